@@ -9,8 +9,9 @@ https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
+# streams images with async reads on Django versions whose handler can't
+from image_picker.asgi import get_asgi_application
+
 application = get_asgi_application()
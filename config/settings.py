@@ -48,11 +48,13 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django_vite',
     'rest_framework',
-    'image_picker',
+    'image_picker.apps.ImagePickerConfig',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # after SecurityMiddleware which hides async handlers from the next one on Django 3.1
+    'image_picker.metrics.server_timing_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -92,6 +94,13 @@ DATABASES = {
     }
 }
 
+# shared by all worker processes of a host, galleries registry and picker settings rely on it
+CACHES = {
+    'default': env.cache("CACHE_URL", default=f"filecache://{BASE_DIR / 'cache' / 'django'}"),
+}
+# tests get a cache directory of their own
+TEST_RUNNER = "config.test_runner.TestRunner"
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -155,4 +164,92 @@ if DEBUG:
 
 DJANGO_VITE_DEV_MODE = env("DJANGO_VITE_DEV_MODE")
 DJANGO_VITE_DEV_SERVER_PORT = 3000
-DJANGO_VITE_DEV_SERVER_HOST = env("DJANGO_VITE_DEV_SERVER_HOST")
\ No newline at end of file
+DJANGO_VITE_DEV_SERVER_HOST = env("DJANGO_VITE_DEV_SERVER_HOST")
+
+# image picker
+# upper bound of image entries kept in the in-process galleries index cache, sorted views included
+IMAGE_PICKER_INDEX_CACHE_MAX_IMAGES = env.int("IMAGE_PICKER_INDEX_CACHE_MAX_IMAGES", default=500_000)
+
+# worker processes for image decoding, None uses the number of CPUs
+IMAGE_PICKER_PROCESS_POOL_WORKERS = env.int("IMAGE_PICKER_PROCESS_POOL_WORKERS", default=2)
+
+# thumbnails
+IMAGE_PICKER_THUMBNAIL_DIR = env("IMAGE_PICKER_THUMBNAIL_DIR", default=str(BASE_DIR / 'cache' / 'thumbnails'))
+IMAGE_PICKER_THUMBNAIL_SIZES = {
+    "small": 320,
+    "medium": 800,
+    "large": 1600,
+}
+IMAGE_PICKER_THUMBNAIL_QUALITY = 80
+IMAGE_PICKER_THUMBNAIL_TIMEOUT = 30
+
+# full size images re-encoded to avif or webp when the browser accepts them
+IMAGE_PICKER_TRANSCODE = env.bool("IMAGE_PICKER_TRANSCODE", default=False)
+IMAGE_PICKER_TRANSCODE_DIR = env("IMAGE_PICKER_TRANSCODE_DIR", default=str(BASE_DIR / 'cache' / 'transcoded'))
+# preferred first
+IMAGE_PICKER_TRANSCODE_FORMATS = ["avif", "webp"]
+IMAGE_PICKER_TRANSCODE_QUALITY = 75
+# smaller jpeg and png files are served as they are
+IMAGE_PICKER_TRANSCODE_MIN_SIZE = 256 * 1024
+IMAGE_PICKER_TRANSCODE_CACHE_MAX_BYTES = env.int("IMAGE_PICKER_TRANSCODE_CACHE_MAX_BYTES", default=2 * 1024 ** 3)
+
+# image delivery
+# image URLs change when images are marked so they can be cached for long
+IMAGE_PICKER_IMAGE_CACHE_CONTROL = env("IMAGE_PICKER_IMAGE_CACHE_CONTROL", default="private, max-age=31536000, immutable")
+# python, sendfile, x-sendfile, x-accel-redirect or a dotted path to a DeliveryBackend
+IMAGE_PICKER_DELIVERY_BACKEND = env("IMAGE_PICKER_DELIVERY_BACKEND", default="python")
+# nginx internal location aliased to / for x-accel-redirect
+IMAGE_PICKER_X_ACCEL_LOCATION = env("IMAGE_PICKER_X_ACCEL_LOCATION", default="/protected/")
+
+# read images listings from the database index filled by sync_galleries command
+IMAGE_PICKER_USE_IMAGES_INDEX = env.bool("IMAGE_PICKER_USE_IMAGES_INDEX", default=False)
+
+# keep galleries indexes hot watching their directories
+IMAGE_PICKER_WATCHER = env.bool("IMAGE_PICKER_WATCHER", default=False)
+# auto, inotify or polling
+IMAGE_PICKER_WATCHER_BACKEND = env("IMAGE_PICKER_WATCHER_BACKEND", default="auto")
+IMAGE_PICKER_WATCHER_POLL_INTERVAL = 2.0
+
+# threads for parallel batch operations on slow or network filesystems
+IMAGE_PICKER_BATCH_WORKERS = 8
+
+# threads listing subdirectories of recursive galleries
+IMAGE_PICKER_WALK_WORKERS = 8
+
+# threads loading galleries listings for the cross-gallery feed
+IMAGE_PICKER_FEED_WORKERS = 8
+
+# threads doing filesystem work for async views
+IMAGE_PICKER_ASYNC_WORKERS = 32
+
+# cache alias shared by all workers for the galleries registry, changes made by any
+# process, e.g. admin or management commands, are seen by the others on their next request
+IMAGE_PICKER_GALLERY_CACHE = "default"
+# without the shared cache every process reloads galleries this often in seconds,
+# None never reloads which is only right for single process deployments
+IMAGE_PICKER_GALLERY_REGISTRY_TTL = 10
+
+# Server-Timing headers and /metrics endpoint
+IMAGE_PICKER_METRICS = env.bool("IMAGE_PICKER_METRICS", default=False)
+# /metrics is served to staff users, requests with "Authorization: Bearer <token>"
+# and these addresses, behind a reverse proxy every request has its address so use the token
+IMAGE_PICKER_METRICS_TOKEN = env.str("IMAGE_PICKER_METRICS_TOKEN", default=None)
+IMAGE_PICKER_METRICS_ALLOWED_IPS = env.list("IMAGE_PICKER_METRICS_ALLOWED_IPS", default=["127.0.0.1", "::1"])
+
+# read image metadata of a whole gallery in background when its listing is requested
+IMAGE_PICKER_METADATA_PREFETCH = env.bool("IMAGE_PICKER_METADATA_PREFETCH", default=False)
+
+# where picker settings are kept: session, signed-cookie, cache or user, which keeps
+# settings of signed in users in the database behind the cache and uses cookies for others
+IMAGE_PICKER_SETTINGS_STORE = env("IMAGE_PICKER_SETTINGS_STORE", default="signed-cookie")
+# cache alias of cache and user stores, it has to be shared by all workers
+IMAGE_PICKER_SETTINGS_CACHE = "default"
+
+# per-gallery SQLite files with marks of galleries in sidecar mark mode
+IMAGE_PICKER_MARKS_DIR = env("IMAGE_PICKER_MARKS_DIR", default=str(BASE_DIR / 'marks'))
+
+# deleted images are moved to .trash of their gallery and removed by purge_trash command
+IMAGE_PICKER_TRASH = env.bool("IMAGE_PICKER_TRASH", default=False)
+IMAGE_PICKER_TRASH_MAX_AGE_DAYS = env.float("IMAGE_PICKER_TRASH_MAX_AGE_DAYS", default=30)
+# per gallery, None for no quota
+IMAGE_PICKER_TRASH_MAX_BYTES = None
@@ -0,0 +1,28 @@
+""" Test runner keeping tests off the caches of a running development server """
+import tempfile
+from typing import Any
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """ Runs tests with a file cache of their own
+
+    It is still shared by processes like the configured one, so the registry behaves
+    as deployed, but a dev server using the same project never sees test galleries.
+    """
+
+    def setup_test_environment(self, **kwargs:Any) -> None:
+        super().setup_test_environment(**kwargs)
+        self._cache_dir = tempfile.TemporaryDirectory(prefix="image_picker_tests_")
+        self._caches = override_settings(CACHES={"default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": self._cache_dir.name,
+        }})
+        self._caches.enable()
+
+    def teardown_test_environment(self, **kwargs:Any) -> None:
+        self._caches.disable()
+        self._cache_dir.cleanup()
+        super().teardown_test_environment(**kwargs)
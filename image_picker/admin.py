@@ -24,6 +24,6 @@ class GalleryAdmin(WidgetAttrsMixin, admin.ModelAdmin):
         'slug': {'autocomplete' : 'off'},
         'dir_path': {'autocomplete' : 'off'}
     }
-    list_display = ('title', 'dir_path')
+    list_display = ('title', 'dir_path', 'recursive', 'mark_mode')
     
 
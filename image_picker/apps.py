@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ImagePickerConfig(AppConfig):
     name = 'image_picker'
+
+    def ready(self) -> None:
+        # connects cache invalidation receivers and watcher startup
+        from . import registry, settings_store, thumbnails, transcoding, watcher  # noqa: F401
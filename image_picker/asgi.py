@@ -0,0 +1,64 @@
+""" ASGI handler sending responses with async content on Django versions before 4.2
+
+Older handlers iterate streaming content in the event loop, so every chunk read
+would block it. Responses of AsyncStreamingHttpResponse are sent with async for
+instead, other responses as usual.
+"""
+from typing import Any, AsyncIterator, Callable, cast
+
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.http import HttpRequest
+from django.http.response import HttpResponseBase
+
+
+class AsyncStreamingHttpResponse(HttpResponseBase):
+    streaming = True
+
+    def __init__(self, streaming_content:AsyncIterator[bytes], *args:Any, **kwargs:Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.streaming_content = streaming_content
+
+    def __iter__(self) -> Any:
+        raise TypeError("async content can only be sent by image_picker.asgi.ASGIHandler")
+
+
+def supports_async_content(request:HttpRequest) -> bool:
+    """ Whether AsyncStreamingHttpResponse can be returned for the request """
+    return getattr(request, "async_content", False)
+
+
+class ASGIHandler(DjangoASGIHandler):
+
+    def create_request(self, scope:Any, body_file:Any) -> Any:
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            cast(Any, request).async_content = True
+        return request, error_response
+
+    async def send_response(self, response:Any, send:Callable[[dict], Any]) -> None:
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            await super().send_response(response, send)
+            return
+
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode("ascii")
+            if isinstance(value, str):
+                value = value.encode("latin1")
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b"Set-Cookie", cookie.output(header="").encode("ascii").strip()))
+
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        async for chunk in response.streaming_content:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body"})
+        await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application() -> ASGIHandler:
+    django.setup(set_prefix=False)
+    return ASGIHandler()
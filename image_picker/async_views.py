@@ -0,0 +1,160 @@
+""" Native async views for ASGI servers
+
+Filesystem work runs in a bounded thread pool so the event loop is never
+blocked and one worker can serve many concurrent downloads.
+"""
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Protocol, TypeVar, cast
+
+import django
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import (Http404, HttpRequest, HttpResponse, HttpResponseNotAllowed, JsonResponse,
+                         StreamingHttpResponse)
+
+from .asgi import AsyncStreamingHttpResponse, supports_async_content
+from .delivery import DeliveryBackend, RANGE_CHUNK_SIZE
+from .models import Gallery
+from .registry import gallery_registry, get_gallery_or_404
+from .serializers import ImageUrls, image_data, images_rows
+from .services import DEFAULT_SHOW_MODE, FSImagesProvider, ImagesException, ShowModeA
+from .transcoding import serve_image
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_ASYNC_WORKERS: int
+
+
+settings = cast(MySettings, settings)
+
+T = TypeVar("T")
+
+# async iterators in StreamingHttpResponse are supported since Django 4.2
+ASYNC_STREAMING = django.VERSION >= (4, 2)
+
+_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "IMAGE_PICKER_ASYNC_WORKERS", 32),
+    thread_name_prefix="image-picker-io"
+)
+
+def _call_io(func:Callable[..., T], *args:Any) -> T:
+    try:
+        return func(*args)
+    finally:
+        # pool threads outlive requests, their connections are closed like request ones
+        close_old_connections()
+
+async def run_io(func:Callable[..., T], *args:Any) -> T:
+    # executor threads don't inherit context, request timings are in a context var
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, context.run, _call_io, func, *args
+    )
+
+async def aiter_file_range(path:Path, start:int, end:int) -> AsyncIterator[bytes]:
+    f = await run_io(open, path, "rb")
+    try:
+        await run_io(f.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await run_io(f.read, min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await run_io(f.close)
+
+
+class AsyncPythonDelivery(DeliveryBackend):
+    """ Streams file with reads done in the io pool """
+
+    def serve(self, request:HttpRequest, path:Path, st:os.stat_result,
+              content_type:str, byte_range:tuple[int, int]|None) -> HttpResponse:
+        start, end = byte_range or (0, st.st_size - 1)
+        response_class = StreamingHttpResponse if ASYNC_STREAMING else AsyncStreamingHttpResponse
+        response = response_class(
+            aiter_file_range(path, start, end),
+            status=200 if byte_range is None else 206,
+            content_type=content_type
+        )
+        response["Content-Length"] = str(end - start + 1)
+        return response
+
+
+async def aget_gallery_or_404(gallery_slug:str) -> Gallery:
+    galleries = gallery_registry.peek()
+    if galleries is not None:
+        if gallery_slug not in galleries:
+            raise Http404("No Gallery matches the given query.")
+        return galleries[gallery_slug]
+    # the shared cache is read on every lookup, in the io pool lookups don't queue on one thread
+    return await run_io(get_gallery_or_404, gallery_slug)
+
+async def images_async(request:HttpRequest, gallery_slug:str) -> JsonResponse:
+    gallery = await aget_gallery_or_404(gallery_slug)
+    show_mode = cast(ShowModeA, request.GET.get("show_mode", DEFAULT_SHOW_MODE))
+
+    try:
+        images = await run_io(lambda: FSImagesProvider(gallery).get_images(show_mode))
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+
+    return JsonResponse(images_rows(images, ImageUrls("get-image-async", gallery_slug)), safe=False)
+
+
+def _serve_image(request:HttpRequest, gallery:Gallery, image_url:str,
+                 backend:DeliveryBackend|None) -> HttpResponse:
+    helper = FSImagesProvider(gallery)
+    helper.check_parent_and_raise(image_url)
+    return serve_image(request, helper.get_image_path(image_url), backend)
+
+async def get_image_async(request:HttpRequest, gallery_slug:str, image_url:str) -> HttpResponse:
+    gallery = await aget_gallery_or_404(gallery_slug)
+
+    # older Django handlers iterate streaming content in the event loop, unless it is
+    # image_picker.asgi one, use the regular backend with them
+    async_content = ASYNC_STREAMING or supports_async_content(request)
+    backend = AsyncPythonDelivery() if async_content else None
+    try:
+        return await run_io(_serve_image, request, gallery, image_url, backend)
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+    except ImagesException as e:
+        raise Http404(str(e))
+
+
+async def mark_image_async(request:HttpRequest, gallery_slug:str, image_url:str,
+                           mark:bool=True) -> HttpResponse:
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    gallery = await aget_gallery_or_404(gallery_slug)
+    try:
+        image_info = await run_io(lambda: FSImagesProvider(gallery).mark_image(image_url, mark))
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+
+    return JsonResponse(image_data(image_info, ImageUrls("get-image-async", gallery_slug)))
+
+
+async def delete_image_async(request:HttpRequest, gallery_slug:str, image_url:str) -> HttpResponse:
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
+    gallery = await aget_gallery_or_404(gallery_slug)
+    try:
+        await run_io(lambda: FSImagesProvider(gallery).delete_image(image_url))
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+
+    return HttpResponse(status=204)
+
+
+# csrf_exempt decorator isn't async aware before Django 5.0, API views are exempt as DRF ones
+for view in (mark_image_async, delete_image_async):
+    cast(Any, view).csrf_exempt = True
@@ -0,0 +1,177 @@
+""" Timings of image_picker hot paths on synthetic galleries, see benchmark_images command """
+import os
+import platform
+import statistics
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, Callable, Iterator, NamedTuple, TypedDict
+
+import django
+from django.conf import settings
+from django.db import transaction
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+
+from .models import Gallery
+from .registry import gallery_registry
+from .services import FSImagesProvider, ShowMode, images_index_cache
+
+# a million images gallery takes minutes and about 4GB of disk to create, pass it in sizes
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+
+class TimingDict(TypedDict):
+    min: float
+    median: float
+    runs: int
+
+
+class Regression(NamedTuple):
+    name: str
+    baseline: float
+    current: float
+
+    @property
+    def ratio(self) -> float:
+        return self.current / self.baseline
+
+
+def image_name(i:int) -> str:
+    # every third image is marked
+    return f"{i:07d}_.jpg" if i % 3 == 0 else f"{i:07d}.jpg"
+
+def make_gallery_files(dirpath:Path, size:int) -> None:
+    for i in range(size):
+        (dirpath / image_name(i)).write_bytes(b"\xff\xd8" + bytes(1022))
+    # a just modified directory is rescanned on every request, galleries are usually settled
+    settled = time.time() - 60
+    os.utime(dirpath, (settled, settled))
+
+def measure(func:Callable[[int], Any], repeat:int, setup:Callable[[], Any]|None=None) -> TimingDict:
+    """ Calls func with the run number repeat times and returns seconds per call """
+    timings = []
+    for run in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func(run)
+        timings.append(time.perf_counter() - start)
+    return {"min": min(timings), "median": statistics.median(timings), "runs": repeat}
+
+
+@contextmanager
+def throwaway_databases() -> Iterator[None]:
+    """ Test databases replacing the configured ones, so these are neither written nor locked """
+    old_config = setup_databases(verbosity=0, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+
+
+@contextmanager
+def benchmark_gallery(size:int, tmp_dir:str|None=None, rollback:bool=False) -> Iterator[Gallery]:
+    """ Gallery of synthetic files, deleted afterwards or with rollback never committed """
+    slug = f"benchmark-{uuid.uuid4().hex[:8]}"
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as dirname:
+        make_gallery_files(Path(dirname), size)
+        try:
+            if rollback:
+                with transaction.atomic():
+                    gallery = Gallery.objects.create(title="benchmark", slug=slug, dir_path=dirname)
+                    yield gallery
+                    transaction.set_rollback(True)
+            else:
+                gallery = Gallery.objects.create(title="benchmark", slug=slug, dir_path=dirname)
+                try:
+                    yield gallery
+                finally:
+                    gallery.delete()
+        finally:
+            # rollback doesn't send delete signals
+            gallery_registry.invalidate()
+            images_index_cache.invalidate(slug)
+
+
+def run_gallery_benchmarks(gallery:Gallery, size:int, repeat:int) -> dict[str, TimingDict]:
+    results: dict[str, TimingDict] = {}
+    provider = FSImagesProvider(gallery)
+    invalidate = provider.invalidate_index
+    client = Client()
+
+    for show_mode in ShowMode.MODES_LIST:
+        results[f"{size}/get_images/{show_mode}/cold"] = measure(
+            lambda _: provider.get_images(show_mode), repeat, setup=invalidate
+        )
+        results[f"{size}/get_images/{show_mode}/warm"] = measure(
+            lambda _: provider.get_images(show_mode), repeat
+        )
+    results[f"{size}/get_page/warm"] = measure(lambda _: provider.get_page(limit=100), repeat)
+
+    images_url = reverse("images", args=[gallery.slug])
+    results[f"{size}/view/images/all"] = measure(
+        lambda _: client.get(images_url, {"show_mode": ShowMode.ALL}), repeat
+    )
+    results[f"{size}/view/images/page"] = measure(
+        lambda _: client.get(images_url, {"limit": 100}), repeat
+    )
+    image_url = reverse("get-image", args=[gallery.slug, image_name(1)])
+    results[f"{size}/view/get_image"] = measure(
+        lambda _: client.get(image_url).getvalue(), repeat
+    )
+
+    # unmarked images 1, 2, 4, 5, ... are marked and deleted one per run
+    unmarked = [i for i in range(size) if i % 3][:repeat]
+    results[f"{size}/mark_image"] = measure(
+        lambda run: provider.mark_image(image_name(unmarked[run]), mark=True), repeat
+    )
+    results[f"{size}/delete_image"] = measure(
+        lambda run: provider.delete_image(image_name(unmarked[run])[:-4] + "_.jpg"), repeat
+    )
+    return results
+
+
+def run_benchmarks(sizes:tuple[int, ...]=DEFAULT_SIZES, repeat:int=5, tmp_dir:str|None=None,
+                   log:Callable[[str], Any]|None=None, throwaway_db:bool=True) -> dict[str, Any]:
+    """ Without throwaway_db galleries are written to the current database in rolled back transactions """
+    results: dict[str, TimingDict] = {}
+    # test client requests come to testserver host
+    with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+        with throwaway_databases() if throwaway_db else nullcontext():
+            for size in sizes:
+                if log:
+                    log(f"benchmarking {size} images")
+                with benchmark_gallery(size, tmp_dir, rollback=not throwaway_db) as gallery:
+                    results.update(run_gallery_benchmarks(gallery, size, repeat))
+
+    return {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(baseline:dict[str, Any], current:dict[str, Any], tolerance:float,
+            min_delta:float=0.001) -> list[Regression]:
+    """ Benchmarks whose median got slower than baseline by more than tolerance
+
+    Slowdowns under min_delta seconds are timer noise and are ignored.
+    """
+    regressions = []
+    for name, timing in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or base["median"] <= 0:
+            continue
+        if (timing["median"] > base["median"] * (1 + tolerance) and
+                timing["median"] - base["median"] > min_delta):
+            regressions.append(Regression(name, base["median"], timing["median"]))
+    return regressions
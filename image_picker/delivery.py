@@ -0,0 +1,234 @@
+import mimetypes
+import os
+import re
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator, Protocol, cast
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import FileResponse, HttpRequest, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.module_loading import import_string
+
+from .metrics import bytes_served, count
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_IMAGE_CACHE_CONTROL: str|None
+    IMAGE_PICKER_DELIVERY_BACKEND: str
+    IMAGE_PICKER_X_ACCEL_LOCATION: str
+
+
+settings = cast(MySettings, settings)
+
+RANGE_CHUNK_SIZE = 64 * 1024
+_range_re = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def get_etag(st:os.stat_result) -> str:
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+def parse_range(header:str, size:int) -> tuple[int, int]|None:
+    """ Returns inclusive (start, end) of a single byte range or None to send whole file """
+    match = _range_re.match(header.strip())
+    # multiple ranges and unknown units are allowed to be ignored
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+
+    first, last = match.groups()
+    if first == "":
+        # suffix range: last N bytes
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable(header)
+        return max(0, size - length), size - 1
+
+    start = int(first)
+    # last before first makes the header invalid, which is ignored like a malformed one
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(int(last), size - 1) if last else size - 1
+
+def if_range_passes(request:HttpRequest, etag:str, last_modified:int) -> bool:
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+def get_requested_range(request:HttpRequest, st:os.stat_result, etag:str) -> tuple[int, int]|None:
+    header = request.META.get("HTTP_RANGE")
+    if not header or request.method not in ("GET", "HEAD"):
+        return None
+    if not if_range_passes(request, etag, int(st.st_mtime)):
+        return None
+    return parse_range(header, st.st_size)
+
+def iter_file_range(path:Path, start:int, end:int) -> Iterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def set_validators(response:HttpResponse, st:os.stat_result, etag:str) -> HttpResponse:
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(st.st_mtime)
+    cache_control = getattr(settings, "IMAGE_PICKER_IMAGE_CACHE_CONTROL", None)
+    if cache_control:
+        response["Cache-Control"] = cache_control
+    return response
+
+class FileRange:
+    """ File object limited to a byte range
+
+    fileno() is kept so WSGI servers can still sendfile() it, they start at
+    the current offset and stop at Content-Length.
+    """
+
+    def __init__(self, file:BinaryIO, start:int, end:int) -> None:
+        self._file = file
+        self._file.seek(start)
+        self._remaining = end - start + 1
+
+    def read(self, size:int=-1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DeliveryBackend:
+    """ Sends a file which already passed gallery and conditional checks """
+
+    def serve(self, request:HttpRequest, path:Path, st:os.stat_result,
+              content_type:str, byte_range:tuple[int, int]|None) -> HttpResponse:
+        raise NotImplementedError()
+
+
+class PythonDelivery(DeliveryBackend):
+    """ Streams file through the Python worker """
+
+    def serve(self, request:HttpRequest, path:Path, st:os.stat_result,
+              content_type:str, byte_range:tuple[int, int]|None) -> HttpResponse:
+        if byte_range is None:
+            return FileResponse(open(path, "rb"), content_type=content_type)
+
+        start, end = byte_range
+        return StreamingHttpResponse(
+            iter_file_range(path, start, end), status=206, content_type=content_type
+        )
+
+
+class SendfileDelivery(DeliveryBackend):
+    """ Hands an open file to the server's wsgi.file_wrapper
+
+    Servers like gunicorn send it with os.sendfile without copying data
+    through Python, range responses included.
+    """
+    block_size = 1024 * 1024
+
+    def serve(self, request:HttpRequest, path:Path, st:os.stat_result,
+              content_type:str, byte_range:tuple[int, int]|None) -> HttpResponse:
+        file = open(path, "rb")
+        if byte_range is None:
+            response = FileResponse(file, content_type=content_type)
+        else:
+            response = FileResponse(FileRange(file, *byte_range), status=206,
+                                    content_type=content_type)
+        response.block_size = self.block_size
+        return response
+
+
+class XSendfileDelivery(DeliveryBackend):
+    """ Apache mod_xsendfile and lighttpd send the file named in the header """
+    header = "X-Sendfile"
+
+    def get_header_value(self, path:Path) -> str:
+        return str(path)
+
+    def serve(self, request:HttpRequest, path:Path, st:os.stat_result,
+              content_type:str, byte_range:tuple[int, int]|None) -> HttpResponse:
+        # ranges are served by the front server from the original request
+        response = HttpResponse(content_type=content_type)
+        response[self.header] = self.get_header_value(path)
+        return response
+
+
+class XAccelRedirectDelivery(XSendfileDelivery):
+    """ nginx internal redirect, needs an internal location aliased to /
+
+        location /protected/ { internal; alias /; }
+    """
+    header = "X-Accel-Redirect"
+
+    def get_header_value(self, path:Path) -> str:
+        location = getattr(settings, "IMAGE_PICKER_X_ACCEL_LOCATION", "/protected/")
+        return location.rstrip("/") + quote(path.as_posix())
+
+
+DELIVERY_BACKENDS: dict[str, type[DeliveryBackend]] = {
+    "python": PythonDelivery,
+    "sendfile": SendfileDelivery,
+    "x-sendfile": XSendfileDelivery,
+    "x-accel-redirect": XAccelRedirectDelivery,
+}
+
+def get_delivery_backend() -> DeliveryBackend:
+    name = getattr(settings, "IMAGE_PICKER_DELIVERY_BACKEND", "python")
+    backend_class: Any = DELIVERY_BACKENDS.get(name)
+    if backend_class is None:
+        try:
+            backend_class = import_string(name)
+        except ImportError as e:
+            raise ImproperlyConfigured(f"unknown image delivery backend {name}") from e
+    return backend_class()
+
+def serve_file(request:HttpRequest, path:Path, content_type:str|None=None,
+               backend:DeliveryBackend|None=None) -> HttpResponse:
+    """ Serves a file honouring conditional and range requests """
+    st = os.stat(path)
+    etag = get_etag(st)
+
+    # validators come from stat so the file isn't opened for 304
+    response = get_conditional_response(request, etag=etag, last_modified=int(st.st_mtime))
+    if response is not None:
+        return set_validators(response, st, etag)
+
+    content_type = content_type or mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    try:
+        byte_range = get_requested_range(request, st, etag)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{st.st_size}"
+        return set_validators(response, st, etag)
+
+    backend = backend or get_delivery_backend()
+    response = backend.serve(request, path, st, content_type, byte_range)
+    if byte_range is not None and response.status_code == 206:
+        start, end = byte_range
+        response["Content-Length"] = str(end - start + 1)
+        response["Content-Range"] = f"bytes {start}-{end}/{st.st_size}"
+
+    response["Accept-Ranges"] = "bytes"
+    start, end = byte_range or (0, st.st_size - 1)
+    count(bytes_served, "bytes", end - start + 1)
+    return set_validators(response, st, etag)
@@ -0,0 +1,219 @@
+""" Near-duplicate search over perceptual hashes of gallery images """
+import threading
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple
+
+from django.db import transaction
+
+from .imaging import dhash_many
+from .indexing import match_renames, plan_derived_rows
+from .models import Gallery, ImageHash
+from .services import DerivedData, FSImagesProvider, GalleryIndex, ImageInfo
+from .workers import get_process_pool
+
+HASH_BITS = 64
+HASH_CHUNK_SIZE = 64
+DEFAULT_MAX_DISTANCE = 6
+
+def to_signed(value:int) -> int:
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def to_unsigned(value:int) -> int:
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+def hamming(a:int, b:int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """ Metric tree over Hamming distance, search skips subtrees the triangle inequality rules out """
+    __slots__ = ("_root", "_size")
+
+    def __init__(self) -> None:
+        # node is [hash, names, {distance: child node}]
+        self._root: list[Any]|None = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value:int, name:str) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [name], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(name)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [name], {}]
+                return
+            node = child
+
+    def search(self, value:int, max_distance:int) -> Iterator[tuple[int, str]]:
+        """ Yields distance and name of every hash within max_distance """
+        if self._root is None:
+            return
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                for name in node[1]:
+                    yield distance, name
+            low, high = distance - max_distance, distance + max_distance
+            stack.extend(child for d, child in node[2].items() if low <= d <= high)
+
+
+class HashesResult(NamedTuple):
+    hashed: int
+    renamed: int
+    deleted: int
+
+
+def update_hashes(gallery:Gallery, images:list[ImageInfo]) -> HashesResult:
+    """ Hashes images new or modified since their stored hash and drops hashes of gone ones """
+    stored = {
+        name: (pk, mod_time)
+        for pk, name, mod_time in ImageHash.objects.filter(gallery=gallery)
+            .values_list("pk", "name", "mod_time").iterator()
+    }
+    to_hash, renamed, to_delete = plan_derived_rows(stored, images)
+
+    dirpath = Path(gallery.dir_path).resolve()
+    chunks = [to_hash[i:i+HASH_CHUNK_SIZE] for i in range(0, len(to_hash), HASH_CHUNK_SIZE)]
+    hashes = get_process_pool().map(
+        dhash_many, [[str(dirpath / image.name) for image, _ in chunk] for chunk in chunks]
+    )
+
+    rows = [
+        ImageHash(pk=pk, gallery=gallery, name=image.name, mod_time=image.mod_time,
+                  dhash=None if value is None else to_signed(value))
+        for chunk, values in zip(chunks, hashes)
+        for (image, pk), value in zip(chunk, values)
+    ]
+    with transaction.atomic():
+        # rows another process, e.g. hash_galleries, stored meanwhile are kept, hashes are
+        # read back from the database afterwards anyway
+        ImageHash.objects.bulk_create([row for row in rows if row.pk is None], batch_size=1000,
+                                      ignore_conflicts=True)
+        ImageHash.objects.bulk_update([row for row in rows if row.pk is not None],
+                                      ["mod_time", "dhash"], batch_size=1000)
+        if renamed:
+            new_names = [name for _, name in renamed]
+            for i in range(0, len(new_names), 1000):
+                ImageHash.objects.filter(gallery=gallery, name__in=new_names[i:i+1000]).exclude(
+                    pk__in=[pk for pk, _ in renamed[i:i+1000]]
+                ).delete()
+            ImageHash.objects.bulk_update([ImageHash(pk=pk, name=name) for pk, name in renamed],
+                                          ["name"], batch_size=1000)
+        for i in range(0, len(to_delete), 1000):
+            ImageHash.objects.filter(pk__in=to_delete[i:i+1000]).delete()
+    return HashesResult(len(rows), len(renamed), len(to_delete))
+
+
+class HashIndex(DerivedData):
+    """ Hashes of one listing version of a gallery, attached to the listing """
+    # marking and deleting keep hashes of the remaining images valid
+    carried_over = True
+
+    def __init__(self, images:list[ImageInfo], hashes:dict[str, int], mod_times:dict[str, float]) -> None:
+        # listing images the hashes are for, a listing it is carried over to has others
+        self.images = images
+        self.hashes = hashes
+        # of every hashed image, also of those that couldn't be read
+        self.mod_times = mod_times
+        self.tree = BKTree()
+        for name, value in hashes.items():
+            self.tree.add(value, name)
+
+    def __len__(self) -> int:
+        return len(self.mod_times)
+
+    def rebased(self, images:list[ImageInfo]) -> "HashIndex|None":
+        """ Index of a listing whose images were only renamed by marking or removed, else None """
+        names = match_renames(self.mod_times, images)
+        if names is None:
+            return None
+        hashes = {name: self.hashes[old] for name, old in names.items() if old in self.hashes}
+        return HashIndex(images, hashes, {image.name: image.mod_time for image in images})
+
+    def similar(self, name:str, max_distance:int=DEFAULT_MAX_DISTANCE) -> list[tuple[int, str]]:
+        value = self.hashes.get(name)
+        if value is None:
+            return []
+        return sorted(
+            (distance, other) for distance, other in self.tree.search(value, max_distance)
+            if other != name
+        )
+
+    def clusters(self, max_distance:int=DEFAULT_MAX_DISTANCE) -> list[list[str]]:
+        """ Groups of images linked by chains of near duplicates, largest first """
+        parent = {name: name for name in self.hashes}
+
+        def find(name:str) -> str:
+            while parent[name] != name:
+                parent[name] = parent[parent[name]]
+                name = parent[name]
+            return name
+
+        for name, value in self.hashes.items():
+            for _, other in self.tree.search(value, max_distance):
+                root, other_root = find(name), find(other)
+                if root != other_root:
+                    parent[other_root] = root
+
+        groups: dict[str, list[str]] = {}
+        for name in self.hashes:
+            groups.setdefault(find(name), []).append(name)
+        return sorted((sorted(group) for group in groups.values() if len(group) > 1),
+                      key=lambda group: (-len(group), group[0]))
+
+
+_gallery_locks_lock = threading.Lock()
+# one hasher per gallery, concurrent requests wait for it instead of hashing the same images
+_gallery_locks: dict[str, threading.Lock] = {}
+
+def _current_index(listing:GalleryIndex) -> HashIndex|None:
+    index = listing.derived.get("hashes")
+    # listings are replaced, not modified, when the gallery changes
+    return index if index is not None and index.images is listing.images else None
+
+def get_hash_index(gallery:Gallery) -> HashIndex:
+    """ Hash index of the current listing, hashing only what changed since the stored hashes
+
+    It is kept with the cached listing and carried over to the next one, which reads the
+    database again only if images were added or modified.
+    """
+    provider = FSImagesProvider(gallery)
+    # sidecar marks don't rename images, so the scanned listing is enough
+    index = _current_index(provider.get_scanned_index())
+    if index is not None:
+        return index
+
+    with _gallery_locks_lock:
+        lock = _gallery_locks.setdefault(gallery.slug, threading.Lock())
+    with lock:
+        listing = provider.get_scanned_index()
+        index = _current_index(listing)
+        if index is not None:
+            return index
+
+        carried = listing.derived.get("hashes")
+        index = carried.rebased(listing.images) if carried is not None else None
+        if index is None:
+            update_hashes(gallery, listing.images)
+            names = {image.name for image in listing.images}
+            hashes = {
+                name: to_unsigned(value)
+                for name, value in ImageHash.objects.filter(gallery=gallery, dhash__isnull=False)
+                    .values_list("name", "dhash").iterator()
+                if name in names
+            }
+            index = HashIndex(listing.images, hashes, {image.name: image.mod_time for image in listing.images})
+        listing.attach("hashes", index)
+        return index
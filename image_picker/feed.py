@@ -0,0 +1,90 @@
+""" Images of many galleries merged into one sorted feed, one page at a time """
+import base64
+import binascii
+import heapq
+import json
+from itertools import islice
+from typing import Any, Iterator, NamedTuple, TypedDict
+
+from .models import Gallery
+from .services import (FSImagesProvider, GalleryIndex, ImageInfo, ImagesException, ShowMode,
+                       ShowModeA, SortKey, SortKeyA, SortOrder, SortOrderA, SORT_KEY_FUNCS)
+from .workers import get_feed_pool
+
+
+class FeedImage(NamedTuple):
+    gallery: str
+    image: ImageInfo
+
+
+class FeedPage(TypedDict):
+    results: list[FeedImage]
+    next: str|None
+    # galleries whose listing couldn't be loaded with the reason
+    skipped: dict[str, str]
+
+
+def encode_feed_cursor(item:FeedImage) -> str:
+    data = json.dumps([item.gallery, item.image.name, item.image.mod_time]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_feed_cursor(cursor:str) -> FeedImage:
+    try:
+        gallery, name, mod_time = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if (not isinstance(gallery, str) or not isinstance(name, str) or
+                not isinstance(mod_time, (int, float))):
+            raise ValueError(cursor)
+    except (ValueError, TypeError, binascii.Error):
+        raise ImagesException(f"invalid cursor {cursor}")
+    return FeedImage(gallery, ImageInfo(name, False, float(mod_time)))
+
+
+def load_listings(galleries:list[Gallery]) -> tuple[dict[str, GalleryIndex], dict[str, str]]:
+    """ Listings of galleries loaded concurrently, mostly hits of the index cache """
+    futures = {
+        gallery.slug: get_feed_pool().submit(lambda g: FSImagesProvider(g).get_index(), gallery)
+        for gallery in galleries
+    }
+    listings: dict[str, GalleryIndex] = {}
+    skipped: dict[str, str] = {}
+    for slug, future in futures.items():
+        try:
+            listings[slug] = future.result()
+        except OSError as e:
+            skipped[slug] = e.strerror or str(e)
+    return listings, skipped
+
+
+def merge_listings(listings:dict[str, GalleryIndex], show_mode:ShowModeA=ShowMode.UNMARKED,
+                   sort:SortKeyA=SortKey.MOD_TIME, order:SortOrderA=SortOrder.ASC,
+                   cursor:str|None=None) -> Iterator[FeedImage]:
+    """ Lazy k-way merge of sorted views, images with equal keys are ordered by gallery slug """
+    reverse = order == SortOrder.DESC
+    after = decode_feed_cursor(cursor) if cursor else None
+    after_key = SORT_KEY_FUNCS[sort](after.image) if after else None
+
+    def stream(slug:str, listing:GalleryIndex) -> Iterator[tuple[tuple[Any, ...], FeedImage]]:
+        # images equal to the cursor key come after it only in galleries following its gallery
+        inclusive = after is not None and (slug < after.gallery if reverse else slug > after.gallery)
+        view = listing.sorted_view(sort, show_mode)
+        for key, image in view.iter_after(after_key, reverse, inclusive):
+            yield (key, slug), FeedImage(slug, image)
+
+    streams = [stream(slug, listing) for slug, listing in listings.items()]
+    for _, item in heapq.merge(*streams, key=lambda pair: pair[0], reverse=reverse):
+        yield item
+
+
+def get_feed_page(galleries:list[Gallery], show_mode:ShowModeA=ShowMode.UNMARKED,
+                  sort:SortKeyA=SortKey.MOD_TIME, order:SortOrderA=SortOrder.ASC,
+                  cursor:str|None=None, limit:int=100) -> FeedPage:
+    listings, skipped = load_listings(galleries)
+    # one extra image tells whether another page follows
+    items = list(islice(merge_listings(listings, show_mode, sort, order, cursor), limit + 1))
+    has_more = len(items) > limit
+    items = items[:limit]
+    return {
+        "results": items,
+        "next": encode_feed_cursor(items[-1]) if has_more else None,
+        "skipped": skipped,
+    }
@@ -0,0 +1,116 @@
+""" Image processing functions executed in worker processes
+
+The module must not import Django so that spawned workers stay light.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Any
+
+
+def generate_thumbnail(source:str, target:str, size:int, quality:int, image_format:str) -> str:
+    from PIL import Image, ImageOps
+
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with Image.open(source) as im:
+        # lets JPEG decoder downscale while decoding
+        im.draft(im.mode, (size, size))
+        thumb = ImageOps.exif_transpose(im)
+        thumb.thumbnail((size, size))
+        if thumb.mode not in ("RGB", "RGBA"):
+            thumb = thumb.convert("RGBA" if "transparency" in thumb.info else "RGB")
+        thumb.save(tmp, image_format, quality=quality)
+    os.replace(tmp, target)
+    return target
+
+
+def transcode_image(source:str, target:str, quality:int, image_format:str) -> int:
+    """ Re-encodes the full size image upright with its color profile, returns the encoded size """
+    from PIL import Image, ImageOps
+
+    tmp = f"{target}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as im:
+            icc_profile = im.info.get("icc_profile")
+            image = ImageOps.exif_transpose(im)
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+            options: dict[str, Any] = {"quality": quality}
+            if icc_profile:
+                options["icc_profile"] = icc_profile
+            image.save(tmp, image_format, **options)
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return os.path.getsize(target)
+
+
+def dhash(source:str, hash_size:int=8) -> int:
+    """ Difference hash, bits tell whether brightness grows between neighbour pixels """
+    from PIL import Image
+
+    with Image.open(source) as im:
+        im.draft("L", (hash_size * 8, hash_size * 8))
+        small = im.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+        pixels = small.tobytes()
+
+    value = 0
+    width = hash_size + 1
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * width + col]
+            value = (value << 1) | (left > pixels[row * width + col + 1])
+    return value
+
+
+def dhash_many(sources:list[str], hash_size:int=8) -> list[int|None]:
+    """ Hashes a chunk of files per task, unreadable ones get None """
+    hashes: list[int|None] = []
+    for source in sources:
+        try:
+            hashes.append(dhash(source, hash_size))
+        except Exception:
+            hashes.append(None)
+    return hashes
+
+
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME = 0x0132
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 0x9003
+
+def parse_exif_datetime(value:Any) -> float|None:
+    """ EXIF local time as milliseconds, read as if it were UTC since EXIF keeps no zone """
+    if not isinstance(value, str):
+        return None
+    try:
+        taken = datetime.strptime(value.strip("\x00 ")[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    return taken.replace(tzinfo=timezone.utc).timestamp() * 1000
+
+
+def read_metadata(source:str) -> tuple[int, int, str, float|None]:
+    """ Size as displayed, format and EXIF capture time read from the header only """
+    from PIL import Image
+
+    with Image.open(source) as im:
+        width, height = im.size
+        exif = im.getexif()
+        # orientations 5-8 rotate by 90 degrees
+        if exif.get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+        taken_at = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+        return width, height, im.format or "", parse_exif_datetime(taken_at)
+
+
+def read_metadata_many(sources:list[str]) -> list[tuple[int, int, str, float|None]|None]:
+    """ Reads a chunk of files per task, unreadable ones get None """
+    results: list[tuple[int, int, str, float|None]|None] = []
+    for source in sources:
+        try:
+            results.append(read_metadata(source))
+        except Exception:
+            results.append(None)
+    return results
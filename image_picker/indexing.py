@@ -0,0 +1,125 @@
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from django.db import transaction
+
+from .models import Gallery, Image, bump_index_version
+from .services import ImageInfo, iter_image_stats, unmarked_name, walk_image_stats
+
+
+class SyncResult(NamedTuple):
+    created: int
+    updated: int
+    deleted: int
+
+
+def sync_gallery(gallery:Gallery, batch_size:int=1000) -> SyncResult:
+    """ Reconciles gallery Image rows with directory touching only changed rows """
+    existing = {
+        name: (pk, marked, mod_time, size)
+        for pk, name, marked, mod_time, size in Image.objects.filter(gallery=gallery)
+            .values_list("pk", "name", "marked", "mod_time", "size").iterator()
+    }
+
+    to_create: list[Image] = []
+    to_update: list[Image] = []
+    dirpath = Path(gallery.dir_path).resolve()
+    stats = walk_image_stats(dirpath) if gallery.recursive else iter_image_stats(dirpath)
+    for name, marked, st in stats:
+        mod_time = st.st_mtime * 1000
+        row = existing.pop(name, None)
+        if row is None:
+            to_create.append(Image(gallery=gallery, name=name, marked=marked,
+                                   mod_time=mod_time, size=st.st_size))
+        elif row[1:] != (marked, mod_time, st.st_size):
+            to_update.append(Image(pk=row[0], gallery=gallery, name=name, marked=marked,
+                                   mod_time=mod_time, size=st.st_size))
+
+    # whatever left wasn't found on disk
+    to_delete = [row[0] for row in existing.values()]
+
+    with transaction.atomic():
+        Image.objects.bulk_create(to_create, batch_size=batch_size)
+        Image.objects.bulk_update(to_update, ["marked", "mod_time", "size"], batch_size=batch_size)
+        for i in range(0, len(to_delete), batch_size):
+            Image.objects.filter(pk__in=to_delete[i:i+batch_size]).delete()
+        if to_create or to_update or to_delete:
+            bump_index_version(gallery.pk)
+
+    return SyncResult(len(to_create), len(to_update), len(to_delete))
+
+
+def apply_changes(gallery:Gallery, removed:Iterable[str], upserts:list[Image],
+                  batch_size:int=1000) -> None:
+    """ Applies watched changes to gallery rows, upserts are matched by name """
+    removed = list(removed)
+    names = [image.name for image in upserts]
+
+    with transaction.atomic():
+        for i in range(0, len(removed), batch_size):
+            Image.objects.filter(gallery=gallery, name__in=removed[i:i+batch_size]).delete()
+
+        existing: dict[str, int] = {}
+        for i in range(0, len(names), batch_size):
+            existing.update(
+                Image.objects.filter(gallery=gallery, name__in=names[i:i+batch_size])
+                    .values_list("name", "pk")
+            )
+        for image in upserts:
+            image.pk = existing.get(image.name)
+
+        Image.objects.bulk_create([i for i in upserts if i.pk is None], batch_size=batch_size)
+        Image.objects.bulk_update([i for i in upserts if i.pk is not None],
+                                  ["marked", "mod_time", "size"], batch_size=batch_size)
+        bump_index_version(gallery.pk)
+
+
+class DerivedRowsPlan(NamedTuple):
+    # images to compute with pk of the outdated row to overwrite
+    to_compute: list[tuple[ImageInfo, int|None]]
+    # pk and new name of rows whose image was only renamed
+    renamed: list[tuple[int, str]]
+    to_delete: list[int]
+
+
+def match_renames(mod_times:dict[str, float], images:Iterable[ImageInfo]) -> dict[str, str]|None:
+    """ Maps images of a listing to their names in a listing with given mod_times
+
+    Returns None if any image is new or modified, so only marking renames and removals
+    separate the listings.
+    """
+    # marking renames keep mtime like in plan_derived_rows
+    previous = {(unmarked_name(name), mod_time): name for name, mod_time in mod_times.items()}
+    names: dict[str, str] = {}
+    for image in images:
+        if mod_times.get(image.name) == image.mod_time:
+            names[image.name] = image.name
+            continue
+        name = previous.get((unmarked_name(image.name), image.mod_time))
+        if name is None:
+            return None
+        names[image.name] = name
+    return names
+
+def plan_derived_rows(stored:dict[str, tuple[int, float]], images:Iterable[ImageInfo]) -> DerivedRowsPlan:
+    """ Compares rows computed from image content, keyed by name with pk and mod_time, with a listing """
+    stored = dict(stored)
+    to_compute: list[tuple[ImageInfo, int|None]] = []
+    new_images: list[ImageInfo] = []
+    for image in images:
+        row = stored.pop(image.name, None)
+        if row is None:
+            new_images.append(image)
+        elif row[1] != image.mod_time:
+            to_compute.append((image, row[0]))
+
+    # marking renames keep mtime, their rows are moved instead of computed again
+    gone = {(unmarked_name(name), mod_time): pk for name, (pk, mod_time) in stored.items()}
+    renamed: list[tuple[int, str]] = []
+    for image in new_images:
+        pk = gone.pop((unmarked_name(image.name), image.mod_time), None)
+        if pk is None:
+            to_compute.append((image, None))
+        else:
+            renamed.append((pk, image.name))
+    return DerivedRowsPlan(to_compute, renamed, list(gone.values()))
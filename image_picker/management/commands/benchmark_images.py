@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.benchmarks import DEFAULT_SIZES, compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ("Times images listing, marking, deleting and serving on synthetic galleries "
+            "and compares results with a saved baseline")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                            help="comma separated gallery sizes, e.g. 1000,10000,1000000")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--tmp-dir", help="directory for galleries, system temp by default")
+        parser.add_argument("--current-database", action="store_true",
+                            help="write galleries to the configured database in rolled back transactions "
+                                 "instead of a throwaway test database, these lock SQLite for the run")
+        parser.add_argument("--output", help="json file for results, stdout by default")
+        parser.add_argument("--baseline", help="json results of a previous run to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.2,
+                            help="allowed median slowdown against baseline, 0.2 is 20%%")
+        parser.add_argument("--min-delta", type=float, default=0.001,
+                            help="slowdowns under this many seconds are ignored")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = tuple(int(size) for size in options["sizes"].split(","))
+        except ValueError:
+            raise CommandError(f"invalid sizes {options['sizes']}")
+        if options["repeat"] < 1:
+            raise CommandError("repeat must be positive")
+        # every run marks and deletes another unmarked image
+        if min(sizes) < 2 * options["repeat"]:
+            raise CommandError("sizes must be at least twice the repeat")
+
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        results = run_benchmarks(sizes, options["repeat"], options["tmp_dir"],
+                                 log=lambda msg: self.stderr.write(msg),
+                                 throwaway_db=not options["current_database"])
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(results, indent=2))
+
+        if baseline is None:
+            return
+
+        regressions = compare(baseline, results, options["tolerance"], options["min_delta"])
+        for regression in regressions:
+            self.stderr.write(
+                f"{regression.name}: {regression.baseline * 1000:.3f}ms -> "
+                f"{regression.current * 1000:.3f}ms ({regression.ratio:.2f}x)"
+            )
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmarks slower than baseline")
+        self.stderr.write("no regressions against baseline")
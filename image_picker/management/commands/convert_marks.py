@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.marks import MarkMode
+from image_picker.models import Gallery
+from image_picker.services import FSImagesProvider, ImagesException
+
+
+class Command(BaseCommand):
+    help = "Switches galleries between file name suffix and sidecar marks moving existing marks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("galleries", nargs="*", metavar="slug",
+                            help="galleries to convert, all by default")
+        parser.add_argument("--to", choices=MarkMode.MODES_LIST, required=True, dest="mode",
+                            help="mark mode to switch to")
+
+    def handle(self, *args, **options):
+        galleries = Gallery.objects.all()
+        if options["galleries"]:
+            galleries = galleries.filter(pk__in=options["galleries"])
+            missing = set(options["galleries"]) - {g.slug for g in galleries}
+            if missing:
+                raise CommandError(f"galleries not found: {', '.join(sorted(missing))}")
+
+        failed = False
+        for gallery in galleries:
+            try:
+                result = FSImagesProvider(gallery).convert_marks(options["mode"])
+            except ImagesException as e:
+                raise CommandError(str(e))
+            except OSError as e:
+                self.stderr.write(f"{gallery.slug}: {e}")
+                failed = True
+                continue
+            self.stdout.write(f"{gallery.slug}: {result.converted} converted")
+            if result.conflicts:
+                self.stderr.write(
+                    f"{gallery.slug}: names taken for {', '.join(result.conflicts)}, "
+                    f"mode is {gallery.mark_mode}"
+                )
+                failed = failed or gallery.mark_mode != options["mode"]
+        if failed:
+            raise CommandError("some galleries were not converted")
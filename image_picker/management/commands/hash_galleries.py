@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.duplicates import update_hashes
+from image_picker.models import Gallery
+from image_picker.services import FSImagesProvider
+
+
+class Command(BaseCommand):
+    help = "Computes perceptual hashes of new and modified gallery images for duplicates search"
+
+    def add_arguments(self, parser):
+        parser.add_argument("galleries", nargs="*", metavar="slug",
+                            help="galleries to hash, all by default")
+
+    def handle(self, *args, **options):
+        galleries = Gallery.objects.all()
+        if options["galleries"]:
+            galleries = galleries.filter(pk__in=options["galleries"])
+            missing = set(options["galleries"]) - {g.slug for g in galleries}
+            if missing:
+                raise CommandError(f"galleries not found: {', '.join(sorted(missing))}")
+
+        for gallery in galleries:
+            try:
+                images = FSImagesProvider(gallery).get_images("all")
+                result = update_hashes(gallery, images)
+            except OSError as e:
+                self.stderr.write(f"{gallery.slug}: {e}")
+                continue
+            self.stdout.write(
+                f"{gallery.slug}: {result.hashed} hashed, "
+                f"{result.renamed} renamed, {result.deleted} deleted"
+            )
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.models import Gallery
+from image_picker.services import FSImagesProvider
+from image_picker.trash import get_max_age, get_max_bytes
+
+
+class Command(BaseCommand):
+    help = "Removes trashed images older than the max age or above the size quota of their gallery"
+
+    def add_arguments(self, parser):
+        parser.add_argument("galleries", nargs="*", metavar="slug",
+                            help="galleries to purge, all by default")
+        parser.add_argument("--max-age-days", type=float,
+                            help="overrides IMAGE_PICKER_TRASH_MAX_AGE_DAYS, 0 empties the trash")
+        parser.add_argument("--max-bytes", type=int,
+                            help="overrides IMAGE_PICKER_TRASH_MAX_BYTES")
+
+    def handle(self, *args, **options):
+        galleries = Gallery.objects.all()
+        if options["galleries"]:
+            galleries = galleries.filter(pk__in=options["galleries"])
+            missing = set(options["galleries"]) - {g.slug for g in galleries}
+            if missing:
+                raise CommandError(f"galleries not found: {', '.join(sorted(missing))}")
+
+        max_age = get_max_age()
+        if options["max_age_days"] is not None:
+            max_age = options["max_age_days"] * 24 * 60 * 60
+        max_bytes = get_max_bytes() if options["max_bytes"] is None else options["max_bytes"]
+
+        for gallery in galleries:
+            try:
+                result = FSImagesProvider(gallery).trash.purge(max_age, max_bytes)
+            except OSError as e:
+                self.stderr.write(f"{gallery.slug}: {e}")
+                continue
+            self.stdout.write(
+                f"{gallery.slug}: {result.purged} purged, {result.freed} bytes freed, "
+                f"{result.failed} failed"
+            )
@@ -0,0 +1,53 @@
+from argparse import BooleanOptionalAction
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.registration import register_galleries
+from image_picker.registry import gallery_registry
+
+
+class Command(BaseCommand):
+    help = "Registers directories found under roots as galleries with generated slugs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("roots", nargs="+", metavar="root",
+                            help="directories to look for galleries in")
+        parser.add_argument("--depth", type=int, default=1,
+                            help="how deep below roots galleries are, 0 registers roots themselves")
+        parser.add_argument("--recursive", action="store_true",
+                            help="galleries list images of their subdirectories too")
+        parser.add_argument("--min-images", type=int, default=1,
+                            help="directories with fewer images are skipped")
+        parser.add_argument("--warm-index", action=BooleanOptionalAction, default=None,
+                            help="fill the database images index from the pre-scan, "
+                                 "by default when IMAGE_PICKER_USE_IMAGES_INDEX is on")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="only report what would be registered")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["depth"] < 0:
+            raise CommandError("depth can't be negative")
+
+        result = register_galleries(
+            options["roots"], depth=options["depth"], recursive=options["recursive"],
+            min_images=options["min_images"], warm_index=options["warm_index"],
+            dry_run=options["dry_run"], batch_size=options["batch_size"],
+        )
+        if options["verbosity"] > 1:
+            for gallery in result.created:
+                self.stdout.write(f"{gallery.slug}: {gallery.dir_path}")
+            for path, reason in result.skipped.items():
+                self.stderr.write(f"{path}: {reason}")
+        action = "would be registered" if options["dry_run"] else "registered"
+        self.stdout.write(
+            f"{len(result.created)} galleries {action}, {result.images} images indexed, "
+            f"{len(result.skipped)} directories skipped"
+        )
+        if result.created and not options["dry_run"] and not gallery_registry.shared:
+            delay = gallery_registry.propagation_delay()
+            when = "until restarted" if delay is None else f"for up to {delay} seconds"
+            self.stderr.write(self.style.WARNING(
+                f"IMAGE_PICKER_GALLERY_CACHE isn't shared between processes, running workers "
+                f"won't see new galleries {when}"
+            ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image_picker.indexing import sync_gallery
+from image_picker.models import Gallery
+
+
+class Command(BaseCommand):
+    help = "Synchronizes database images index with galleries directories"
+
+    def add_arguments(self, parser):
+        parser.add_argument("galleries", nargs="*", metavar="slug",
+                            help="galleries to sync, all by default")
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        galleries = Gallery.objects.all()
+        if options["galleries"]:
+            galleries = galleries.filter(pk__in=options["galleries"])
+            missing = set(options["galleries"]) - {g.slug for g in galleries}
+            if missing:
+                raise CommandError(f"galleries not found: {', '.join(sorted(missing))}")
+
+        for gallery in galleries:
+            try:
+                result = sync_gallery(gallery, batch_size=options["batch_size"])
+            except OSError as e:
+                self.stderr.write(f"{gallery.slug}: {e}")
+                continue
+            self.stdout.write(
+                f"{gallery.slug}: {result.created} created, "
+                f"{result.updated} updated, {result.deleted} deleted"
+            )
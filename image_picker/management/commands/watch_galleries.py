@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from image_picker.watcher import GalleriesWatcher, create_backend
+
+
+class Command(BaseCommand):
+    help = ("Watches galleries directories applying changes to the database images index, "
+            "use IMAGE_PICKER_WATCHER setting to keep in-process indexes of a server hot")
+
+    def handle(self, *args, **options):
+        if not getattr(settings, "IMAGE_PICKER_USE_IMAGES_INDEX", False):
+            self.stderr.write("IMAGE_PICKER_USE_IMAGES_INDEX is disabled, "
+                              "changes won't be visible to other processes")
+        watcher = GalleriesWatcher(create_backend(), keep_memory_index=False)
+        self.stdout.write("watching galleries, press CTRL-C to stop")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
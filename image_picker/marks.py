@@ -0,0 +1,121 @@
+""" Marks kept in a per-gallery SQLite file instead of renaming images, see Gallery.mark_mode """
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Iterable, Protocol, cast
+
+from django.conf import settings
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_MARKS_DIR: str|Path
+
+
+settings = cast(MySettings, settings)
+
+
+class MarkMode:
+    SUFFIX = 'suffix'
+    SIDECAR = 'sidecar'
+    MODES_LIST = [SUFFIX, SIDECAR]
+    CHOICES = [(SUFFIX, "File name suffix"), (SIDECAR, "Sidecar store")]
+
+
+def get_marks_dir() -> Path:
+    return Path(settings.IMAGE_PICKER_MARKS_DIR)
+
+def get_marks_path(gallery_slug:str) -> Path:
+    # outside of the gallery so writes don't touch its directory mtime
+    return get_marks_dir() / f"{gallery_slug}.sqlite3"
+
+
+class MarkStore:
+    """ Marked image names of one gallery
+
+    Names are held in memory and reloaded when another connection, e.g. of another
+    worker process, commits to the file.
+    """
+
+    def __init__(self, path:Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection: sqlite3.Connection|None = None
+        self._names: frozenset[str]|None = None
+        self._data_version: int|None = None
+        # bumped on local writes, which data_version doesn't count
+        self._generation = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS marks (name TEXT PRIMARY KEY) WITHOUT ROWID")
+            self._connection = connection
+        return self._connection
+
+    def _refresh(self) -> frozenset[str]:
+        connection = self._connect()
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if self._names is None or data_version != self._data_version:
+            self._names = frozenset(name for name, in connection.execute("SELECT name FROM marks"))
+            self._data_version = data_version
+        return self._names
+
+    def names(self) -> frozenset[str]:
+        with self._lock:
+            return self._refresh()
+
+    def snapshot(self) -> tuple[tuple[int|None, int], frozenset[str]]:
+        """ Names with a version that changes whenever marks change in any process """
+        with self._lock:
+            names = self._refresh()
+            return (self._data_version, self._generation), names
+
+    def is_marked(self, name:str) -> bool:
+        return name in self.names()
+
+    def set(self, names:Iterable[str], marked:bool=True) -> None:
+        names = list(names)
+        if not names:
+            return
+        with self._lock:
+            current = self._refresh()
+            connection = self._connect()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                if marked:
+                    connection.executemany("INSERT OR IGNORE INTO marks (name) VALUES (?)",
+                                           ((name,) for name in names))
+                else:
+                    connection.executemany("DELETE FROM marks WHERE name = ?",
+                                           ((name,) for name in names))
+            self._names = current.union(names) if marked else current.difference(names)
+            self._generation += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            connection = self._connect()
+            connection.execute("DELETE FROM marks")
+            self._names = frozenset()
+            self._generation += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+                self._names = None
+
+
+_stores: dict[Path, MarkStore] = {}
+_stores_lock = threading.Lock()
+
+def get_mark_store(gallery_slug:str) -> MarkStore:
+    path = get_marks_path(gallery_slug)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = MarkStore(path)
+        return store
@@ -0,0 +1,297 @@
+""" Dimensions, format and capture time of gallery images read from file headers """
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Protocol, cast
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .imaging import read_metadata_many
+from .indexing import match_renames, plan_derived_rows
+from .models import Gallery, ImageMetadata
+from .services import (DerivedData, FSImagesProvider, GalleryIndex, ImageInfo, ImagesPage, ShowMode,
+                       ShowModeA, SortKey, SortKeyA, SortOrder, SortOrderA, SortedView, SORT_KEY_FUNCS,
+                       decode_cursor, encode_cursor, matches_show_mode)
+from .workers import get_process_pool
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_METADATA_PREFETCH: bool
+
+settings = cast(MySettings, settings)
+
+logger = logging.getLogger(__name__)
+
+METADATA_CHUNK_SIZE = 256
+
+
+class Orientation:
+    LANDSCAPE = 'landscape'
+    PORTRAIT = 'portrait'
+    SQUARE = 'square'
+    ORIENTATIONS_LIST = [LANDSCAPE, PORTRAIT, SQUARE]
+
+class MetadataSortKey:
+    TAKEN_AT = 'taken_at'
+    WIDTH = 'width'
+    HEIGHT = 'height'
+    PIXELS = 'pixels'
+    KEYS_LIST = [TAKEN_AT, WIDTH, HEIGHT, PIXELS]
+
+
+class ImageMeta(NamedTuple):
+    width: int|None
+    height: int|None
+    format: str
+    # milliseconds
+    taken_at: float|None
+
+    @property
+    def orientation(self) -> str|None:
+        if self.width is None or self.height is None:
+            return None
+        if self.width == self.height:
+            return Orientation.SQUARE
+        return Orientation.LANDSCAPE if self.width > self.height else Orientation.PORTRAIT
+
+UNKNOWN_META = ImageMeta(None, None, "", None)
+
+
+class MetadataFilter(NamedTuple):
+    orientation: str|None = None
+    min_width: int|None = None
+    min_height: int|None = None
+    format: str|None = None
+
+    @property
+    def active(self) -> bool:
+        return any(value is not None for value in self)
+
+    def matches(self, meta:ImageMeta) -> bool:
+        if self.orientation is not None and meta.orientation != self.orientation:
+            return False
+        if self.min_width is not None and (meta.width or 0) < self.min_width:
+            return False
+        if self.min_height is not None and (meta.height or 0) < self.min_height:
+            return False
+        if self.format is not None and meta.format.upper() != self.format.upper():
+            return False
+        return True
+
+
+class MetadataResult(NamedTuple):
+    read: int
+    renamed: int
+    deleted: int
+
+
+def update_metadata(gallery:Gallery, images:list[ImageInfo]) -> MetadataResult:
+    """ Reads headers of images new or modified since their stored metadata and drops gone ones """
+    stored = {
+        name: (pk, mod_time)
+        for pk, name, mod_time in ImageMetadata.objects.filter(gallery=gallery)
+            .values_list("pk", "name", "mod_time").iterator()
+    }
+    to_read, renamed, to_delete = plan_derived_rows(stored, images)
+
+    dirpath = Path(gallery.dir_path).resolve()
+    chunks = [to_read[i:i+METADATA_CHUNK_SIZE] for i in range(0, len(to_read), METADATA_CHUNK_SIZE)]
+    results = get_process_pool().map(
+        read_metadata_many, [[str(dirpath / image.name) for image, _ in chunk] for chunk in chunks]
+    )
+
+    rows = [
+        ImageMetadata(pk=pk, gallery=gallery, name=image.name, mod_time=image.mod_time,
+                      **dict(zip(ImageMeta._fields, value or UNKNOWN_META)))
+        for chunk, values in zip(chunks, results)
+        for (image, pk), value in zip(chunk, values)
+    ]
+    with transaction.atomic():
+        # rows another process, e.g. extract_metadata, stored meanwhile are kept, metadata is
+        # read back from the database afterwards anyway
+        ImageMetadata.objects.bulk_create([row for row in rows if row.pk is None], batch_size=1000,
+                                          ignore_conflicts=True)
+        ImageMetadata.objects.bulk_update([row for row in rows if row.pk is not None],
+                                          ["mod_time", *ImageMeta._fields], batch_size=1000)
+        if renamed:
+            new_names = [name for _, name in renamed]
+            for i in range(0, len(new_names), 1000):
+                ImageMetadata.objects.filter(gallery=gallery, name__in=new_names[i:i+1000]).exclude(
+                    pk__in=[pk for pk, _ in renamed[i:i+1000]]
+                ).delete()
+            ImageMetadata.objects.bulk_update([ImageMetadata(pk=pk, name=name) for pk, name in renamed],
+                                              ["name"], batch_size=1000)
+        for i in range(0, len(to_delete), 1000):
+            ImageMetadata.objects.filter(pk__in=to_delete[i:i+1000]).delete()
+    return MetadataResult(len(rows), len(renamed), len(to_delete))
+
+
+class ImagesMetadata(DerivedData):
+    """ Metadata of one scanned listing version of a gallery, attached to the listing """
+    # marking and deleting keep metadata of the remaining images valid
+    carried_over = True
+
+    def __init__(self, images:list[ImageInfo], meta:dict[str, ImageMeta], mod_times:dict[str, float]) -> None:
+        # listing images the metadata is for, a listing it is carried over to has others
+        self.images = images
+        self.meta = meta
+        self.mod_times = mod_times
+
+    def __len__(self) -> int:
+        return len(self.mod_times)
+
+    def rebased(self, images:list[ImageInfo]) -> "ImagesMetadata|None":
+        """ Metadata of a listing whose images were only renamed by marking or removed, else None """
+        names = match_renames(self.mod_times, images)
+        if names is None:
+            return None
+        meta = {name: self.meta[old] for name, old in names.items() if old in self.meta}
+        return ImagesMetadata(images, meta, {image.name: image.mod_time for image in images})
+
+
+class MetadataIndex(DerivedData):
+    """ Metadata of a listing with sorted views over it, attached to the listing """
+
+    def __init__(self, listing:GalleryIndex, meta:dict[str, ImageMeta]) -> None:
+        self.listing = listing
+        self.meta = meta
+        self._views: dict[tuple[str, str], SortedView] = {}
+
+    def __len__(self) -> int:
+        return sum(len(view.images) for view in list(self._views.values()))
+
+    def get(self, name:str) -> ImageMeta:
+        return self.meta.get(name, UNKNOWN_META)
+
+    def key_func(self, sort:str) -> Callable[[ImageInfo], tuple[Any, ...]]:
+        if sort in SORT_KEY_FUNCS:
+            return SORT_KEY_FUNCS[sort]
+        get = self.get
+        if sort == MetadataSortKey.TAKEN_AT:
+            # images without EXIF date fall back to modification time
+            return lambda image: (get(image.name).taken_at or image.mod_time, image.name)
+        if sort == MetadataSortKey.WIDTH:
+            return lambda image: (get(image.name).width or 0, image.name)
+        if sort == MetadataSortKey.HEIGHT:
+            return lambda image: (get(image.name).height or 0, image.name)
+        if sort == MetadataSortKey.PIXELS:
+            def pixels(image:ImageInfo) -> tuple[Any, ...]:
+                meta = get(image.name)
+                return ((meta.width or 0) * (meta.height or 0), image.name)
+            return pixels
+        raise ValueError(f"unknown sort key {sort}")
+
+    def filter(self, show_mode:ShowModeA=ShowMode.UNMARKED,
+               filters:MetadataFilter=MetadataFilter()) -> list[ImageInfo]:
+        return [
+            image for image in self.listing.images
+            if matches_show_mode(image, show_mode) and filters.matches(self.get(image.name))
+        ]
+
+    def sorted_view(self, sort:str, show_mode:ShowModeA=ShowMode.UNMARKED,
+                    filters:MetadataFilter=MetadataFilter()) -> SortedView:
+        if sort in SORT_KEY_FUNCS:
+            view = self.listing.sorted_view(cast(SortKeyA, sort), show_mode)
+        elif (sort, show_mode) in self._views:
+            view = self._views[(sort, show_mode)]
+        else:
+            built = SortedView(self.listing.filter(show_mode), self.key_func(sort))
+            view = self._views.setdefault((sort, show_mode), built)
+            if view is built:
+                self.listing.charge(len(view.images))
+        if not filters.active:
+            return view
+        # filtering keeps the order so filtered views are never sorted again
+        return view.filtered(lambda image: filters.matches(self.get(image.name)))
+
+    def page(self, show_mode:ShowModeA=ShowMode.UNMARKED, sort:str=SortKey.MOD_TIME,
+             order:SortOrderA=SortOrder.ASC, cursor:str|None=None, limit:int=100,
+             filters:MetadataFilter=MetadataFilter()) -> ImagesPage:
+        after = self.key_func(sort)(decode_cursor(cursor)) if cursor else None
+        images, has_more = self.sorted_view(sort, show_mode, filters).page(
+            after, order == SortOrder.DESC, limit
+        )
+        return {
+            "results": images,
+            "next": encode_cursor(images[-1]) if has_more else None
+        }
+
+
+_gallery_locks_lock = threading.Lock()
+# one reader per gallery, concurrent requests wait for it instead of reading the same headers
+_gallery_locks: dict[str, threading.Lock] = {}
+
+def _current_metadata(scanned:GalleryIndex) -> ImagesMetadata|None:
+    metadata = scanned.derived.get("metadata")
+    # listings are replaced, not modified, when the gallery changes
+    return metadata if metadata is not None and metadata.images is scanned.images else None
+
+def get_metadata_index(gallery:Gallery) -> MetadataIndex:
+    """ Metadata of the current listing, reading only headers of images changed since stored
+
+    Metadata is kept with the cached scanned listing and carried over to the next one,
+    which reads the database again only if images were added or modified.
+    """
+    provider = FSImagesProvider(gallery)
+    index = provider.get_index().derived.get("metadata_index")
+    if index is not None:
+        return index
+
+    with _gallery_locks_lock:
+        lock = _gallery_locks.setdefault(gallery.slug, threading.Lock())
+    with lock:
+        scanned = provider.get_scanned_index()
+        listing = provider.get_index(scanned)
+        index = listing.derived.get("metadata_index")
+        if index is not None:
+            return index
+
+        metadata = _current_metadata(scanned)
+        if metadata is None:
+            carried = scanned.derived.get("metadata")
+            metadata = carried.rebased(scanned.images) if carried is not None else None
+        if metadata is None:
+            update_metadata(gallery, scanned.images)
+            names = {image.name for image in scanned.images}
+            meta = {
+                name: ImageMeta(*values)
+                for name, *values in ImageMetadata.objects.filter(gallery=gallery)
+                    .values_list("name", *ImageMeta._fields).iterator()
+                if name in names
+            }
+            metadata = ImagesMetadata(scanned.images, meta,
+                                      {image.name: image.mod_time for image in scanned.images})
+        scanned.attach("metadata", metadata)
+        # views are per listing, in sidecar mode the one joined with marks
+        index = MetadataIndex(listing, metadata.meta)
+        listing.attach("metadata_index", index)
+        return index
+
+
+_prefetching: set[str] = set()
+
+def _prefetch(gallery:Gallery) -> None:
+    try:
+        get_metadata_index(gallery)
+    except Exception:
+        logger.exception("metadata prefetch of gallery %s failed", gallery.slug)
+    finally:
+        with _gallery_locks_lock:
+            _prefetching.discard(gallery.slug)
+        # connections are per thread and this one ends here
+        connections.close_all()
+
+def prefetch_metadata(gallery:Gallery) -> bool:
+    """ Fills metadata of the whole gallery in a background thread if enabled and outdated """
+    if not getattr(settings, "IMAGE_PICKER_METADATA_PREFETCH", False):
+        return False
+    if "metadata_index" in FSImagesProvider(gallery).get_index().derived:
+        return False
+    with _gallery_locks_lock:
+        if gallery.slug in _prefetching:
+            return False
+        _prefetching.add(gallery.slug)
+    threading.Thread(target=_prefetch, args=(gallery,), daemon=True,
+                     name=f"metadata-{gallery.slug}").start()
+    return True
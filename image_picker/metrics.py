@@ -0,0 +1,191 @@
+""" Per-request phase timings and process-wide histograms in Prometheus text format """
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import hmac
+from typing import Any, Callable, Iterator, Protocol, cast
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_METRICS: bool
+    IMAGE_PICKER_METRICS_TOKEN: str|None
+    IMAGE_PICKER_METRICS_ALLOWED_IPS: list[str]
+
+
+settings = cast(MySettings, settings)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def metrics_enabled() -> bool:
+    return getattr(settings, "IMAGE_PICKER_METRICS", False)
+
+def metrics_allowed(request:HttpRequest) -> bool:
+    """ Whether the request may scrape /metrics: staff users, the bearer token or allowed addresses """
+    user = getattr(request, "user", None)
+    if user is not None and user.is_staff:
+        return True
+    token = getattr(settings, "IMAGE_PICKER_METRICS_TOKEN", None)
+    if token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return True
+    return request.META.get("REMOTE_ADDR") in getattr(settings, "IMAGE_PICKER_METRICS_ALLOWED_IPS",
+                                                      ["127.0.0.1", "::1"])
+
+def format_labels(labels:tuple[tuple[str, str], ...], extra:str="") -> str:
+    parts = [f'{name}="{value}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    def __init__(self, name:str, help:str, buckets:tuple[float, ...]=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # labels -> (per bucket counts with +Inf last, sum)
+        self._series: dict[tuple[tuple[str, str], ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value:float, **labels:str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1][0] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = [(key, list(counts), total[0]) for key, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{format_labels(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+            yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+
+
+class Counter:
+    def __init__(self, name:str, help:str) -> None:
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+
+    def inc(self, value:float=1, **labels:str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{format_labels(labels)} {value}"
+
+
+request_duration = Histogram("image_picker_request_duration_seconds", "Request duration by view")
+phase_duration = Histogram("image_picker_phase_duration_seconds", "Time spent in request phases")
+files_scanned = Counter("image_picker_files_scanned_total", "Directory entries listed as images")
+bytes_served = Counter("image_picker_bytes_served_total", "Image and thumbnail bytes sent")
+
+METRICS = (request_duration, phase_duration, files_scanned, bytes_served)
+
+def render_metrics() -> str:
+    return "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+
+
+class RequestTimings:
+    __slots__ = ("phases", "counts")
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+        self.counts: dict[str, float] = {}
+
+    def server_timing(self, total:float) -> str:
+        entries = [f"{phase};dur={duration * 1000:.3f}" for phase, duration in self.phases.items()]
+        entries += [f'{name};desc="{value:g}"' for name, value in self.counts.items()]
+        entries.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(entries)
+
+
+_request_timings: ContextVar[RequestTimings|None] = ContextVar("image_picker_timings", default=None)
+
+@contextmanager
+def timed(phase:str) -> Iterator[None]:
+    """ Records duration of the block for the current request and the phase histogram """
+    if not metrics_enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        phase_duration.observe(duration, phase=phase)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.phases[phase] = timings.phases.get(phase, 0.0) + duration
+
+def count(counter:Counter, name:str, value:float) -> None:
+    if not metrics_enabled():
+        return
+    counter.inc(value)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.counts[name] = timings.counts.get(name, 0) + value
+
+
+def _finish(request:HttpRequest, response:HttpResponse, timings:RequestTimings, start:float) -> None:
+    total = time.perf_counter() - start
+    match = request.resolver_match
+    request_duration.observe(total, view=(match.url_name or match.view_name) if match else "unresolved")
+    response["Server-Timing"] = timings.server_timing(total)
+
+
+@sync_and_async_middleware
+def server_timing_middleware(get_response:Callable[[HttpRequest], Any]) -> Callable[[HttpRequest], Any]:
+    """ Adds Server-Timing header with phases recorded by timed() """
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def async_middleware(request:HttpRequest) -> HttpResponse:
+            if not metrics_enabled():
+                return await get_response(request)
+            timings = RequestTimings()
+            token = _request_timings.set(timings)
+            start = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                _request_timings.reset(token)
+            _finish(request, response, timings, start)
+            return response
+        return async_middleware
+
+    def middleware(request:HttpRequest) -> HttpResponse:
+        if not metrics_enabled():
+            return get_response(request)
+        timings = RequestTimings()
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            response = get_response(request)
+        finally:
+            _request_timings.reset(token)
+        _finish(request, response, timings, start)
+        return response
+    return middleware
@@ -0,0 +1,37 @@
+# Generated by Django 3.1 on 2026-10-17 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0003_auto_20200822_1613'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Image',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('marked', models.BooleanField(default=False)),
+                ('mod_time', models.FloatField()),
+                ('size', models.BigIntegerField()),
+                ('gallery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='image_picker.gallery')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['gallery', 'marked', 'mod_time'], name='image_gallery_marked_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='image',
+            index=models.Index(fields=['gallery', 'mod_time'], name='image_gallery_mod_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='image',
+            constraint=models.UniqueConstraint(fields=('gallery', 'name'), name='unique_gallery_image_name'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.1 on 2026-10-17 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0004_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='recursive',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='name',
+            field=models.CharField(max_length=1024),
+        ),
+    ]
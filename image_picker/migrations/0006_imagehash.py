@@ -0,0 +1,28 @@
+# Generated by Django 3.1 on 2026-10-17 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0005_gallery_recursive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageHash',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1024)),
+                ('mod_time', models.FloatField()),
+                ('dhash', models.BigIntegerField(null=True)),
+                ('gallery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='hashes', to='image_picker.gallery')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='imagehash',
+            constraint=models.UniqueConstraint(fields=('gallery', 'name'), name='unique_gallery_hash_name'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1 on 2026-10-17 10:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0006_imagehash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageMetadata',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1024)),
+                ('mod_time', models.FloatField()),
+                ('width', models.PositiveIntegerField(null=True)),
+                ('height', models.PositiveIntegerField(null=True)),
+                ('format', models.CharField(blank=True, max_length=16)),
+                ('taken_at', models.FloatField(null=True)),
+                ('gallery', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='metadata', to='image_picker.gallery')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='imagemetadata',
+            constraint=models.UniqueConstraint(fields=('gallery', 'name'), name='unique_gallery_metadata_name'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.1 on 2026-10-17 10:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('image_picker', '0007_imagemetadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserPickerSettings',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='picker_settings', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('selected_gallery', models.CharField(blank=True, max_length=128)),
+                ('show_mode', models.CharField(max_length=20)),
+            ],
+            options={
+                'verbose_name_plural': 'User picker settings',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-17 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0008_userpickersettings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='mark_mode',
+            field=models.CharField(choices=[('suffix', 'File name suffix'), ('sidecar', 'Sidecar store')], default='suffix', max_length=16),
+        ),
+    ]
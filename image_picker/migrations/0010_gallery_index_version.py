@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-17 10:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image_picker', '0009_gallery_mark_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gallery',
+            name='index_version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
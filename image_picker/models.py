@@ -1,4 +1,6 @@
+from django.conf import settings
 from django.db import models
+from .marks import MarkMode
 from .validators import validate_path_exists, validate_is_dir
 
 
@@ -7,9 +9,99 @@ class Gallery(models.Model):
     slug = models.SlugField(max_length=128, db_index=True, primary_key=True)
     dir_path = models.CharField(max_length=255, unique=True,
     validators=(validate_path_exists, validate_is_dir))
+    # images of subdirectories are listed with paths relative to dir_path
+    recursive = models.BooleanField(default=False)
+    # switched with convert_marks command which moves existing marks
+    mark_mode = models.CharField(max_length=16, choices=MarkMode.CHOICES, default=MarkMode.SUFFIX)
+    # bumped with every change of the gallery Image rows so other processes can tell
+    # their cached listing is stale, see bump_index_version
+    index_version = models.PositiveBigIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name_plural = "Galleries"
 
     def __str__(self):
         return self.dir_path
+
+
+def bump_index_version(gallery_id:str) -> None:
+    """ Has to run in the transaction changing Image rows of the gallery """
+    Gallery.objects.filter(pk=gallery_id).update(index_version=models.F("index_version") + 1)
+
+
+class Image(models.Model):
+    """ Database index of gallery images kept in sync by sync_galleries command """
+    gallery = models.ForeignKey(Gallery, on_delete=models.CASCADE, related_name="images")
+    # relative path in recursive galleries
+    name = models.CharField(max_length=1024)
+    marked = models.BooleanField(default=False)
+    # milliseconds as in images api
+    mod_time = models.FloatField()
+    size = models.BigIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["gallery", "name"], name="unique_gallery_image_name"),
+        ]
+        indexes = [
+            models.Index(fields=["gallery", "marked", "mod_time"], name="image_gallery_marked_idx"),
+            models.Index(fields=["gallery", "mod_time"], name="image_gallery_mod_time_idx"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class ImageHash(models.Model):
+    """ Perceptual hash of an image version, recomputed when mod_time changes """
+    gallery = models.ForeignKey(Gallery, on_delete=models.CASCADE, related_name="hashes")
+    name = models.CharField(max_length=1024)
+    mod_time = models.FloatField()
+    # 64 bit dhash stored as signed to fit BigIntegerField
+    dhash = models.BigIntegerField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["gallery", "name"], name="unique_gallery_hash_name"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class ImageMetadata(models.Model):
+    """ Header data of an image version, read again when mod_time changes """
+    gallery = models.ForeignKey(Gallery, on_delete=models.CASCADE, related_name="metadata")
+    name = models.CharField(max_length=1024)
+    mod_time = models.FloatField()
+    # size as displayed after EXIF orientation, null when the file isn't a readable image
+    width = models.PositiveIntegerField(null=True)
+    height = models.PositiveIntegerField(null=True)
+    format = models.CharField(max_length=16, blank=True)
+    # EXIF capture time in milliseconds, camera local time read as UTC
+    taken_at = models.FloatField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["gallery", "name"], name="unique_gallery_metadata_name"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class UserPickerSettings(models.Model):
+    """ Picker settings of a signed in user for the user settings store """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name="picker_settings")
+    selected_gallery = models.CharField(max_length=128, blank=True)
+    show_mode = models.CharField(max_length=20)
+
+    class Meta:
+        verbose_name_plural = "User picker settings"
+
+    def to_dict(self) -> dict[str, str]:
+        return {"selected_gallery": self.selected_gallery, "show_mode": self.show_mode}
+
+    def __str__(self):
+        return str(self.user)
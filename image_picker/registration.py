@@ -0,0 +1,138 @@
+""" Galleries registered in bulk from directories found under given roots """
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, NamedTuple, Protocol, cast
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils.text import slugify
+
+from .models import Gallery, Image
+from .registry import gallery_registry
+from .services import iter_image_stats, walk_image_stats
+from .validators import validate_path_exists, validate_is_dir
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_USE_IMAGES_INDEX: bool
+    IMAGE_PICKER_WALK_WORKERS: int
+
+
+settings = cast(MySettings, settings)
+
+SLUG_MAX_LENGTH = Gallery._meta.get_field("slug").max_length or 128
+DIR_PATH_MAX_LENGTH = Gallery._meta.get_field("dir_path").max_length or 255
+
+
+class PreScan(NamedTuple):
+    path: Path
+    images: list[tuple[str, bool, os.stat_result]]
+    # validation or listing failure, images are empty then
+    error: str|None
+
+
+class RegistrationResult(NamedTuple):
+    created: list[Gallery]
+    images: int
+    # directory with the reason it wasn't registered
+    skipped: dict[str, str]
+
+
+def discover_directories(roots:Iterable[str|Path], depth:int=1) -> list[Path]:
+    """ Non hidden directories depth levels below roots, symlinked ones aren't followed """
+    level = sorted({Path(root).resolve() for root in roots})
+    for _ in range(depth):
+        found: list[Path] = []
+        for dirpath in level:
+            try:
+                entries = os.scandir(dirpath)
+            except OSError:
+                continue
+            with entries:
+                found.extend(Path(entry.path) for entry in entries
+                             if entry.name[0] != "." and entry.is_dir(follow_symlinks=False))
+        level = sorted(found)
+    return level
+
+
+def unique_slug(name:str, taken:set[str]) -> str:
+    base = slugify(name)[:SLUG_MAX_LENGTH - 8].strip("-") or "gallery"
+    slug, n = base, 1
+    while slug in taken:
+        n += 1
+        slug = f"{base}-{n}"
+    taken.add(slug)
+    return slug
+
+
+def prescan(path:Path, recursive:bool=False) -> PreScan:
+    """ Runs the model validators of dir_path and lists images of the directory """
+    try:
+        validate_path_exists(path)
+        validate_is_dir(path)
+        stats = walk_image_stats(path) if recursive else iter_image_stats(path)
+        return PreScan(path, list(stats), None)
+    except ValidationError as e:
+        return PreScan(path, [], "; ".join(e.messages))
+    except OSError as e:
+        return PreScan(path, [], e.strerror or str(e))
+
+
+def register_galleries(roots:Iterable[str|Path], depth:int=1, recursive:bool=False,
+                       min_images:int=1, warm_index:bool|None=None, dry_run:bool=False,
+                       batch_size:int=1000) -> RegistrationResult:
+    """ Creates galleries for new directories under roots in one transaction
+
+    Directories are validated and listed in parallel, the listing fills the database
+    images index right away when warm_index is on, by default when the index is used.
+    """
+    if warm_index is None:
+        warm_index = getattr(settings, "IMAGE_PICKER_USE_IMAGES_INDEX", False)
+
+    registered = set(Gallery.objects.values_list("dir_path", flat=True))
+    registered.update(str(Path(dir_path).resolve()) for dir_path in list(registered))
+    taken = set(Gallery.objects.values_list("slug", flat=True))
+
+    skipped: dict[str, str] = {}
+    paths: list[Path] = []
+    for path in discover_directories(roots, depth):
+        if str(path) in registered:
+            skipped[str(path)] = "already registered"
+        elif len(str(path)) > DIR_PATH_MAX_LENGTH:
+            skipped[str(path)] = "path too long"
+        else:
+            paths.append(path)
+
+    workers = getattr(settings, "IMAGE_PICKER_WALK_WORKERS", 8)
+    # listings mostly wait on the filesystem
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        scans = list(executor.map(lambda path: prescan(path, recursive), paths))
+
+    galleries: list[Gallery] = []
+    images: list[Image] = []
+    for scan in scans:
+        if scan.error is not None:
+            skipped[str(scan.path)] = scan.error
+            continue
+        if len(scan.images) < min_images:
+            skipped[str(scan.path)] = f"{len(scan.images)} images"
+            continue
+        gallery = Gallery(title=scan.path.name[:128], slug=unique_slug(scan.path.name, taken),
+                          dir_path=str(scan.path), recursive=recursive)
+        galleries.append(gallery)
+        if warm_index:
+            images.extend(Image(gallery=gallery, name=name, marked=marked,
+                                mod_time=st.st_mtime * 1000, size=st.st_size)
+                          for name, marked, st in scan.images)
+
+    if dry_run or not galleries:
+        return RegistrationResult(galleries, len(images), skipped)
+
+    # bulk_create sends no post_save, so the registry is told once after commit
+    with transaction.atomic():
+        Gallery.objects.bulk_create(galleries, batch_size=batch_size)
+        Image.objects.bulk_create(images, batch_size=batch_size)
+    gallery_registry.invalidate()
+    return RegistrationResult(galleries, len(images), skipped)
@@ -0,0 +1,147 @@
+import threading
+import time
+import uuid
+from typing import Any, Protocol, cast
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import Http404
+
+from .metrics import timed
+from .models import Gallery
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_GALLERY_CACHE: str|None
+    IMAGE_PICKER_GALLERY_REGISTRY_TTL: float|None
+
+settings = cast(MySettings, settings)
+
+VERSION_KEY = "image_picker:galleries:version"
+GALLERIES_KEY = "image_picker:galleries:{version}"
+
+
+class GalleryRegistry:
+    """ Galleries kept in process memory and reloaded after any Gallery change.
+
+    With a shared cache alias other processes learn about changes through a version
+    key and take the galleries from the cache instead of the database. Without it they
+    only reload galleries once IMAGE_PICKER_GALLERY_REGISTRY_TTL passes.
+    """
+
+    def __init__(self, cache_alias:str|None=None) -> None:
+        self._cache_alias = cache_alias
+        self._lock = threading.Lock()
+        self._galleries: dict[str, Gallery]|None = None
+        self._version: str|None = None
+        self._loaded_at = 0.0
+        # bumped on local invalidation so a load racing with it isn't stored
+        self._generation = 0
+
+    @property
+    def shared_cache(self) -> BaseCache|None:
+        alias = self._cache_alias or getattr(settings, "IMAGE_PICKER_GALLERY_CACHE", None)
+        return caches[alias] if alias else None
+
+    @property
+    def shared(self) -> bool:
+        """ Whether changes made by one process are seen by the others right away """
+        cache = self.shared_cache
+        return cache is not None and not isinstance(cache, (LocMemCache, DummyCache))
+
+    @property
+    def ttl(self) -> float|None:
+        return getattr(settings, "IMAGE_PICKER_GALLERY_REGISTRY_TTL", 10)
+
+    def propagation_delay(self) -> float|None:
+        """ Seconds until other processes see a change, None if they never do """
+        return 0 if self.shared else self.ttl
+
+    def _expired(self) -> bool:
+        ttl = self.ttl
+        return ttl is not None and time.monotonic() - self._loaded_at >= ttl
+
+    def _shared_version(self, cache:BaseCache) -> str:
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(VERSION_KEY)
+        return cast(str, version)
+
+    def _load(self, cache:BaseCache|None, version:str|None) -> dict[str, Gallery]:
+        if cache is not None:
+            galleries = cache.get(GALLERIES_KEY.format(version=version))
+            if galleries is not None:
+                return cast(dict[str, Gallery], galleries)
+
+        galleries = {gallery.slug: gallery for gallery in Gallery.objects.all()}
+        if cache is not None:
+            # expires too in case rows were changed bypassing signals, e.g. restored from a dump
+            cache.set(GALLERIES_KEY.format(version=version), galleries, self.ttl)
+        return galleries
+
+    def peek(self) -> dict[str, Gallery]|None:
+        """ Returns loaded galleries if they can be trusted without any I/O """
+        if self.shared_cache is not None or self._expired():
+            return None
+        return self._galleries
+
+    def galleries(self) -> dict[str, Gallery]:
+        cache = self.shared_cache
+        version = self._shared_version(cache) if cache is not None else None
+
+        with self._lock:
+            if (self._galleries is not None and self._version == version and
+                    (cache is not None or not self._expired())):
+                return self._galleries
+            generation = self._generation
+
+        loaded_at = time.monotonic()
+        galleries = self._load(cache, version)
+
+        with self._lock:
+            if generation == self._generation:
+                self._galleries = galleries
+                self._version = version
+                self._loaded_at = loaded_at
+        return galleries
+
+    def all(self) -> list[Gallery]:
+        return list(self.galleries().values())
+
+    def get(self, slug:str) -> Gallery|None:
+        return self.galleries().get(slug)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._galleries = None
+            self._version = None
+            self._generation += 1
+
+        cache = self.shared_cache
+        if cache is not None:
+            cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+
+
+gallery_registry = GalleryRegistry()
+
+
+def get_gallery_or_404(gallery_slug:str) -> Gallery:
+    with timed("gallery"):
+        gallery = gallery_registry.get(gallery_slug)
+    if gallery is None:
+        raise Http404("No Gallery matches the given query.")
+    return gallery
+
+
+@receiver(post_save, sender=Gallery)
+@receiver(post_delete, sender=Gallery)
+def on_gallery_changed(sender:Any, **kwargs:Any) -> None:
+    gallery_registry.invalidate()
+    # a reload racing with the open transaction could still see the old rows
+    transaction.on_commit(gallery_registry.invalidate)
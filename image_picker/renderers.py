@@ -0,0 +1,66 @@
+import json
+from typing import Any, Iterable, Mapping
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from .metrics import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class NDJSONRenderer(BaseRenderer):
+    """ Newline delimited JSON, one object per line """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    @staticmethod
+    def render_lines(items:Iterable[Any]) -> Iterable[bytes]:
+        for item in items:
+            yield json.dumps(item).encode() + b"\n"
+
+    def render(self, data:Any, accepted_media_type:str|None=None,
+               renderer_context:Mapping[str, Any]|None=None) -> bytes:
+        if data is None:
+            return b""
+        items = data if isinstance(data, list) else [data]
+        return b"".join(self.render_lines(items))
+
+
+class FastJSONRenderer(JSONRenderer):
+    """ JSON rendered by orjson when it is installed """
+
+    def render(self, data:Any, accepted_media_type:str|None=None,
+               renderer_context:Mapping[str, Any]|None=None) -> bytes:
+        if data is None:
+            return b""
+        # indented output is left to the stdlib encoder
+        with timed("render"):
+            if orjson is None or self.get_indent(accepted_media_type or "", renderer_context or {}):
+                return super().render(data, accepted_media_type, renderer_context)
+            return orjson.dumps(data, default=self.encoder_class().default)
+
+
+class MsgPackRenderer(BaseRenderer):
+    """ MessagePack, available when msgpack is installed """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data:Any, accepted_media_type:str|None=None,
+               renderer_context:Mapping[str, Any]|None=None) -> bytes:
+        if data is None:
+            return b""
+        return msgpack.packb(data, use_bin_type=True)
+
+
+OPTIONAL_RENDERER_CLASSES: list[type[BaseRenderer]] = [MsgPackRenderer] if msgpack is not None else []
@@ -1,12 +1,15 @@
-from typing import cast, TypedDict
+from typing import Any, Callable, cast, Iterable
+from urllib.parse import quote
+
+from django.urls import reverse
+from django.utils.http import RFC3986_SUBDELIMS
 from rest_framework import serializers
-from rest_framework.request import Request
-from typing_extensions import Unpack
 from .models import Gallery
-from .services import PickerSettings, ShowMode, DEFAULT_SHOW_MODE, PickerSettingsDict
-
-# TYPES
-SaveKwargs = TypedDict("SaveKwargs", {"request": Request})
+from .duplicates import DEFAULT_MAX_DISTANCE, HASH_BITS
+from .metadata import ImageMeta, MetadataFilter, MetadataSortKey, Orientation
+from .registry import gallery_registry
+from .services import (PickerSettings, ShowMode, DEFAULT_SHOW_MODE, PickerSettingsDict,
+                       SortKey, SortOrder, BatchOp, ImageInfo)
 
 class GallerySerializer(serializers.ModelSerializer[Gallery]):
     
@@ -16,15 +19,129 @@ class GallerySerializer(serializers.ModelSerializer[Gallery]):
     
     #Meta = cast(type[serializers.ModelSerializer[Gallery].Meta], _Meta)
 
+class ImageUrls:
+    """ Image urls of a gallery from a prefix reversed once instead of per image """
+    __slots__ = ("prefix",)
+
+    def __init__(self, view_name:str, gallery_slug:str) -> None:
+        url = reverse(view_name, kwargs={"gallery_slug": gallery_slug, "image_url": "_"})
+        self.prefix = url[:-1]
+
+    def __call__(self, name:str) -> str:
+        # quoted like reverse() quotes path arguments
+        return self.prefix + quote(name, safe=RFC3986_SUBDELIMS + "/~:@")
+
+
+class ImagesLayout:
+    ROWS = 'rows'
+    COLUMNS = 'columns'
+    LAYOUTS_LIST = [ROWS, COLUMNS]
+
+
+def image_data(image:ImageInfo, urls:ImageUrls) -> dict[str, Any]:
+    return {"name": image.name, "marked": image.marked, "mod_time": image.mod_time,
+            "url": urls(image.name)}
+
+def images_rows(images:Iterable[ImageInfo], urls:ImageUrls) -> list[dict[str, Any]]:
+    return [image_data(image, urls) for image in images]
+
+def images_columns(images:list[ImageInfo], urls:ImageUrls) -> dict[str, Any]:
+    """ Parallel arrays, an image url is url_prefix followed by the url-encoded name """
+    return {
+        "url_prefix": urls.prefix,
+        "names": [image.name for image in images],
+        "mod_times": [image.mod_time for image in images],
+        "marked": [image.marked for image in images],
+    }
+
+def image_metadata_data(image:ImageInfo, meta:ImageMeta, urls:ImageUrls) -> dict[str, Any]:
+    return {**image_data(image, urls), **meta._asdict()}
+
+def images_metadata_rows(images:Iterable[ImageInfo], get_meta:Callable[[str], ImageMeta],
+                         urls:ImageUrls) -> list[dict[str, Any]]:
+    return [image_metadata_data(image, get_meta(image.name), urls) for image in images]
+
+def images_metadata_columns(images:list[ImageInfo], get_meta:Callable[[str], ImageMeta],
+                            urls:ImageUrls) -> dict[str, Any]:
+    metas = [get_meta(image.name) for image in images]
+    return {
+        **images_columns(images, urls),
+        "widths": [meta.width for meta in metas],
+        "heights": [meta.height for meta in metas],
+        "formats": [meta.format for meta in metas],
+        "taken_ats": [meta.taken_at for meta in metas],
+    }
+
+
+class ImagesPageQuerySerializer(serializers.Serializer):
+    show_mode = serializers.ChoiceField(choices=ShowMode.MODES_LIST, default=DEFAULT_SHOW_MODE)
+    sort = serializers.ChoiceField(choices=SortKey.KEYS_LIST, default=SortKey.MOD_TIME)
+    order = serializers.ChoiceField(choices=SortOrder.ORDERS_LIST, default=SortOrder.ASC)
+    cursor = serializers.CharField(required=False)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+class ImagesMetadataQuerySerializer(ImagesPageQuerySerializer):
+    sort = serializers.ChoiceField(choices=SortKey.KEYS_LIST + MetadataSortKey.KEYS_LIST,
+                                   default=SortKey.MOD_TIME)
+    orientation = serializers.ChoiceField(choices=Orientation.ORIENTATIONS_LIST, required=False)
+    min_width = serializers.IntegerField(min_value=1, required=False)
+    min_height = serializers.IntegerField(min_value=1, required=False)
+    # format query parameter is taken by api format override
+    image_format = serializers.CharField(max_length=16, required=False)
+
+    def get_filter(self) -> MetadataFilter:
+        data = self.validated_data
+        return MetadataFilter(data.get("orientation"), data.get("min_width"),
+                              data.get("min_height"), data.get("image_format"))
+
+class FeedQuerySerializer(ImagesPageQuerySerializer):
+    # comma separated slugs, all galleries by default
+    galleries = serializers.CharField(required=False)
+
+    def validate_galleries(self, value:str) -> list[Gallery]:
+        slugs = [slug for slug in value.split(",") if slug]
+        galleries = gallery_registry.galleries()
+        missing = [slug for slug in slugs if slug not in galleries]
+        if missing:
+            raise serializers.ValidationError(f"galleries not found: {', '.join(missing)}")
+        return [galleries[slug] for slug in dict.fromkeys(slugs)]
+
+class NeighborsQuerySerializer(serializers.Serializer):
+    show_mode = serializers.ChoiceField(choices=ShowMode.MODES_LIST, default=DEFAULT_SHOW_MODE)
+    sort = serializers.ChoiceField(choices=SortKey.KEYS_LIST, default=SortKey.MOD_TIME)
+    order = serializers.ChoiceField(choices=SortOrder.ORDERS_LIST, default=SortOrder.ASC)
+    count = serializers.IntegerField(min_value=0, max_value=20, default=3)
+
+class DuplicatesQuerySerializer(serializers.Serializer):
+    distance = serializers.IntegerField(min_value=0, max_value=HASH_BITS, default=DEFAULT_MAX_DISTANCE)
+
+class BatchOperationSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    op = serializers.ChoiceField(choices=BatchOp.OPS_LIST)
+
+class BatchSerializer(serializers.Serializer):
+    MAX_OPERATIONS = 10000
+
+    operations = BatchOperationSerializer(many=True, allow_empty=False)
+    parallel = serializers.BooleanField(default=False)
+
+    def validate_operations(self, value:list) -> list:
+        if len(value) > self.MAX_OPERATIONS:
+            raise serializers.ValidationError(
+                f"no more than {self.MAX_OPERATIONS} operations per batch"
+            )
+        return value
+
+class TrashRestoreSerializer(serializers.Serializer):
+    id = serializers.CharField(max_length=1024)
+
 class SettingsSerializer(serializers.Serializer[PickerSettings]):
     selected_gallery = serializers.CharField(max_length=128)
     show_mode = serializers.CharField(max_length=20, default=DEFAULT_SHOW_MODE)
 
     
     def validate_selected_gallery(self, value:str) -> str:
-        try:
-            Gallery.objects.get(pk=value)
-        except Gallery.DoesNotExist:
+        if gallery_registry.get(value) is None:
             raise serializers.ValidationError(f" gallery '{value}' doesn't exist")
         return value
     
@@ -35,13 +152,13 @@ class SettingsSerializer(serializers.Serializer[PickerSettings]):
         return value
     
    
-    def save(self, **kwargs:Unpack[SaveKwargs]) -> PickerSettings:  # type: ignore
+    def save(self, **kwargs:Any) -> PickerSettings:  # type: ignore
+        """ Returns validated settings, views persist them with the settings store """
         data = cast(PickerSettingsDict, self.validated_data)
         
         settings = PickerSettings(
             **data
         )
-
-        settings.to_session(kwargs['request'])
+        self.instance = settings
         return settings
 
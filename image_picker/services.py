@@ -1,14 +1,35 @@
+import base64
+import binascii
+import json
+import os
+import posixpath
 import re
-from glob import iglob
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
-from typing import TypedDict, Protocol, TypeAlias, Literal, cast
+from typing import (Any, Callable, Iterable, Iterator, NamedTuple, TypedDict, Protocol, TypeAlias,
+                    Literal, cast)
 
 from django.http import HttpRequest
 from django.conf import settings
-from .models import Gallery
+from django.db import connections, transaction
+from .marks import MarkMode, MarkStore, get_mark_store
+from .metrics import count, files_scanned, timed
+from .models import Gallery, Image, bump_index_version
+from .registry import gallery_registry
+from .signals import image_renamed, image_deleted
+from .trash import Trash, TrashEntry, trash_enabled
+from .workers import get_walk_pool
 
 class MySettings(Protocol):
     DEBUG: bool
+    IMAGE_PICKER_INDEX_CACHE_MAX_IMAGES: int
+    IMAGE_PICKER_USE_IMAGES_INDEX: bool
+    IMAGE_PICKER_BATCH_WORKERS: int
 
 
 settings = cast(MySettings, settings)
@@ -18,10 +39,21 @@ class ImageDict(TypedDict):
     marked: bool
     mod_time: float
 
+class ImageInfo(NamedTuple):
+    """ Image record of listings and indexes, a tuple to keep large galleries compact """
+    name: str
+    marked: bool
+    # milliseconds
+    mod_time: float
+
+    def to_dict(self) -> ImageDict:
+        return {"name": self.name, "marked": self.marked, "mod_time": self.mod_time}
+
 class GalleryProto(Protocol):
     dir_path: str
     slug: str
     title: str
+    recursive: bool
 
 class ShowMode:
     ALL = 'all'
@@ -31,6 +63,21 @@ class ShowMode:
 
 ShowModeA: TypeAlias = Literal["all", "marked", "unmarked"]
 
+class SortKey:
+    MOD_TIME = 'mod_time'
+    NAME = 'name'
+    NATURAL = 'natural'
+    KEYS_LIST = [MOD_TIME, NAME, NATURAL]
+
+SortKeyA: TypeAlias = Literal["mod_time", "name", "natural"]
+
+class SortOrder:
+    ASC = 'asc'
+    DESC = 'desc'
+    ORDERS_LIST = [ASC, DESC]
+
+SortOrderA: TypeAlias = Literal["asc", "desc"]
+
 def is_file_marked(filename:str|Path) -> bool:
     file = filename if type(filename) == Path else Path(filename)
     return file.stem.endswith("_")    
@@ -38,7 +85,592 @@ def is_file_marked(filename:str|Path) -> bool:
 class ImagesException(Exception):
     pass
 
-# TODO wraps image/images to image info class
+class BatchOp:
+    MARK = 'mark'
+    UNMARK = 'unmark'
+    DELETE = 'delete'
+    OPS_LIST = [MARK, UNMARK, DELETE]
+
+BatchOpA: TypeAlias = Literal["mark", "unmark", "delete"]
+
+class BatchOperationDict(TypedDict):
+    name: str
+    op: BatchOpA
+
+class BatchResultDict(TypedDict):
+    name: str
+    op: BatchOpA
+    status: Literal["ok", "not_found", "error"]
+    image: ImageInfo|None
+    error: str|None
+
+# Directory scanner
+IMAGE_EXTENSIONS = frozenset(("jpg", "png", "jpeg", "gif", "webp"))
+
+def unmarked_name(name:str) -> str:
+    """ Name of an image without the mark suffix, the same for its marked and unmarked names """
+    stem, dot, ext = name.rpartition(".")
+    return stem[:-1] + dot + ext if stem.endswith("_") else name
+
+def parse_image_name(name:str) -> bool|None:
+    """ Returns marked state for an image filename or None if it isn't an image """
+    dot = name.rfind(".")
+    # hidden files and names without extension are skipped like glob('*.*') did
+    if dot <= 0 or name[0] == ".":
+        return None
+    if name[dot+1:].lower() not in IMAGE_EXTENSIONS:
+        return None
+    return name[dot-1] == "_"
+
+def iter_image_stats(dirpath:str|Path) -> Iterator[tuple[str, bool, os.stat_result]]:
+    """ Single pass over the directory yielding name, marked and stat of images """
+    # scandir is opened eagerly so a missing directory fails before streaming starts
+    return _iter_image_entries(os.scandir(dirpath))
+
+def _iter_image_entries(entries:Any) -> Iterator[tuple[str, bool, os.stat_result]]:
+    with entries:
+        for entry in entries:
+            marked = parse_image_name(entry.name)
+            if marked is None:
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                # removed while scanning or a broken symlink
+                continue
+            yield entry.name, marked, st
+
+def iter_images(dirpath:str|Path) -> Iterator[ImageInfo]:
+    """ Yields images in directory order """
+    return (
+        ImageInfo(name, marked, st.st_mtime * 1000)
+        for name, marked, st in iter_image_stats(dirpath)
+    )
+
+def scan_images(dirpath:str|Path) -> list[ImageInfo]:
+    return list(iter_images(dirpath))
+
+# Recursive galleries
+class DirectoryScan(NamedTuple):
+    # relative to the gallery, empty for the gallery directory itself
+    reldir: str
+    # None if the directory vanished
+    mtime_ns: int|None
+    scanned_ns: int
+    images: list[tuple[str, bool, os.stat_result]]
+    subdirs: list[str]
+
+def scan_directory(dirpath:Path, reldir:str) -> DirectoryScan:
+    """ Lists images and subdirectories of one directory of a tree with names relative to dirpath """
+    path = dirpath / reldir if reldir else dirpath
+    prefix = f"{reldir}/" if reldir else ""
+    try:
+        # mtime is taken before listing so changes made during it are seen next time
+        mtime_ns = os.stat(path).st_mtime_ns
+        entries = os.scandir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        if not reldir:
+            raise
+        return DirectoryScan(reldir, None, 0, [], [])
+    scanned_ns = time.time_ns()
+
+    images: list[tuple[str, bool, os.stat_result]] = []
+    subdirs: list[str] = []
+    with entries:
+        for entry in entries:
+            # hidden directories are skipped like hidden files
+            if entry.name[0] == ".":
+                continue
+            try:
+                # symlinked directories aren't followed to avoid cycles and escaping the gallery
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(prefix + entry.name)
+                    continue
+                marked = parse_image_name(entry.name)
+                if marked is None or not entry.is_file():
+                    continue
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            images.append((prefix + entry.name, marked, st))
+    return DirectoryScan(reldir, mtime_ns, scanned_ns, images, subdirs)
+
+def walk_directories(dirpath:Path, reldirs:Iterable[str],
+                     descend:Callable[[str], bool]=lambda reldir: True) -> Iterator[DirectoryScan]:
+    """ Scans directories and subdirectories accepted by descend on the walk pool """
+    pool = get_walk_pool()
+    pending: set[Future[DirectoryScan]] = {pool.submit(scan_directory, dirpath, reldir) for reldir in reldirs}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                scan = future.result()
+                yield scan
+                pending.update(
+                    pool.submit(scan_directory, dirpath, subdir)
+                    for subdir in scan.subdirs if descend(subdir)
+                )
+    finally:
+        for future in pending:
+            future.cancel()
+
+def walk_image_stats(dirpath:str|Path) -> Iterator[tuple[str, bool, os.stat_result]]:
+    """ Like iter_image_stats for a whole tree, names are relative paths """
+    # the gallery directory is listed at once so a missing one fails before streaming starts
+    root = scan_directory(Path(dirpath), "")
+    return _walk_image_stats(Path(dirpath), root)
+
+def _walk_image_stats(dirpath:Path, root:DirectoryScan) -> Iterator[tuple[str, bool, os.stat_result]]:
+    yield from root.images
+    for scan in walk_directories(dirpath, root.subdirs):
+        yield from scan.images
+
+# Sorting and pagination
+_digits_re = re.compile(r"(\d+)")
+
+def natural_key(name:str) -> tuple[str|int, ...]:
+    # re.split puts digit groups at odd positions so tuples compare without type errors
+    parts = _digits_re.split(name.lower())
+    return tuple(int(part) if i % 2 else part for i, part in enumerate(parts))
+
+SORT_KEY_FUNCS: dict[str, Callable[[ImageInfo], tuple[Any, ...]]] = {
+    SortKey.MOD_TIME: lambda image: (image.mod_time, image.name),
+    SortKey.NAME: lambda image: (image.name,),
+    SortKey.NATURAL: lambda image: (natural_key(image.name), image.name),
+}
+
+def matches_show_mode(image:ImageInfo, show_mode:ShowModeA) -> bool:
+    if show_mode == ShowMode.UNMARKED:
+        return not image.marked
+    elif show_mode == ShowMode.MARKED:
+        return image.marked
+    return True
+
+def encode_cursor(image:ImageInfo) -> str:
+    data = json.dumps([image.name, image.mod_time]).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+def decode_cursor(cursor:str) -> ImageInfo:
+    try:
+        name, mod_time = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(name, str) or not isinstance(mod_time, (int, float)):
+            raise ValueError(cursor)
+    except (ValueError, TypeError, binascii.Error):
+        raise ImagesException(f"invalid cursor {cursor}")
+    return ImageInfo(name, False, float(mod_time))
+
+class ImagesPage(TypedDict):
+    results: list[ImageInfo]
+    next: str|None
+
+class SortedView:
+    """ Images of one show mode sorted ascending by one sort key """
+    __slots__ = ("keys", "images")
+
+    def __init__(self, images:list[ImageInfo], key_func:Callable[[ImageInfo], tuple[Any, ...]]) -> None:
+        pairs = sorted(((key_func(image), image) for image in images), key=lambda pair: pair[0])
+        self.keys = [key for key, _ in pairs]
+        self.images = [image for _, image in pairs]
+
+    def filtered(self, predicate:Callable[[ImageInfo], bool]) -> "SortedView":
+        """ Subset in the same order without sorting again """
+        view = SortedView.__new__(SortedView)
+        pairs = [(key, image) for key, image in zip(self.keys, self.images) if predicate(image)]
+        view.keys = [key for key, _ in pairs]
+        view.images = [image for _, image in pairs]
+        return view
+
+    def iter_after(self, after:tuple[Any, ...]|None, reverse:bool,
+                   inclusive:bool=False) -> Iterator[tuple[tuple[Any, ...], ImageInfo]]:
+        """ Lazily yields keys and images following after key in the given direction """
+        if not reverse:
+            if after is None:
+                start = 0
+            else:
+                start = (bisect_left if inclusive else bisect_right)(self.keys, after)
+            for i in range(start, len(self.images)):
+                yield self.keys[i], self.images[i]
+            return
+
+        if after is None:
+            end = len(self.images)
+        else:
+            end = (bisect_right if inclusive else bisect_left)(self.keys, after)
+        for i in range(end - 1, -1, -1):
+            yield self.keys[i], self.images[i]
+
+    def page(self, after:tuple[Any, ...]|None, reverse:bool, limit:int) -> tuple[list[ImageInfo], bool]:
+        """ Returns up to limit images following after key and whether more follow """
+        if not reverse:
+            start = 0 if after is None else bisect_right(self.keys, after)
+            end = start + limit
+            return self.images[start:end], end < len(self.images)
+
+        end = len(self.images) if after is None else bisect_left(self.keys, after)
+        start = max(0, end - limit)
+        return self.images[start:end][::-1], start > 0
+
+
+# Galleries index cache
+# token of cache entries only keeping data carried over to the next listing
+_INVALIDATED = object()
+# directory mtimes closer than this to the scan time may still change without
+# a visible mtime update on filesystems with coarse timestamps
+RACY_MTIME_NS = 1_000_000_000
+
+class GalleryIndex:
+    __slots__ = ("dirpath", "token", "images", "racy", "live", "source", "_views", "derived",
+                 "charged", "on_grow")
+
+    def __init__(self, dirpath:Path, token:Any, images:list[ImageInfo], racy:bool=False,
+                 live:bool=False, source:Any=None) -> None:
+        self.dirpath = dirpath
+        self.token = token
+        self.images = images
+        self.racy = racy
+        # live indexes are kept up to date by the galleries watcher and aren't revalidated
+        self.live = live
+        # what images were loaded from if it is reused for revalidation, e.g. ImagesTree
+        self.source = source
+        # sorted views are built on first use and live as long as the scan
+        self._views: dict[tuple[str, str], SortedView] = {}
+        # data computed from the listing, e.g. joined sidecar marks, sized by len() and
+        # kept and evicted with the index
+        self.derived: dict[str, Any] = {}
+        # set by the cache holding the index, the size counted for it and a callback for growth
+        self.charged = 0
+        self.on_grow: Callable[["GalleryIndex", int], None]|None = None
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    @property
+    def size(self) -> int:
+        """ Images with entries of sorted views, which hold a key and a reference each, and derived data """
+        return (len(self.images) + sum(len(view.images) for view in list(self._views.values()))
+                + sum(len(value) for value in list(self.derived.values())))
+
+    def charge(self, size:int) -> None:
+        """ Counts memory added for the index against the budget of the cache holding it """
+        if self.on_grow is not None:
+            self.on_grow(self, size)
+
+    def attach(self, name:str, value:Any) -> None:
+        old = self.derived.get(name)
+        self.derived[name] = value
+        self.charge(len(value) - (len(old) if old is not None else 0))
+
+    def with_changes(self, removed:Iterable[str], upserts:Iterable[ImageInfo]) -> "GalleryIndex":
+        """ Returns a copy with images removed or replaced by name """
+        upserts = list(upserts)
+        touched = set(removed).union(image.name for image in upserts)
+        images = [image for image in self.images if image.name not in touched]
+        images.extend(upserts)
+        return GalleryIndex(self.dirpath, self.token, images, self.racy, self.live, self.source)
+
+    def filter(self, show_mode:ShowModeA=ShowMode.UNMARKED) -> list[ImageInfo]:
+        if show_mode == ShowMode.ALL:
+            return list(self.images)
+        return [image for image in self.images if matches_show_mode(image, show_mode)]
+
+    def sorted_view(self, sort:SortKeyA, show_mode:ShowModeA=ShowMode.UNMARKED) -> SortedView:
+        view = self._views.get((sort, show_mode))
+        if view is None:
+            built = SortedView(self.filter(show_mode), SORT_KEY_FUNCS[sort])
+            # a view built concurrently by another thread wins and is counted once
+            view = self._views.setdefault((sort, show_mode), built)
+            if view is built:
+                self.charge(len(view.images))
+        return view
+
+    def page(self, show_mode:ShowModeA=ShowMode.UNMARKED, sort:SortKeyA=SortKey.MOD_TIME,
+             order:SortOrderA=SortOrder.ASC, cursor:str|None=None, limit:int=100) -> ImagesPage:
+        after = SORT_KEY_FUNCS[sort](decode_cursor(cursor)) if cursor else None
+        images, has_more = self.sorted_view(sort, show_mode).page(
+            after, order == SortOrder.DESC, limit
+        )
+        return {
+            "results": images,
+            "next": encode_cursor(images[-1]) if has_more else None
+        }
+
+    def neighbors(self, image:ImageInfo, show_mode:ShowModeA=ShowMode.UNMARKED,
+                  sort:SortKeyA=SortKey.MOD_TIME, order:SortOrderA=SortOrder.ASC,
+                  count:int=3) -> tuple[list[ImageInfo], list[ImageInfo]]:
+        """ Up to count images following and preceding image in listing order, nearest first
+
+        The image itself doesn't have to match show_mode, e.g. when it was just marked.
+        """
+        key = SORT_KEY_FUNCS[sort](image)
+        view = self.sorted_view(sort, show_mode)
+        reverse = order == SortOrder.DESC
+        following, _ = view.page(key, reverse, count)
+        preceding, _ = view.page(key, not reverse, count)
+        return following, preceding
+
+
+class ImagesIndexCache:
+    """ Process-wide LRU cache of gallery listings validated by a token
+
+    The token is the directory mtime unless the caller provides its own. Entries of
+    sorted views and derived data count against max_images like images do.
+    """
+
+    def __init__(self, max_images:int) -> None:
+        self._max_images = max_images
+        self._lock = threading.Lock()
+        self._indexes: OrderedDict[str, GalleryIndex] = OrderedDict()
+        self._total = 0
+
+    @staticmethod
+    def get_token(dirpath:Path) -> int:
+        return os.stat(dirpath).st_mtime_ns
+
+    def get(self, key:str, dirpath:Path, loader:Callable[[], list[ImageInfo]],
+            get_token:Callable[[], Any]|None=None, source:Any=None) -> GalleryIndex:
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None and index.live and index.dirpath == dirpath:
+                self._indexes.move_to_end(key)
+                return index
+
+        # token is taken before the scan so changes made during it force a rescan
+        if get_token is None:
+            token = self.get_token(dirpath)
+            racy = time.time_ns() - token < RACY_MTIME_NS
+        else:
+            token = get_token()
+            racy = False
+
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None and index.token == token and index.dirpath == dirpath and not index.racy:
+                self._indexes.move_to_end(key)
+                return index
+
+        index = GalleryIndex(dirpath, token, loader(), racy, source=source)
+        self.put(key, index)
+        return index
+
+    @staticmethod
+    def _carried_over(index:GalleryIndex) -> dict[str, Any]:
+        return {name: value for name, value in index.derived.items()
+                if getattr(value, "carried_over", False)}
+
+    def put(self, key:str, index:GalleryIndex) -> None:
+        with self._lock:
+            old = self._indexes.pop(key, None)
+            if old is not None:
+                self._total -= old.charged
+                index.derived = {**self._carried_over(old), **index.derived}
+            self._add(key, index)
+            self._evict()
+
+    def _add(self, key:str, index:GalleryIndex) -> None:
+        self._indexes[key] = index
+        index.charged = index.size
+        self._total += index.charged
+        index.on_grow = lambda index, size: self._grow(key, index, size)
+
+    def _grow(self, key:str, index:GalleryIndex, size:int) -> None:
+        with self._lock:
+            # growth of replaced or evicted indexes isn't counted
+            if self._indexes.get(key) is not index:
+                return
+            index.charged += size
+            self._total += size
+            # it is being used, so it's the one kept
+            self._indexes.move_to_end(key)
+            self._evict()
+
+    def _evict(self) -> None:
+        # the most recent index is kept even if it alone exceeds the budget
+        while self._total > self._max_images and len(self._indexes) > 1:
+            _, evicted = self._indexes.popitem(last=False)
+            self._total -= evicted.charged
+
+    def peek(self, key:str) -> GalleryIndex|None:
+        index = self._indexes.get(key)
+        return None if index is None or index.token is _INVALIDATED else index
+
+    def update_live(self, key:str, removed:Iterable[str], upserts:Iterable[ImageInfo]) -> bool:
+        """ Applies changes to a live index, returns False if there is none """
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None or not index.live:
+                return False
+            # readers keep using the old index, it is replaced not modified
+            self._total -= index.charged
+            updated = index.with_changes(removed, upserts)
+            updated.derived = self._carried_over(index)
+            self._add(key, updated)
+            return True
+
+    def set_not_live(self) -> None:
+        """ Falls back to token validation when changes are no longer watched """
+        with self._lock:
+            for index in self._indexes.values():
+                index.live = False
+
+    def invalidate(self, key:str) -> None:
+        with self._lock:
+            index = self._indexes.pop(key, None)
+            if index is None:
+                return
+            self._total -= index.charged
+            carried = self._carried_over(index)
+            if carried:
+                # an empty entry keeps carried data for the listing scanned next, and is
+                # evicted like any other
+                placeholder = GalleryIndex(index.dirpath, _INVALIDATED, [], racy=True)
+                placeholder.derived = carried
+                self._add(key, placeholder)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+            self._total = 0
+
+    def __contains__(self, key:str) -> bool:
+        return self.peek(key) is not None
+
+    @property
+    def total_images(self) -> int:
+        return self._total
+
+
+images_index_cache = ImagesIndexCache(
+    getattr(settings, "IMAGE_PICKER_INDEX_CACHE_MAX_IMAGES", 500_000)
+)
+
+
+class DerivedData:
+    """ Data computed from a listing and attached to it, sized by len()
+
+    Data carried over is handed to the next listing of the gallery after a rescan or a change,
+    which checks it against its own images.
+    """
+    carried_over = False
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MarkedIndex(DerivedData):
+    """ Listing joined with sidecar marks of one marks version, attached to the scanned listing """
+    __slots__ = ("version", "index")
+
+    def __init__(self, version:Any, index:GalleryIndex) -> None:
+        self.version = version
+        self.index = index
+
+    def __len__(self) -> int:
+        return self.index.size
+
+
+def join_marks(index:GalleryIndex, store:MarkStore) -> GalleryIndex:
+    """ Index with marks of the sidecar store, rebuilt only when the scan or marks change """
+    version, marks = store.snapshot()
+    marked = index.derived.get("marks")
+    if marked is not None and marked.version == version:
+        return marked.index
+
+    images = [image if (image.name in marks) == image.marked else image._replace(marked=not image.marked)
+              for image in index.images]
+    joined = GalleryIndex(index.dirpath, index.token, images, index.racy, index.live, index.source)
+    # its sorted views count against the budget of the scanned listing
+    joined.on_grow = lambda _, size: index.charge(size)
+    index.attach("marks", MarkedIndex(version, joined))
+    return joined
+
+
+class DirectorySegment(NamedTuple):
+    mtime_ns: int
+    racy: bool
+    images: list[ImageInfo]
+    subdirs: list[str]
+
+class ImagesTree:
+    """ Images of a recursive gallery kept per directory
+
+    Refresh stats every known directory and lists again only those whose mtime
+    changed, so a change deep in the tree doesn't cause a walk of the whole tree.
+    """
+
+    def __init__(self, dirpath:Path) -> None:
+        self.dirpath = dirpath
+        self._lock = threading.Lock()
+        self._segments: dict[str, DirectorySegment] = {}
+        self._dirty: set[str] = set()
+        self._version = 0
+
+    def _get_mtime(self, reldir:str) -> int|None:
+        try:
+            return os.stat(self.dirpath / reldir if reldir else self.dirpath).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    def _changed_dirs(self) -> list[str]:
+        reldirs = list(self._segments)
+        mtimes = get_walk_pool().map(self._get_mtime, reldirs)
+        changed = [
+            reldir for reldir, mtime in zip(reldirs, mtimes)
+            if reldir in self._dirty or self._segments[reldir].racy or
+                mtime != self._segments[reldir].mtime_ns
+        ]
+        self._dirty.clear()
+        return changed
+
+    def _remove_subtree(self, reldir:str) -> None:
+        prefix = f"{reldir}/"
+        for key in [key for key in self._segments if key == reldir or key.startswith(prefix)]:
+            del self._segments[key]
+
+    def _rescan(self, reldirs:list[str]) -> bool:
+        """ Lists directories again and new subdirectories found in them, returns whether anything changed """
+        changed = False
+        for scan in walk_directories(self.dirpath, reldirs, lambda subdir: subdir not in self._segments):
+            old = self._segments.get(scan.reldir)
+            if scan.mtime_ns is None:
+                if old is not None:
+                    self._remove_subtree(scan.reldir)
+                    changed = True
+                continue
+
+            images = [ImageInfo(name, marked, st.st_mtime * 1000) for name, marked, st in scan.images]
+            if old is not None:
+                for subdir in set(old.subdirs).difference(scan.subdirs):
+                    self._remove_subtree(subdir)
+            if old is None or old.images != images or old.subdirs != scan.subdirs:
+                changed = True
+            racy = scan.scanned_ns - scan.mtime_ns < RACY_MTIME_NS
+            self._segments[scan.reldir] = DirectorySegment(scan.mtime_ns, racy, images, scan.subdirs)
+        return changed
+
+    def refresh(self) -> tuple[int, int]:
+        """ Brings the tree up to date, returns a token changing with its content """
+        with self._lock:
+            reldirs = self._changed_dirs() if self._segments else [""]
+            if reldirs and self._rescan(reldirs):
+                self._version += 1
+            return (id(self), self._version)
+
+    def invalidate_dirs(self, reldirs:Iterable[str]) -> None:
+        """ Lists directories again on next refresh whatever their mtimes are """
+        with self._lock:
+            self._dirty.update(reldirs)
+
+    def images(self) -> list[ImageInfo]:
+        with self._lock:
+            return [image for segment in self._segments.values() for image in segment.images]
+
+class MarksConversion(NamedTuple):
+    converted: int
+    conflicts: list[str]
+
+
 class FSImagesProvider():
     
     @classmethod
@@ -49,31 +681,172 @@ class FSImagesProvider():
     def __init__(self, gallery:Gallery) -> None:
         self._gallery = gallery
         self._dirpath = Path(gallery.dir_path).resolve()
+        self._deferred_changes: tuple[list[str], list[ImageInfo]]|None = None
+        self._deferred_lock = threading.Lock()
 
-    def get_images(self, show_mode:ShowModeA=ShowMode.UNMARKED) -> list[ImageDict]:
-        path_all_files = str(self._dirpath / '*.*')
-
-        fname_regex = r".+"
-        ext_regex = r"\.(jpg|png|jpeg|gif|webp)$"
-
-        if show_mode == ShowMode.UNMARKED:
-            fname_regex += r"[^_]"
-        elif show_mode == ShowMode.MARKED:
-            fname_regex += "_"
-
-        fname_regex += ext_regex
-        regex = re.compile(fname_regex, re.IGNORECASE)
-        return list(
-            {
-                "name": file.name,
-                "marked": is_file_marked(file.name),
-                "mod_time": self.get_mod_time(file)
-            }
-            for file in map(Path, filter(regex.match, iglob(path_all_files)))
-        )
+    @property
+    def dirpath(self) -> Path:
+        return self._dirpath
+
+    @property
+    def cache_key(self) -> str:
+        return self._gallery.slug
+
+    @property
+    def use_images_index(self) -> bool:
+        return getattr(settings, "IMAGE_PICKER_USE_IMAGES_INDEX", False)
+
+    @property
+    def recursive(self) -> bool:
+        return self._gallery.recursive
+
+    @property
+    def sidecar_marks(self) -> bool:
+        return getattr(self._gallery, "mark_mode", MarkMode.SUFFIX) == MarkMode.SIDECAR
+
+    @property
+    def mark_store(self) -> MarkStore:
+        return get_mark_store(self._gallery.slug)
+
+    def is_marked(self, imagename:str) -> bool:
+        if self.sidecar_marks:
+            return self.mark_store.is_marked(imagename)
+        return is_file_marked(imagename)
+
+    def relative_name(self, path:Path) -> str:
+        return path.relative_to(self._dirpath).as_posix()
+
+    def scan_images(self) -> list[ImageInfo]:
+        with timed("scan"):
+            if self.recursive:
+                images = [ImageInfo(name, marked, st.st_mtime * 1000)
+                          for name, marked, st in walk_image_stats(self._dirpath)]
+            else:
+                images = scan_images(self._dirpath)
+        count(files_scanned, "files", len(images))
+        return images
+
+    def get_tree(self) -> ImagesTree:
+        """ Tree of the cached index to revalidate it by directories or a new one """
+        index = images_index_cache.peek(self.cache_key)
+        if index is not None and isinstance(index.source, ImagesTree) and index.dirpath == self._dirpath:
+            return index.source
+        return ImagesTree(self._dirpath)
+
+    def get_tree_index(self) -> GalleryIndex:
+        tree = self.get_tree()
+        with timed("scan"):
+            return images_index_cache.get(self.cache_key, self._dirpath, tree.images, tree.refresh,
+                                          source=tree)
+
+    def get_indexed_images(self, show_mode:ShowModeA=ShowMode.ALL) -> list[ImageInfo]:
+        """ Reads images from database index filled by sync_galleries command """
+        qs = Image.objects.filter(gallery_id=self._gallery.pk)
+        if show_mode in (ShowMode.MARKED, ShowMode.UNMARKED):
+            qs = qs.filter(marked=show_mode == ShowMode.MARKED)
+        with timed("index_db"):
+            return [ImageInfo._make(row) for row in qs.values_list("name", "marked", "mod_time")]
+
+    def get_images_index_token(self) -> tuple[Any, ...]:
+        # every Image writer bumps index_version, so a single row lookup replaces aggregating images
+        version = Gallery.objects.filter(pk=self._gallery.pk).values_list("index_version", flat=True).first()
+        try:
+            mtime_ns = ImagesIndexCache.get_token(self._dirpath)
+        except FileNotFoundError:
+            mtime_ns = None
+        return version, mtime_ns
+
+    def get_scanned_index(self) -> GalleryIndex:
+        """ Index with marks taken from file names """
+        if self.use_images_index:
+            return images_index_cache.get(self.cache_key, self._dirpath,
+                                          self.get_indexed_images, self.get_images_index_token)
+        if self.recursive:
+            return self.get_tree_index()
+        return images_index_cache.get(self.cache_key, self._dirpath, self.scan_images)
+
+    def get_index(self, scanned:GalleryIndex|None=None) -> GalleryIndex:
+        """ Listing with marks, scanned is the current scanned listing if already taken """
+        index = self.get_scanned_index() if scanned is None else scanned
+        if self.sidecar_marks:
+            return join_marks(index, self.mark_store)
+        return index
+
+    def invalidate_index(self) -> None:
+        images_index_cache.invalidate(self.cache_key)
+
+    def apply_index_changes(self, removed:list[str], upserts:list[ImageInfo]) -> None:
+        with self._deferred_lock:
+            if self._deferred_changes is not None:
+                self._deferred_changes[0].extend(removed)
+                self._deferred_changes[1].extend(upserts)
+                return
+        # watched indexes are updated in place, others are rescanned on next use
+        if images_index_cache.update_live(self.cache_key, removed, upserts):
+            return
+        index = images_index_cache.peek(self.cache_key)
+        if index is not None and isinstance(index.source, ImagesTree):
+            # only directories of changed images are listed again
+            index.source.invalidate_dirs(
+                {posixpath.dirname(name) for name in (*removed, *(image.name for image in upserts))}
+            )
+            return
+        self.invalidate_index()
+
+    @contextmanager
+    def deferred_index_changes(self) -> Iterator[None]:
+        """ Collects index changes to apply them at once """
+        self._deferred_changes = ([], [])
+        try:
+            yield
+        finally:
+            with self._deferred_lock:
+                removed, upserts = self._deferred_changes
+                self._deferred_changes = None
+            if removed or upserts:
+                self.apply_index_changes(removed, upserts)
+
+    def get_images(self, show_mode:ShowModeA=ShowMode.UNMARKED) -> list[ImageInfo]:
+        if self.use_images_index and not self.sidecar_marks:
+            return self.get_indexed_images(show_mode)
+        return self.get_index().filter(show_mode)
+
+    def get_page(self, show_mode:ShowModeA=ShowMode.UNMARKED, sort:SortKeyA=SortKey.MOD_TIME,
+                 order:SortOrderA=SortOrder.ASC, cursor:str|None=None, limit:int=100) -> ImagesPage:
+        return self.get_index().page(show_mode, sort, order, cursor, limit)
+
+    def get_neighbors(self, imagename:str, show_mode:ShowModeA=ShowMode.UNMARKED,
+                      sort:SortKeyA=SortKey.MOD_TIME, order:SortOrderA=SortOrder.ASC,
+                      count:int=3) -> tuple[list[ImageInfo], list[ImageInfo]]:
+        self.check_parent_and_raise(imagename)
+        # mod_time of the image locates it in the sorted listing without searching by name
+        image = ImageInfo(imagename, self.is_marked(imagename),
+                          self.get_mod_time(self.get_image_path(imagename)))
+        return self.get_index().neighbors(image, show_mode, sort, order, count)
+
+    def iter_images(self, show_mode:ShowModeA=ShowMode.UNMARKED) -> Iterator[ImageInfo]:
+        """ Streams images straight from the directory bypassing the index cache """
+        if self.recursive:
+            images = (ImageInfo(name, marked, st.st_mtime * 1000)
+                      for name, marked, st in walk_image_stats(self._dirpath))
+        else:
+            images = iter_images(self._dirpath)
+        if self.sidecar_marks:
+            marks = self.mark_store.names()
+            images = (image._replace(marked=image.name in marks) for image in images)
+        return (image for image in images if matches_show_mode(image, show_mode))
     
     def check_parent(self, imagename:str) -> bool:
-        return self._dirpath == (self._dirpath / imagename).parent
+        path = self._dirpath / imagename
+        if not self.recursive:
+            return self._dirpath == path.parent
+
+        parts = imagename.split("/")
+        # no way up, no hidden or empty components and nothing absolute
+        if any(not part or part[0] == "." or "\\" in part for part in parts):
+            return False
+        # listed directories are never symlinks, a symlinked one could lead outside the gallery
+        return os.path.realpath(path.parent) == str(path.parent)
     
     def check_parent_and_raise(self, imagename:str) -> bool:
         if not self.check_parent(imagename):
@@ -89,12 +862,18 @@ class FSImagesProvider():
             raise FileNotFoundError(f"file {imagename} doesn't exist in gallery {self._dirpath}")
         return file
 
-    def mark_image(self, imagename:str, mark:bool=True) -> ImageDict:
+    def mark_image(self, imagename:str, mark:bool=True) -> ImageInfo:
         
         self.check_parent_and_raise(imagename)
         
         file = self.get_image_path(imagename)
 
+        if self.sidecar_marks:
+            # nothing is renamed so the directory, its mtime and the cached scan stay as they are
+            name = self.relative_name(file)
+            self.mark_store.set([name], mark)
+            return ImageInfo(name, mark, self.get_mod_time(file))
+
         new_filename: Path| None = None
         if mark and not is_file_marked(file):
             new_filename = file.with_name(file.stem + "_"+ file.suffix)
@@ -102,19 +881,195 @@ class FSImagesProvider():
             new_filename = file.with_name(file.stem[:-1] + file.suffix)
     
         if new_filename:
-            file.rename(new_filename)
-            file = new_filename
-        return {
-                "name": file.name,
-                "marked": mark,
-                "mod_time": self.get_mod_time(file)
-            }
+            return self.rename_image(file, new_filename, mark)
+
+        return ImageInfo(self.relative_name(file), mark, self.get_mod_time(file))
+
+    def rename_image(self, file:Path, new_filename:Path, mark:bool) -> ImageInfo:
+        file.rename(new_filename)
+        image_renamed.send(
+            sender=self.__class__, gallery=self._gallery, old_path=file, new_path=new_filename
+        )
+        old_name, new_name = self.relative_name(file), self.relative_name(new_filename)
+        if self.use_images_index:
+            with transaction.atomic():
+                Image.objects.filter(gallery_id=self._gallery.pk, name=old_name).update(
+                    name=new_name, marked=mark
+                )
+                bump_index_version(self._gallery.pk)
+        image = ImageInfo(new_name, mark, self.get_mod_time(new_filename))
+        self.apply_index_changes([old_name], [image])
+        return image
 
     def delete_image(self, imagename:str) -> None:
         self.check_parent_and_raise(imagename)
 
         del_path = self.get_image_path(imagename)
-        del_path.unlink()
+        name = self.relative_name(del_path)
+        if trash_enabled():
+            # the sidecar mark goes with the image, so restoring brings it back
+            self.trash.move(del_path, name, self.sidecar_marks and self.mark_store.is_marked(name))
+        else:
+            del_path.unlink()
+        image_deleted.send(sender=self.__class__, gallery=self._gallery, path=del_path)
+        if self.sidecar_marks:
+            self.mark_store.set([name], False)
+        if self.use_images_index:
+            with transaction.atomic():
+                Image.objects.filter(gallery_id=self._gallery.pk, name=name).delete()
+                bump_index_version(self._gallery.pk)
+        self.apply_index_changes([name], [])
+
+    @property
+    def trash(self) -> Trash:
+        return Trash(self._dirpath)
+
+    def get_trash(self) -> list[TrashEntry]:
+        return self.trash.entries()
+
+    def restore_image(self, entry_id:str) -> ImageInfo:
+        """ Moves a trashed image back, fails if its name was taken meanwhile """
+        name, file, marked = self.trash.restore(entry_id)
+        if marked and self.sidecar_marks:
+            self.mark_store.set([name])
+        st = file.stat()
+        image = ImageInfo(name, self.is_marked(name), st.st_mtime * 1000)
+        if self.use_images_index:
+            with transaction.atomic():
+                Image.objects.update_or_create(
+                    gallery_id=self._gallery.pk, name=name,
+                    defaults={"marked": is_file_marked(name), "mod_time": image.mod_time, "size": st.st_size}
+                )
+                bump_index_version(self._gallery.pk)
+        self.apply_index_changes([], [image])
+        return image
+
+    def sidecar_renames(self) -> tuple[list[tuple[Path, Path]], list[str]]:
+        """ Suffix marked images to rename to unmarked names and ones whose name is taken """
+        renames: list[tuple[Path, Path]] = []
+        conflicts: list[str] = []
+        for image in self.scan_images():
+            if not image.marked:
+                continue
+            file = self._dirpath / image.name
+            new_filename = file.with_name(file.stem[:-1] + file.suffix)
+            if new_filename.exists():
+                conflicts.append(image.name)
+            else:
+                renames.append((file, new_filename))
+        return renames, conflicts
+
+    def suffix_renames(self) -> tuple[list[tuple[Path, Path]], list[str]]:
+        """ Sidecar marked images to rename to marked names and ones whose name is taken """
+        renames: list[tuple[Path, Path]] = []
+        conflicts: list[str] = []
+        for name in sorted(self.mark_store.names()):
+            file = self._dirpath / name
+            if not file.exists() or is_file_marked(file):
+                continue
+            new_filename = file.with_name(file.stem + "_" + file.suffix)
+            if new_filename.exists():
+                conflicts.append(name)
+            else:
+                renames.append((file, new_filename))
+        return renames, conflicts
+
+    def convert_marks(self, mode:str) -> MarksConversion:
+        """ Moves marks between file name suffixes and the sidecar store
+
+        The mode is switched first and marks are moved once running processes see it,
+        so none of them keeps marking the old way. Marks of images whose other name is
+        taken stay where they are, a switch to suffix mode with such conflicts isn't made.
+        """
+        delay = gallery_registry.propagation_delay()
+        if delay is None:
+            raise ImagesException(
+                "running processes can't see mark mode changes, configure IMAGE_PICKER_GALLERY_CACHE"
+            )
+
+        store = self.mark_store
+        if mode == MarkMode.SIDECAR:
+            # suffix marks are valid sidecar marks under their current names meanwhile
+            renames, conflicts = self.sidecar_renames()
+            store.set([*conflicts, *(self.relative_name(file) for file, _ in renames)])
+        else:
+            renames, conflicts = self.suffix_renames()
+            if conflicts:
+                return MarksConversion(0, conflicts)
+
+        self._gallery.mark_mode = mode
+        self._gallery.save(update_fields=["mark_mode"])
+        time.sleep(delay)
+
+        converted = 0
+        with self.deferred_index_changes():
+            if mode == MarkMode.SIDECAR:
+                # listed again, images could be marked the old way until the switch was seen
+                renames, conflicts = self.sidecar_renames()
+                store.set(conflicts)
+                for file, new_filename in renames:
+                    store.set([self.relative_name(new_filename)])
+                    self.rename_image(file, new_filename, True)
+                    store.set([self.relative_name(file)], False)
+                    converted += 1
+            else:
+                renames, conflicts = self.suffix_renames()
+                for file, new_filename in renames:
+                    self.rename_image(file, new_filename, True)
+                    converted += 1
+                # conflicting marks stay in the store in case the gallery is switched back
+                store.set(set(store.names()).difference(conflicts), False)
+        return MarksConversion(converted, conflicts)
+
+    def apply_operation(self, operation:BatchOperationDict) -> BatchResultDict:
+        name, op = operation["name"], operation["op"]
+        result: BatchResultDict = {
+            "name": name, "op": op, "status": "ok", "image": None, "error": None
+        }
+        try:
+            if op == BatchOp.DELETE:
+                self.delete_image(name)
+            else:
+                result["image"] = self.mark_image(name, mark=op == BatchOp.MARK)
+        except FileNotFoundError as e:
+            result["status"] = "not_found"
+            result["error"] = str(e)
+        except (ImagesException, OSError) as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        return result
+
+    def _apply_operations_in_thread(self, operations:list[BatchOperationDict]) -> list[BatchResultDict]:
+        try:
+            return [self.apply_operation(operation) for operation in operations]
+        finally:
+            # connections are per thread and pool threads are gone after the batch
+            connections.close_all()
+
+    def apply_batch(self, operations:list[BatchOperationDict], parallel:bool=False) -> list[BatchResultDict]:
+        """ Applies operations in order, in parallel for slow or network filesystems
+
+        In parallel only operations of different images run concurrently, ones of the same
+        image, under its marked or unmarked name, run in order on one worker.
+        """
+        with self.deferred_index_changes():
+            if not parallel:
+                return [self.apply_operation(operation) for operation in operations]
+
+            groups: dict[str, list[int]] = {}
+            for i, operation in enumerate(operations):
+                groups.setdefault(unmarked_name(operation["name"]), []).append(i)
+            results: list[BatchResultDict] = [None] * len(operations) # type: ignore
+            workers = getattr(settings, "IMAGE_PICKER_BATCH_WORKERS", 8)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                group_results = executor.map(
+                    lambda indexes: self._apply_operations_in_thread([operations[i] for i in indexes]),
+                    groups.values()
+                )
+                for indexes, group in zip(groups.values(), group_results):
+                    for i, result in zip(indexes, group):
+                        results[i] = result
+            return results
 
 # Picker settings
 class PickerSettingsDict(TypedDict):
@@ -0,0 +1,168 @@
+""" Where picker settings of a client are kept, see IMAGE_PICKER_SETTINGS_STORE """
+import secrets
+from typing import Any, Protocol, cast
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import BaseCache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+from django.utils.module_loading import import_string
+
+from .models import UserPickerSettings
+from .services import DEFAULT_SHOW_MODE, PickerSettings
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_SETTINGS_STORE: str
+    IMAGE_PICKER_SETTINGS_CACHE: str
+    IMAGE_PICKER_SETTINGS_COOKIE_AGE: int
+    SESSION_COOKIE_SECURE: bool
+
+
+settings = cast(MySettings, settings)
+
+SETTINGS_COOKIE = "picker_settings"
+CLIENT_COOKIE = "picker_client"
+COOKIE_SALT = "image_picker.settings"
+CACHE_KEY = "image_picker:settings:{kind}:{id}"
+DEFAULT_COOKIE_AGE = 365 * 24 * 60 * 60
+
+def get_cookie_age() -> int:
+    return getattr(settings, "IMAGE_PICKER_SETTINGS_COOKIE_AGE", DEFAULT_COOKIE_AGE)
+
+def get_settings_cache() -> BaseCache:
+    return caches[getattr(settings, "IMAGE_PICKER_SETTINGS_CACHE", "default")]
+
+def get_cookie(request:HttpRequest, key:str) -> Any:
+    value = request.COOKIES.get(key)
+    if not value:
+        return None
+    try:
+        return signing.loads(value, salt=COOKIE_SALT, max_age=get_cookie_age())
+    except signing.BadSignature:
+        return None
+
+def set_cookie(response:HttpResponse, key:str, value:Any) -> None:
+    response.set_cookie(
+        key, signing.dumps(value, salt=COOKIE_SALT, compress=True), max_age=get_cookie_age(),
+        httponly=True, samesite="Lax", secure=getattr(settings, "SESSION_COOKIE_SECURE", False)
+    )
+
+def from_dict(data:Any) -> PickerSettings:
+    if not isinstance(data, dict):
+        return PickerSettings.default_settings()
+    return PickerSettings(data.get("selected_gallery", ""), data.get("show_mode", DEFAULT_SHOW_MODE))
+
+
+class SettingsStore:
+    def load(self, request:HttpRequest) -> PickerSettings:
+        raise NotImplementedError
+
+    def save(self, request:HttpRequest, response:HttpResponse, picker_settings:PickerSettings) -> None:
+        raise NotImplementedError
+
+
+class SessionSettingsStore(SettingsStore):
+    """ Django session, costs whatever the session engine costs """
+
+    def load(self, request:HttpRequest) -> PickerSettings:
+        return PickerSettings.from_session(request)
+
+    def save(self, request:HttpRequest, response:HttpResponse, picker_settings:PickerSettings) -> None:
+        picker_settings.to_session(request)
+
+
+class SignedCookieSettingsStore(SettingsStore):
+    """ Settings kept by the client in a signed cookie, no server side state at all """
+
+    def load(self, request:HttpRequest) -> PickerSettings:
+        return from_dict(get_cookie(request, SETTINGS_COOKIE))
+
+    def save(self, request:HttpRequest, response:HttpResponse, picker_settings:PickerSettings) -> None:
+        set_cookie(response, SETTINGS_COOKIE, picker_settings.to_dict())
+
+
+class CacheSettingsStore(SettingsStore):
+    """ Settings in a cache keyed by a random client id cookie """
+
+    def get_client_id(self, request:HttpRequest) -> str|None:
+        client_id = get_cookie(request, CLIENT_COOKIE)
+        return client_id if isinstance(client_id, str) else None
+
+    def load(self, request:HttpRequest) -> PickerSettings:
+        client_id = self.get_client_id(request)
+        if client_id is None:
+            return PickerSettings.default_settings()
+        data = get_settings_cache().get(CACHE_KEY.format(kind="client", id=client_id))
+        return from_dict(data)
+
+    def save(self, request:HttpRequest, response:HttpResponse, picker_settings:PickerSettings) -> None:
+        client_id = self.get_client_id(request) or secrets.token_urlsafe(16)
+        get_settings_cache().set(CACHE_KEY.format(kind="client", id=client_id),
+                                 picker_settings.to_dict(), get_cookie_age())
+        # refreshes the cookie age too
+        set_cookie(response, CLIENT_COOKIE, client_id)
+
+
+class UserSettingsStore(SettingsStore):
+    """ Settings of signed in users in the database behind a write-through cache
+
+    Anonymous clients fall back to signed cookies.
+    """
+    anonymous_store = SignedCookieSettingsStore()
+
+    def get_user_id(self, request:HttpRequest) -> Any:
+        user = getattr(request, "user", None)
+        return user.pk if user is not None and user.is_authenticated else None
+
+    def load(self, request:HttpRequest) -> PickerSettings:
+        user_id = self.get_user_id(request)
+        if user_id is None:
+            return self.anonymous_store.load(request)
+
+        cache = get_settings_cache()
+        key = CACHE_KEY.format(kind="user", id=user_id)
+        data = cache.get(key)
+        if data is None:
+            row = UserPickerSettings.objects.filter(user_id=user_id).first()
+            data = row.to_dict() if row else PickerSettings.default_settings().to_dict()
+            cache.set(key, data, None)
+        return from_dict(data)
+
+    def save(self, request:HttpRequest, response:HttpResponse, picker_settings:PickerSettings) -> None:
+        user_id = self.get_user_id(request)
+        if user_id is None:
+            self.anonymous_store.save(request, response, picker_settings)
+            return
+
+        data = picker_settings.to_dict()
+        UserPickerSettings.objects.update_or_create(user_id=user_id, defaults=data)
+        get_settings_cache().set(CACHE_KEY.format(kind="user", id=user_id), data, None)
+
+
+SETTINGS_STORES: dict[str, type[SettingsStore]] = {
+    "session": SessionSettingsStore,
+    "signed-cookie": SignedCookieSettingsStore,
+    "cache": CacheSettingsStore,
+    "user": UserSettingsStore,
+}
+
+def get_settings_store() -> SettingsStore:
+    name = getattr(settings, "IMAGE_PICKER_SETTINGS_STORE", "session")
+    store_class: Any = SETTINGS_STORES.get(name)
+    if store_class is None:
+        try:
+            store_class = import_string(name)
+        except ImportError as e:
+            raise ImproperlyConfigured(f"unknown picker settings store {name}") from e
+    return store_class()
+
+
+@receiver(post_save, sender=UserPickerSettings)
+@receiver(post_delete, sender=UserPickerSettings)
+def on_user_settings_changed(sender:Any, instance:UserPickerSettings, **kwargs:Any) -> None:
+    # rows changed outside of the store, e.g. in admin, are reloaded on next use
+    get_settings_cache().delete(CACHE_KEY.format(kind="user", id=instance.pk))
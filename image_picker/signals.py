@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# sent by images providers with gallery and old_path, new_path arguments
+image_renamed = Signal()
+
+# sent by images providers with gallery and path arguments
+image_deleted = Signal()
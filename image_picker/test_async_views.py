@@ -0,0 +1,107 @@
+import asyncio
+import tempfile
+import threading
+from pathlib import Path
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from django.core import signals
+from django.db import close_old_connections
+from django.test import AsyncClient, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from .asgi import ASGIHandler
+from .async_views import aget_gallery_or_404, aiter_file_range
+from .models import Gallery
+from .registry import get_gallery_or_404
+
+
+# galleries are looked up in io pool threads, which only see committed rows
+@override_settings(IMAGE_PICKER_METRICS=True)
+class AsyncViewsTestCase(TransactionTestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dir_path = Path(self.tmp_dir.name)
+        (self.tmp_dir_path / "1.jpg").write_bytes(b"0123456789")
+        (self.tmp_dir_path / "2_.jpg").touch()
+        Gallery.objects.create(title="async", slug="async", dir_path=self.tmp_dir.name)
+        self.async_client = AsyncClient()
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    async def test_gallery_lookup_in_io_pool(self):
+        threads = []
+        def lookup(slug):
+            threads.append(threading.current_thread().name)
+            return get_gallery_or_404(slug)
+
+        with mock.patch("image_picker.async_views.get_gallery_or_404", lookup):
+            gallery = await aget_gallery_or_404("async")
+        self.assertEqual(gallery.slug, "async")
+        self.assertTrue(threads[0].startswith("image-picker-io"))
+
+    async def test_images(self):
+        resp = await self.async_client.get(reverse("images-async", args=["async"]) + "?show_mode=all")
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertSetEqual({i["name"] for i in data}, {"1.jpg", "2_.jpg"})
+        self.assertTrue(all(i["url"].startswith("/async/get-image/async/") for i in data))
+        # io pool work is timed for the request
+        self.assertIn("scan;dur=", resp["Server-Timing"])
+
+        resp = await self.async_client.get(reverse("images-async", args=["not_exists"]))
+        self.assertEqual(resp.status_code, 404)
+
+    async def test_get_image(self):
+        url = reverse("get-image-async", args=["async", "1.jpg"])
+        resp = await self.async_client.get(url, headers=[(b"range", b"bytes=2-4")])
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(await sync_to_async(b"".join)(resp.streaming_content), b"234")
+
+        resp = await self.async_client.get(reverse("get-image-async", args=["async", "3.jpg"]))
+        self.assertEqual(resp.status_code, 404)
+
+    async def test_mark_and_delete(self):
+        resp = await self.async_client.post(reverse("mark-image-async", args=["async", "1.jpg"]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json()["name"], "1_.jpg")
+
+        resp = await self.async_client.get(reverse("delete-image-async", args=["async", "1_.jpg"]))
+        self.assertEqual(resp.status_code, 405)
+        resp = await self.async_client.post(reverse("delete-image-async", args=["async", "1_.jpg"]))
+        self.assertEqual(resp.status_code, 204)
+        self.assertFalse((self.tmp_dir_path / "1_.jpg").exists())
+
+    def test_aiter_file_range(self):
+        async def read() -> bytes:
+            return b"".join([chunk async for chunk in
+                             aiter_file_range(self.tmp_dir_path / "1.jpg", 3, 100)])
+        self.assertEqual(asyncio.run(read()), b"3456789")
+
+    async def test_asgi_handler_streams_async_content(self):
+        messages: list[dict] = []
+
+        async def receive() -> dict:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message:dict) -> None:
+            messages.append(message)
+
+        scope = {
+            "type": "http", "method": "GET", "query_string": b"",
+            "path": reverse("get-image-async", args=["async", "1.jpg"]),
+            "headers": [(b"host", b"testserver"), (b"range", b"bytes=2-4")],
+        }
+        # like the test client, keeps the test transaction connection open
+        signals.request_started.disconnect(close_old_connections)
+        signals.request_finished.disconnect(close_old_connections)
+        try:
+            await ASGIHandler()(scope, receive, send)
+        finally:
+            signals.request_started.connect(close_old_connections)
+            signals.request_finished.connect(close_old_connections)
+
+        self.assertEqual(messages[0]["status"], 206)
+        self.assertEqual(b"".join(m.get("body", b"") for m in messages[1:]), b"234")
@@ -0,0 +1,54 @@
+import json
+from io import StringIO
+import tempfile
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from .benchmarks import benchmark_gallery, compare
+from .models import Gallery
+from .services import FSImagesProvider, ShowMode
+
+
+class BenchmarksTestCase(TestCase):
+
+    def test_compare(self):
+        baseline = {"results": {
+            "a": {"median": 0.010}, "b": {"median": 0.010}, "c": {"median": 0.0001},
+        }}
+        current = {"results": {
+            "a": {"median": 0.011}, "b": {"median": 0.020}, "c": {"median": 0.0005},
+            "new": {"median": 1.0},
+        }}
+        regressions = compare(baseline, current, tolerance=0.2)
+        self.assertListEqual([r.name for r in regressions], ["b"])
+        self.assertAlmostEqual(regressions[0].ratio, 2.0)
+
+    def test_benchmark_gallery_slug_taken(self):
+        Gallery.objects.create(title="benchmark", slug="benchmark", dir_path=tempfile.gettempdir())
+        with benchmark_gallery(2) as gallery:
+            self.assertNotEqual(gallery.slug, "benchmark")
+            self.assertEqual(len(FSImagesProvider(gallery).get_images(ShowMode.ALL)), 2)
+        self.assertFalse(Gallery.objects.filter(pk=gallery.pk).exists())
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = Path(tmp_dir) / "results.json"
+            # the test database is already a throwaway one
+            call_command("benchmark_images", sizes="12", repeat=2, output=str(output),
+                         current_database=True, stderr=StringIO())
+            results = json.loads(output.read_text())
+
+            self.assertIn("12/get_images/unmarked/warm", results["results"])
+            self.assertIn("12/view/get_image", results["results"])
+            self.assertEqual(results["results"]["12/delete_image"]["runs"], 2)
+            self.assertFalse(Gallery.objects.filter(slug__startswith="benchmark").exists())
+
+            # a run against itself can only differ by noise
+            call_command("benchmark_images", sizes="12", repeat=2, baseline=str(output),
+                         tolerance=100, current_database=True, stdout=StringIO(), stderr=StringIO())
+
+        with self.assertRaises(CommandError):
+            call_command("benchmark_images", sizes="3", repeat=2)
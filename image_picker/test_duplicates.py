@@ -0,0 +1,126 @@
+import os
+import random
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.test import TestCase
+from django.urls import reverse
+from PIL import Image, ImageDraw
+
+from . import duplicates
+from .duplicates import BKTree, get_hash_index, hamming, update_hashes
+from .models import Gallery, ImageHash
+from .services import FSImagesProvider, ShowMode, images_index_cache
+
+
+class BKTreeTestCase(TestCase):
+
+    def test_search_matches_linear_scan(self):
+        rnd = random.Random(1)
+        hashes = [rnd.getrandbits(64) for _ in range(500)]
+        # some near copies
+        hashes += [h ^ (1 << rnd.randrange(64)) for h in hashes[:50]]
+        tree = BKTree()
+        for i, value in enumerate(hashes):
+            tree.add(value, str(i))
+        self.assertEqual(len(tree), len(hashes))
+
+        for value in hashes[:20]:
+            for distance in (0, 3, 10):
+                expected = {str(i) for i, other in enumerate(hashes) if hamming(value, other) <= distance}
+                self.assertSetEqual({name for _, name in tree.search(value, distance)}, expected)
+
+
+class DuplicatesTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.dirpath = Path(self.tmp_dir.name)
+
+        original = Image.new("RGB", (256, 256))
+        draw = ImageDraw.Draw(original)
+        for i in range(0, 256, 32):
+            draw.rectangle((i, 0, i + 16, 255), fill=(i, 255 - i, 128))
+        original.save(self.dirpath / "a.png")
+        original.resize((200, 200)).save(self.dirpath / "a_copy.jpg", quality=70)
+        original.rotate(90).save(self.dirpath / "b.png")
+
+        mtime = time.time() - 60
+        os.utime(self.dirpath, (mtime, mtime))
+        self.gallery = Gallery.objects.create(title="dups", slug="dups", dir_path=self.tmp_dir.name)
+        images_index_cache.invalidate("dups")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_update_hashes(self):
+        provider = FSImagesProvider(self.gallery)
+        result = update_hashes(self.gallery, provider.get_images(ShowMode.ALL))
+        self.assertEqual(result.hashed, 3)
+        # nothing changed
+        self.assertEqual(update_hashes(self.gallery, provider.get_images(ShowMode.ALL)).hashed, 0)
+
+        # marking moves the hash
+        dhash = ImageHash.objects.get(gallery=self.gallery, name="b.png").dhash
+        provider.mark_image("b.png")
+        result = update_hashes(self.gallery, provider.get_images(ShowMode.ALL))
+        self.assertEqual((result.hashed, result.renamed, result.deleted), (0, 1, 0))
+        self.assertEqual(ImageHash.objects.get(gallery=self.gallery, name="b_.png").dhash, dhash)
+
+        provider.delete_image("b_.png")
+        result = update_hashes(self.gallery, provider.get_images(ShowMode.ALL))
+        self.assertEqual(result.deleted, 1)
+
+    def test_concurrent_writer(self):
+        images = FSImagesProvider(self.gallery).get_images(ShowMode.ALL)
+        plan_derived_rows = duplicates.plan_derived_rows
+
+        def plan_and_race(stored, images):
+            plan = plan_derived_rows(stored, images)
+            # another process stores the same image meanwhile
+            ImageHash.objects.create(gallery=self.gallery, name="a.png", mod_time=0, dhash=1)
+            return plan
+
+        with mock.patch.object(duplicates, "plan_derived_rows", plan_and_race):
+            update_hashes(self.gallery, images)
+        self.assertEqual(ImageHash.objects.filter(gallery=self.gallery).count(), 3)
+
+    def test_carried_over_listing_changes(self):
+        index = get_hash_index(self.gallery)
+        provider = FSImagesProvider(self.gallery)
+        provider.mark_image("a.png")
+        provider.delete_image("b.png")
+        # marks and deletions are applied without reading stored hashes
+        with self.assertNumQueries(0):
+            rebased = get_hash_index(self.gallery)
+        self.assertIsNot(rebased, index)
+        self.assertEqual(rebased.hashes["a_.png"], index.hashes["a.png"])
+        self.assertNotIn("b.png", rebased.mod_times)
+        self.assertListEqual([name for _, name in rebased.similar("a_.png")], ["a_copy.jpg"])
+
+        # new images are hashed, stored rows catch up with the renames then
+        Image.new("RGB", (64, 64)).save(self.dirpath / "c.png")
+        provider.invalidate_index()
+        self.assertIn("c.png", get_hash_index(self.gallery).hashes)
+        self.assertSetEqual(set(ImageHash.objects.filter(gallery=self.gallery).values_list("name", flat=True)),
+                            {"a_.png", "a_copy.jpg", "c.png"})
+
+    def test_endpoints(self):
+        resp = self.client.get(reverse("image-duplicates", args=["dups", "a.png"]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual([i["name"] for i in resp.data["results"]], ["a_copy.jpg"])
+        self.assertEqual(resp.data["results"][0]["url"], reverse("get-image", args=["dups", "a_copy.jpg"]))
+
+        resp = self.client.get(reverse("gallery-duplicates", args=["dups"]))
+        self.assertListEqual([[i["name"] for i in c] for c in resp.data["clusters"]],
+                             [["a.png", "a_copy.jpg"]])
+
+        # index is reused while the listing is the same
+        index = get_hash_index(self.gallery)
+        self.assertIs(get_hash_index(self.gallery), index)
+
+        self.assertEqual(self.client.get(reverse("image-duplicates", args=["dups", "c.png"])).status_code, 404)
+        resp = self.client.get(reverse("gallery-duplicates", args=["dups"]) + "?distance=100")
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,82 @@
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from .feed import get_feed_page
+from .models import Gallery
+from .services import ShowMode, images_index_cache
+
+
+class FeedTestCase(APITestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dirs = [TemporaryDirectory() for _ in range(3)]
+        now = time.time() - 600
+        self.galleries = []
+        self.expected: list[tuple[float, str, str]] = []
+        for i, tmp_dir in enumerate(self.tmp_dirs):
+            slug = f"g{i}"
+            for j in range(5):
+                # 4_.jpg is marked
+                name = f"{j}_.jpg" if j == 4 else f"{j}.jpg"
+                path = Path(tmp_dir.name) / name
+                path.touch()
+                # galleries interleave, 0.jpg of g0 and g1 is a tie broken by slug
+                mtime = now + j * 10 + i if j else now
+                os.utime(path, (mtime, mtime))
+                if j != 4:
+                    self.expected.append((path.stat().st_mtime * 1000, slug, name))
+            os.utime(tmp_dir.name, (now, now))
+            self.galleries.append(Gallery.objects.create(title=slug, slug=slug, dir_path=tmp_dir.name))
+            images_index_cache.invalidate(slug)
+        self.expected.sort()
+
+    def tearDown(self) -> None:
+        for tmp_dir in self.tmp_dirs:
+            tmp_dir.cleanup()
+
+    def collect(self, **kwargs) -> list[tuple[str, str]]:
+        items, cursor = [], None
+        while True:
+            page = get_feed_page(self.galleries, cursor=cursor, **kwargs)
+            items += [(item.gallery, item.image.name) for item in page["results"]]
+            cursor = page["next"]
+            if cursor is None:
+                return items
+
+    def test_merge_pages(self):
+        expected = [(slug, name) for _, slug, name in self.expected]
+        self.assertListEqual(self.collect(limit=4), expected)
+        self.assertListEqual(self.collect(limit=1, order="desc"), expected[::-1])
+        self.assertListEqual(self.collect(limit=3, sort="name"),
+                             sorted(expected, key=lambda item: (item[1], item[0])))
+        self.assertEqual(len(self.collect(limit=7, show_mode=ShowMode.ALL)), 15)
+
+    def test_view(self):
+        url = reverse("images-feed")
+        resp = self.client.get(url, {"galleries": "g2,g0", "limit": 5, "order": "desc"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data["results"]), 5)
+        first = resp.data["results"][0]
+        self.assertEqual(first["url"], reverse("get-image", args=[first["gallery"], first["name"]]))
+        self.assertTrue(all(item["gallery"] in ("g0", "g2") for item in resp.data["results"]))
+
+        resp = self.client.get(resp.data["next"])
+        self.assertEqual(len(resp.data["results"]), 3)
+        self.assertIsNone(resp.data["next"])
+
+        self.assertEqual(self.client.get(url, {"galleries": "g0,nope"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"cursor": "bad"}).status_code, 400)
+
+        os.rename(self.tmp_dirs[1].name, self.tmp_dirs[1].name + "-gone")
+        images_index_cache.invalidate("g1")
+        try:
+            resp = self.client.get(url)
+            self.assertIn("g1", resp.data["skipped"])
+            self.assertEqual(len(resp.data["results"]), 8)
+        finally:
+            os.rename(self.tmp_dirs[1].name + "-gone", self.tmp_dirs[1].name)
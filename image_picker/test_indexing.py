@@ -0,0 +1,80 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from .indexing import sync_gallery
+from .models import Gallery, Image, bump_index_version
+from .services import FSImagesProvider, ShowMode
+
+
+class SyncGalleryTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.tmpdir_path = Path(self.tmpdir.name)
+        for name in ("1.jpg", "2_.jpg", "3.png"):
+            (self.tmpdir_path / name).touch()
+        self.gallery = Gallery.objects.create(title="gallery", slug="gallery",
+                                              dir_path=self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def rows(self) -> dict[str, bool]:
+        return dict(Image.objects.filter(gallery=self.gallery).values_list("name", "marked"))
+
+    def test_sync(self):
+        result = sync_gallery(self.gallery)
+        self.assertEqual(tuple(result), (3, 0, 0))
+        self.assertDictEqual(self.rows(), {"1.jpg": False, "2_.jpg": True, "3.png": False})
+
+        # nothing changed
+        self.assertEqual(tuple(sync_gallery(self.gallery)), (0, 0, 0))
+
+        (self.tmpdir_path / "1.jpg").write_bytes(b"data")
+        (self.tmpdir_path / "3.png").unlink()
+        (self.tmpdir_path / "4.gif").touch()
+        self.assertEqual(tuple(sync_gallery(self.gallery, batch_size=1)), (1, 1, 1))
+        self.assertDictEqual(self.rows(), {"1.jpg": False, "2_.jpg": True, "4.gif": False})
+        self.assertEqual(Image.objects.get(gallery=self.gallery, name="1.jpg").size, 4)
+
+    def test_command(self):
+        with open(os.devnull, "w") as devnull:
+            call_command("sync_galleries", "gallery", stdout=devnull)
+        self.assertEqual(len(self.rows()), 3)
+
+    @override_settings(IMAGE_PICKER_USE_IMAGES_INDEX=True)
+    def test_provider_reads_index(self):
+        provider = FSImagesProvider(self.gallery)
+        self.assertListEqual(provider.get_images(ShowMode.ALL), [])
+
+        sync_gallery(self.gallery)
+        self.assertSetEqual({i.name for i in provider.get_images(ShowMode.UNMARKED)},
+                            {"1.jpg", "3.png"})
+        page = provider.get_page(ShowMode.ALL, limit=10)
+        self.assertEqual(len(page["results"]), 3)
+
+        # changes made through provider are applied to index
+        provider.mark_image("1.jpg")
+        provider.delete_image("3.png")
+        self.assertDictEqual(self.rows(), {"1_.jpg": True, "2_.jpg": True})
+        self.assertEqual(len(provider.get_page(ShowMode.ALL, limit=10)["results"]), 2)
+
+    @override_settings(IMAGE_PICKER_USE_IMAGES_INDEX=True)
+    def test_in_place_change_by_other_process(self):
+        sync_gallery(self.gallery)
+        provider = FSImagesProvider(self.gallery)
+        self.assertEqual(len(provider.get_page(ShowMode.UNMARKED, limit=10)["results"]), 2)
+
+        # marking in another worker renames the row keeping its pk, count and mod_time
+        Image.objects.filter(gallery=self.gallery, name="1.jpg").update(name="1_.jpg", marked=True)
+        bump_index_version(self.gallery.pk)
+        names = [image.name for image in provider.get_page(ShowMode.UNMARKED, limit=10)["results"]]
+        self.assertListEqual(names, ["3.png"])
+
+        # validating the cached listing doesn't read its images
+        with self.assertNumQueries(1):
+            provider.get_page(ShowMode.UNMARKED, limit=10)
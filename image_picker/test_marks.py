@@ -0,0 +1,127 @@
+import os
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase, override_settings
+
+from .marks import MarkMode, MarkStore, get_mark_store
+from .models import Gallery
+from .services import FSImagesProvider, ShowMode, SortKey, images_index_cache
+
+
+class MarkStoreTestCase(TestCase):
+
+    def test_other_connection_writes(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "gallery.sqlite3"
+            store, other = MarkStore(path), MarkStore(path)
+            try:
+                store.set(["a.jpg", "b.jpg"])
+                version, names = other.snapshot()
+                self.assertEqual(names, {"a.jpg", "b.jpg"})
+
+                store.set(["a.jpg"], False)
+                # other process' commit is seen through data_version
+                self.assertNotEqual(other.snapshot()[0], version)
+                self.assertFalse(other.is_marked("a.jpg"))
+                self.assertTrue(other.is_marked("b.jpg"))
+            finally:
+                store.close()
+                other.close()
+
+
+class SidecarMarksTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.marks_dir = TemporaryDirectory()
+        self.settings_override = override_settings(IMAGE_PICKER_MARKS_DIR=self.marks_dir.name)
+        self.settings_override.enable()
+        self.dirpath = Path(self.tmpdir.name)
+        for name in ("a.jpg", "b_.jpg", "c.jpg", "c_.jpg"):
+            (self.dirpath / name).touch()
+        os.utime(self.dirpath, (0, 0))
+        self.gallery = Gallery.objects.create(title="gallery", slug="gallery", dir_path=self.tmpdir.name,
+                                              mark_mode=MarkMode.SIDECAR)
+        images_index_cache.invalidate("gallery")
+
+    def tearDown(self) -> None:
+        get_mark_store("gallery").close()
+        self.settings_override.disable()
+        self.tmpdir.cleanup()
+        self.marks_dir.cleanup()
+
+    def names(self, show_mode) -> list[str]:
+        return sorted(image.name for image in FSImagesProvider(self.gallery).get_images(show_mode))
+
+    def test_joined_index_counted(self):
+        provider = FSImagesProvider(self.gallery)
+        provider.mark_image("a.jpg")
+        joined = provider.get_index()
+        scanned = provider.get_scanned_index()
+        # the scan and the joined listing
+        self.assertEqual(scanned.charged, 8)
+
+        joined.sorted_view(SortKey.NAME, ShowMode.ALL)
+        self.assertEqual(scanned.charged, 12)
+        total = images_index_cache.total_images
+        # evicted together
+        images_index_cache.invalidate("gallery")
+        self.assertEqual(images_index_cache.total_images, total - 12)
+        self.assertIsNot(provider.get_index(), joined)
+
+    def test_mark_without_rename(self):
+        provider = FSImagesProvider(self.gallery)
+        # suffixes mean nothing in sidecar mode
+        self.assertListEqual(self.names(ShowMode.MARKED), [])
+        scanned = provider.get_scanned_index()
+
+        image = provider.mark_image("a.jpg")
+        self.assertEqual((image.name, image.marked), ("a.jpg", True))
+        self.assertTrue((self.dirpath / "a.jpg").exists())
+        self.assertEqual(self.dirpath.stat().st_mtime, 0)
+        self.assertListEqual(self.names(ShowMode.MARKED), ["a.jpg"])
+        self.assertListEqual([i.name for i in FSImagesProvider(self.gallery).iter_images(ShowMode.MARKED)],
+                             ["a.jpg"])
+        # the scan is reused, only marks are joined again
+        self.assertIs(provider.get_scanned_index(), scanned)
+        self.assertIs(provider.get_index(), provider.get_index())
+
+        provider.mark_image("a.jpg", False)
+        self.assertListEqual(self.names(ShowMode.MARKED), [])
+
+        provider.mark_image("c.jpg")
+        provider.delete_image("c.jpg")
+        self.assertFalse(get_mark_store("gallery").is_marked("c.jpg"))
+
+    def test_convert(self):
+        self.gallery.mark_mode = MarkMode.SUFFIX
+        self.gallery.save()
+        provider = FSImagesProvider(self.gallery)
+
+        result = provider.convert_marks(MarkMode.SIDECAR)
+        self.assertEqual(result.converted, 1)
+        # c.jpg is taken, c_.jpg keeps its name but stays marked
+        self.assertListEqual(result.conflicts, ["c_.jpg"])
+        self.assertEqual(Gallery.objects.get(pk="gallery").mark_mode, MarkMode.SIDECAR)
+        self.assertListEqual(sorted(os.listdir(self.dirpath)), ["a.jpg", "b.jpg", "c.jpg", "c_.jpg"])
+        self.assertListEqual(self.names(ShowMode.MARKED), ["b.jpg", "c_.jpg"])
+
+        provider.mark_image("a.jpg")
+        out, err = StringIO(), StringIO()
+        call_command("convert_marks", "gallery", "--to", MarkMode.SUFFIX, stdout=out, stderr=err)
+        self.assertIn("gallery: 2 converted", out.getvalue())
+        self.gallery.refresh_from_db()
+        self.assertEqual(self.gallery.mark_mode, MarkMode.SUFFIX)
+        self.assertListEqual(sorted(os.listdir(self.dirpath)), ["a_.jpg", "b_.jpg", "c.jpg", "c_.jpg"])
+        self.assertListEqual(self.names(ShowMode.MARKED), ["a_.jpg", "b_.jpg", "c_.jpg"])
+        self.assertEqual(get_mark_store("gallery").names(), set())
+
+    @override_settings(IMAGE_PICKER_GALLERY_CACHE=None, IMAGE_PICKER_GALLERY_REGISTRY_TTL=None)
+    def test_convert_needs_visible_mode_switch(self):
+        # running workers would keep marking the old way
+        with self.assertRaises(CommandError):
+            call_command("convert_marks", "gallery", "--to", MarkMode.SUFFIX, stdout=StringIO())
+        self.assertEqual(Gallery.objects.get(pk="gallery").mark_mode, MarkMode.SIDECAR)
@@ -0,0 +1,153 @@
+import os
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+from PIL import Image
+
+from . import metadata
+from .imaging import EXIF_DATETIME_ORIGINAL, EXIF_IFD, EXIF_ORIENTATION, read_metadata
+from .metadata import ImageMeta, MetadataFilter, get_metadata_index, update_metadata
+from .models import Gallery, ImageMetadata
+from .services import FSImagesProvider, ShowMode, images_index_cache
+
+
+class MetadataTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        self.dirpath = Path(self.tmp_dir.name)
+
+        exif = Image.Exif()
+        exif.get_ifd(EXIF_IFD)[EXIF_DATETIME_ORIGINAL] = "2020:01:02 03:04:05"
+        # stored sideways, displayed portrait
+        exif[EXIF_ORIENTATION] = 6
+        Image.new("RGB", (40, 30)).save(self.dirpath / "photo.jpg", exif=exif)
+        Image.new("RGB", (64, 48)).save(self.dirpath / "wide.png")
+        Image.new("RGB", (20, 20)).save(self.dirpath / "square_.gif")
+        (self.dirpath / "broken.jpg").write_bytes(b"not an image")
+
+        mtime = time.time() - 60
+        os.utime(self.dirpath, (mtime, mtime))
+        self.gallery = Gallery.objects.create(title="meta", slug="meta", dir_path=self.tmp_dir.name)
+        images_index_cache.invalidate("meta")
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_read_metadata(self):
+        self.assertEqual(read_metadata(str(self.dirpath / "photo.jpg")),
+                         (30, 40, "JPEG", 1577934245000.0))
+        self.assertEqual(read_metadata(str(self.dirpath / "wide.png")), (64, 48, "PNG", None))
+
+    def test_update_metadata(self):
+        provider = FSImagesProvider(self.gallery)
+        result = update_metadata(self.gallery, provider.get_images(ShowMode.ALL))
+        self.assertEqual(result.read, 4)
+        broken = ImageMetadata.objects.get(gallery=self.gallery, name="broken.jpg")
+        self.assertIsNone(broken.width)
+        self.assertEqual(update_metadata(self.gallery, provider.get_images(ShowMode.ALL)).read, 0)
+
+        provider.mark_image("wide.png")
+        result = update_metadata(self.gallery, provider.get_images(ShowMode.ALL))
+        self.assertEqual((result.read, result.renamed, result.deleted), (0, 1, 0))
+        self.assertEqual(ImageMetadata.objects.get(gallery=self.gallery, name="wide_.png").width, 64)
+
+        # modified image is read again
+        Image.new("RGB", (10, 80)).save(self.dirpath / "photo.jpg")
+        os.utime(self.dirpath / "photo.jpg", (time.time() + 5, time.time() + 5))
+        provider.invalidate_index()
+        self.assertEqual(update_metadata(self.gallery, provider.get_images(ShowMode.ALL)).read, 1)
+        self.assertEqual(ImageMetadata.objects.get(gallery=self.gallery, name="photo.jpg").height, 80)
+
+    def test_concurrent_writer(self):
+        provider = FSImagesProvider(self.gallery)
+        update_metadata(self.gallery, provider.get_images(ShowMode.ALL))
+        provider.mark_image("wide.png")
+        (self.dirpath / "new.png").write_bytes(b"not an image")
+        provider.invalidate_index()
+        images = provider.get_images(ShowMode.ALL)
+        plan_derived_rows = metadata.plan_derived_rows
+
+        def plan_and_race(stored, images):
+            plan = plan_derived_rows(stored, images)
+            # another process stores the new image and the renamed one meanwhile
+            for name in ("new.png", "wide_.png"):
+                ImageMetadata.objects.create(gallery=self.gallery, name=name, mod_time=0, format="PNG")
+            return plan
+
+        with mock.patch.object(metadata, "plan_derived_rows", plan_and_race):
+            update_metadata(self.gallery, images)
+        self.assertEqual(ImageMetadata.objects.filter(gallery=self.gallery).count(), 5)
+        self.assertEqual(ImageMetadata.objects.get(gallery=self.gallery, name="wide_.png").width, 64)
+
+    def test_index(self):
+        index = get_metadata_index(self.gallery)
+        self.assertIs(get_metadata_index(self.gallery), index)
+        self.assertEqual(index.get("wide.png"), ImageMeta(64, 48, "PNG", None))
+
+        self.assertListEqual(
+            [i.name for i in index.filter(ShowMode.ALL, MetadataFilter(orientation="portrait"))],
+            ["photo.jpg"]
+        )
+        self.assertListEqual(
+            [i.name for i in index.page(ShowMode.ALL, "pixels", "desc", limit=10)["results"]],
+            ["wide.png", "photo.jpg", "square_.gif", "broken.jpg"]
+        )
+        page = index.page(ShowMode.ALL, "width", limit=2, filters=MetadataFilter(min_width=15))
+        self.assertListEqual([i.name for i in page["results"]], ["square_.gif", "photo.jpg"])
+        page = index.page(ShowMode.ALL, "width", cursor=page["next"], limit=2,
+                          filters=MetadataFilter(min_width=15))
+        self.assertListEqual([i.name for i in page["results"]], ["wide.png"])
+        self.assertIsNone(page["next"])
+
+    def test_carried_over_listing_changes(self):
+        index = get_metadata_index(self.gallery)
+        index.page(ShowMode.ALL, "width", limit=10)
+        provider = FSImagesProvider(self.gallery)
+        provider.mark_image("wide.png")
+        provider.delete_image("broken.jpg")
+        # marks and deletions are applied without reading stored metadata
+        with self.assertNumQueries(0):
+            rebased = get_metadata_index(self.gallery)
+        self.assertIsNot(rebased, index)
+        self.assertEqual(rebased.get("wide_.png"), ImageMeta(64, 48, "PNG", None))
+        self.assertNotIn("broken.jpg", rebased.meta)
+        self.assertListEqual([i.name for i in rebased.page(ShowMode.ALL, "width", limit=10)["results"]],
+                             ["square_.gif", "photo.jpg", "wide_.png"])
+
+        # new images are read, stored rows catch up with the renames then
+        Image.new("RGB", (8, 8)).save(self.dirpath / "new.png")
+        provider.invalidate_index()
+        self.assertEqual(get_metadata_index(self.gallery).get("new.png").width, 8)
+        self.assertSetEqual(set(ImageMetadata.objects.filter(gallery=self.gallery).values_list("name", flat=True)),
+                            {"photo.jpg", "wide_.png", "square_.gif", "new.png"})
+
+    def test_images_view(self):
+        url = reverse("images", args=["meta"])
+        resp = self.client.get(url, {"metadata": 1})
+        self.assertEqual(resp.status_code, 200)
+        rows = {row["name"]: row for row in resp.json()}
+        self.assertSetEqual(set(rows), {"photo.jpg", "wide.png", "broken.jpg"})
+        self.assertEqual(rows["photo.jpg"]["taken_at"], 1577934245000.0)
+        self.assertEqual(rows["wide.png"]["format"], "PNG")
+
+        resp = self.client.get(url, {"image_format": "png", "show_mode": "all", "layout": "columns"})
+        self.assertListEqual(resp.json()["names"], ["wide.png"])
+        self.assertListEqual(resp.json()["widths"], [64])
+
+        resp = self.client.get(url, {"sort": "taken_at", "order": "desc", "limit": 1})
+        data = resp.json()
+        self.assertEqual(len(data["results"]), 1)
+        self.assertIsNotNone(data["next"])
+
+        resp = self.client.get(url, {"orientation": "round"})
+        self.assertEqual(resp.status_code, 400)
+
+    def test_command(self):
+        call_command("extract_metadata", "meta", stdout=open(os.devnull, "w"))
+        self.assertEqual(ImageMetadata.objects.filter(gallery=self.gallery).count(), 4)
@@ -0,0 +1,82 @@
+import tempfile
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .metrics import Counter, Histogram, phase_duration, timed
+from .models import Gallery
+
+
+@override_settings(IMAGE_PICKER_METRICS=True)
+class MetricsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        for name in ("1.jpg", "2_.jpg"):
+            (Path(self.tmp_dir.name) / name).write_bytes(b"12345")
+        Gallery.objects.create(title="metrics", slug="metrics", dir_path=self.tmp_dir.name)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "test", buckets=(0.1, 1.0))
+        histogram.observe(0.05, phase="a")
+        histogram.observe(0.5, phase="a")
+        histogram.observe(5, phase="a")
+        lines = list(histogram.render())
+
+        self.assertIn("# TYPE test_seconds histogram", lines)
+        self.assertIn('test_seconds_bucket{phase="a",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{phase="a",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{phase="a",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{phase="a"} 3', lines)
+
+        counter = Counter("test_total", "test")
+        counter.inc(2)
+        counter.inc(3)
+        self.assertIn("test_total 5", list(counter.render()))
+
+    def test_server_timing(self):
+        resp = self.client.get(reverse("images", args=["metrics"]) + "?show_mode=all")
+        self.assertEqual(resp.status_code, 200)
+        timing = resp["Server-Timing"]
+        for phase in ("gallery;dur=", "serialize;dur=", "render;dur=", "total;dur="):
+            self.assertIn(phase, timing)
+
+        resp = self.client.get(reverse("get-image", args=["metrics", "1.jpg"]))
+        self.assertIn('bytes;desc="5"', resp["Server-Timing"])
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse("images", args=["metrics"]))
+        resp = self.client.get(reverse("metrics"))
+        self.assertEqual(resp.status_code, 200)
+        body = resp.content.decode()
+        self.assertIn('image_picker_request_duration_seconds_count{view="images"}', body)
+        self.assertIn('image_picker_phase_duration_seconds_bucket{phase="gallery",le="+Inf"}', body)
+        self.assertIn("image_picker_bytes_served_total", body)
+
+        with override_settings(IMAGE_PICKER_METRICS=False):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+            resp = self.client.get(reverse("images", args=["metrics"]))
+            self.assertNotIn("Server-Timing", resp)
+
+    def test_metrics_access(self):
+        with override_settings(IMAGE_PICKER_METRICS_ALLOWED_IPS=[], IMAGE_PICKER_METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+            resp = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong")
+            self.assertEqual(resp.status_code, 403)
+            resp = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(resp.status_code, 200)
+
+            User.objects.create_user("staff", password="pass", is_staff=True)
+            self.client.login(username="staff", password="pass")
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 200)
+
+    def test_disabled_skips_histograms(self):
+        with override_settings(IMAGE_PICKER_METRICS=False):
+            with timed("disabled_phase"):
+                pass
+        self.assertNotIn('phase="disabled_phase"', "\n".join(phase_duration.render()))
@@ -0,0 +1,66 @@
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from .models import Gallery, Image
+from .registration import discover_directories, register_galleries
+from .registry import GalleryRegistry, gallery_registry
+
+
+class RegisterGalleriesTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.root = Path(self.tmpdir.name)
+        for name in ("Summer 2020/a.jpg", "Summer 2020/b_.png", "summer-2020/c.jpg",
+                     "empty/notes.txt", ".hidden/d.jpg", "nested/deep/e.jpg", "taken/f.jpg"):
+            path = self.root / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        Gallery.objects.create(title="taken", slug="taken", dir_path=str(self.root / "taken"))
+        Gallery.objects.create(title="other", slug="nested", dir_path="/")
+        gallery_registry.galleries()
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_discover(self):
+        names = [path.relative_to(self.root.resolve()).as_posix()
+                 for path in discover_directories([self.root], depth=2)]
+        self.assertListEqual(names, ["nested/deep"])
+
+    def test_register(self):
+        result = register_galleries([self.root], warm_index=True)
+        self.assertListEqual(sorted(g.slug for g in result.created), ["summer-2020", "summer-2020-2"])
+        self.assertEqual(result.images, 3)
+        self.assertEqual(result.skipped[str(self.root.resolve() / "taken")], "already registered")
+        self.assertEqual(result.skipped[str(self.root.resolve() / "empty")], "0 images")
+        # images of subdirectories count only for recursive galleries
+        self.assertEqual(result.skipped[str(self.root.resolve() / "nested")], "0 images")
+
+    def test_command(self):
+        # registry of a running web worker
+        worker_registry = GalleryRegistry("default")
+        self.assertNotIn("summer-2020", worker_registry.galleries())
+        out = StringIO()
+        call_command("register_galleries", str(self.root), "--recursive", "--warm-index", stdout=out)
+        self.assertIn("3 galleries registered, 4 images indexed, 2 directories skipped", out.getvalue())
+        gallery = Gallery.objects.get(slug="nested-2")
+        self.assertTrue(gallery.recursive)
+        self.assertListEqual(list(gallery.images.values_list("name", flat=True)), ["deep/e.jpg"])
+        self.assertIn("summer-2020-2", gallery_registry.galleries())
+        self.assertIn("summer-2020-2", worker_registry.galleries())
+
+        out = StringIO()
+        call_command("register_galleries", str(self.root), "--dry-run", stdout=out)
+        self.assertIn("0 galleries would be registered", out.getvalue())
+        self.assertEqual(Image.objects.count(), 4)
+
+    @override_settings(IMAGE_PICKER_GALLERY_CACHE=None, IMAGE_PICKER_GALLERY_REGISTRY_TTL=None)
+    def test_warns_without_shared_registry(self):
+        err = StringIO()
+        call_command("register_galleries", str(self.root), stdout=StringIO(), stderr=err)
+        self.assertIn("won't see new galleries until restarted", err.getvalue())
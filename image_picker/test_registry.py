@@ -0,0 +1,67 @@
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from .models import Gallery
+from .registry import GalleryRegistry, gallery_registry
+
+
+class GalleryRegistryTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.gallery = Gallery.objects.create(title="reg", slug="reg", dir_path=self.tmp_dir.name)
+
+    def tearDown(self) -> None:
+        self.tmp_dir.cleanup()
+
+    def test_cached_lookup(self):
+        gallery_registry.invalidate()
+        self.assertEqual(gallery_registry.get("reg"), self.gallery)
+        with self.assertNumQueries(0):
+            self.assertEqual(gallery_registry.get("reg"), self.gallery)
+            self.assertIsNone(gallery_registry.get("not_exists"))
+
+    def test_invalidated_by_signals(self):
+        self.assertEqual(gallery_registry.get("reg").title, "reg")
+
+        self.gallery.title = "renamed"
+        self.gallery.save()
+        self.assertEqual(gallery_registry.get("reg").title, "renamed")
+
+        self.gallery.delete()
+        self.assertIsNone(gallery_registry.get("reg"))
+
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_shared_cache(self):
+        caches["default"].clear()
+        first, second = GalleryRegistry("default"), GalleryRegistry("default")
+
+        self.assertIn("reg", first.galleries())
+        # the other process takes galleries from the shared cache
+        with self.assertNumQueries(0):
+            self.assertIn("reg", second.galleries())
+
+        Gallery.objects.filter(pk="reg").delete()
+        first.invalidate()
+        self.assertNotIn("reg", second.galleries())
+
+    def test_tests_cache_isolated(self):
+        location = str(caches["default"]._dir)
+        self.assertNotEqual(Path(location), settings.BASE_DIR / "cache" / "django")
+
+    @override_settings(IMAGE_PICKER_GALLERY_CACHE=None, IMAGE_PICKER_GALLERY_REGISTRY_TTL=60)
+    def test_ttl_without_shared_cache(self):
+        registry = GalleryRegistry()
+        self.assertFalse(registry.shared)
+        self.assertIn("reg", registry.galleries())
+
+        # deleted by another process, nothing tells this one
+        Gallery.objects.filter(pk="reg").delete()
+        self.assertIn("reg", registry.galleries())
+        registry._loaded_at -= 60
+        self.assertIsNone(registry.peek())
+        self.assertNotIn("reg", registry.galleries())
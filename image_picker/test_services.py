@@ -1,12 +1,19 @@
 import os
+import shutil
+import time
 from tempfile import TemporaryDirectory
 from pathlib import Path
 from typing import Dict, cast
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 from django.contrib.sessions.backends.base import SessionBase
 from django.test import TestCase
+from django.urls import reverse
+from . import services
+from .models import Gallery
 from .services import (PickerSettings, ShowMode, DEFAULT_SHOW_MODE, SETTINGS_SESSION_KEY,
-                       FSImagesProvider, is_file_marked)
+                       FSImagesProvider, is_file_marked, ImagesIndexCache, GalleryIndex,
+                       parse_image_name, iter_images, natural_key, SortKey, SortOrder,
+                       ImagesException, ImageInfo, ImagesTree, DerivedData, images_index_cache)
 
 
 class PickerSettingsTestCase(TestCase):
@@ -98,7 +105,7 @@ class FSImageProviderTestCase(TestCase):
 
         # test get all images
         provider = FSImagesProvider(gallery)
-        images = {Path(i["name"]).name for i in provider.get_images(ShowMode.ALL)}
+        images = {Path(i.name).name for i in provider.get_images(ShowMode.ALL)}
         self.assertSetEqual(
             filenames,
             images,
@@ -106,7 +113,7 @@ class FSImageProviderTestCase(TestCase):
         )
         
         # test get unmarked
-        images = {Path(i["name"]).name for i in provider.get_images(ShowMode.UNMARKED)}
+        images = {Path(i.name).name for i in provider.get_images(ShowMode.UNMARKED)}
         self.assertSetEqual(
             {f for f in filenames if not is_file_marked(f)},
             images,
@@ -114,13 +121,45 @@ class FSImageProviderTestCase(TestCase):
         )
 
         # test get marked
-        images = {Path(i["name"]).name for i in provider.get_images(ShowMode.MARKED)}
+        images = {Path(i.name).name for i in provider.get_images(ShowMode.MARKED)}
         self.assertSetEqual(
             {f for f in filenames if is_file_marked(f)},
             images,
             "MARKED NOT equal"
         )
     
+    def test_iter_images(self):
+        with TemporaryDirectory() as tmpdir:
+            tmpdir_path = Path(tmpdir)
+            for f in ("a.jpg", "b_.PNG", ".hidden.jpg", "noext", "c.txt"):
+                (tmpdir_path / f).touch()
+            (tmpdir_path / "dir.jpg").mkdir()
+
+            images = {i.name: i for i in iter_images(tmpdir_path)}
+            self.assertSetEqual({"a.jpg", "b_.PNG"}, set(images))
+            self.assertFalse(images["a.jpg"].marked)
+            self.assertTrue(images["b_.PNG"].marked)
+            self.assertEqual(
+                images["a.jpg"].mod_time,
+                FSImagesProvider.get_mod_time(tmpdir_path / "a.jpg")
+            )
+
+            gallery = Mock()
+            gallery.dir_path = tmpdir
+            provider = FSImagesProvider(gallery)
+            self.assertListEqual(
+                [i.name for i in provider.iter_images(ShowMode.MARKED)],
+                ["b_.PNG"]
+            )
+
+    def test_parse_image_name(self):
+        self.assertFalse(parse_image_name("1.jpg"))
+        self.assertTrue(parse_image_name("1_.JPEG"))
+        self.assertTrue(parse_image_name("_.webp"))
+        self.assertIsNone(parse_image_name(".jpg"))
+        self.assertIsNone(parse_image_name("1.bmp"))
+        self.assertIsNone(parse_image_name("jpg"))
+
     def test_get_mod_time(self):
         filename = "mod_time.jpg"
         self.touch_file(filename)
@@ -151,4 +190,247 @@ class FSImageProviderTestCase(TestCase):
         provider = FSImagesProvider(gallery)
         provider.mark_image(oldfile.name, mark=False)
         self.assertFalse(oldfile.exists(), "OLD FILE STILL EXISTS")
-        self.assertTrue(newfile.exists(), "MARK FILE DOESNT EXIST")
\ No newline at end of file
+        self.assertTrue(newfile.exists(), "MARK FILE DOESNT EXIST")
+
+class ImagesIndexCacheTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.tmpdir_path = Path(self.tmpdir.name)
+        self.loads = 0
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def set_dir_mtime(self, seconds_ago:int) -> None:
+        mtime_ns = time.time_ns() - seconds_ago * 1_000_000_000
+        os.utime(self.tmpdir_path, ns=(mtime_ns, mtime_ns))
+
+    def loader(self):
+        self.loads += 1
+        return [ImageInfo("1.jpg", False, 1.0)]
+
+    def test_cached_until_dir_changes(self):
+        cache = ImagesIndexCache(100)
+        self.set_dir_mtime(60)
+
+        index = cache.get("gallery", self.tmpdir_path, self.loader)
+        self.assertIs(cache.get("gallery", self.tmpdir_path, self.loader), index)
+        self.assertEqual(self.loads, 1)
+
+        # directory changed
+        self.set_dir_mtime(30)
+        self.assertIsNot(cache.get("gallery", self.tmpdir_path, self.loader), index)
+        self.assertEqual(self.loads, 2)
+
+        # explicit invalidation
+        cache.invalidate("gallery")
+        cache.get("gallery", self.tmpdir_path, self.loader)
+        self.assertEqual(self.loads, 3)
+
+    def test_racy_index_rescanned(self):
+        cache = ImagesIndexCache(100)
+        self.set_dir_mtime(0)
+
+        cache.get("gallery", self.tmpdir_path, self.loader)
+        cache.get("gallery", self.tmpdir_path, self.loader)
+        self.assertEqual(self.loads, 2)
+
+    def test_lru_eviction(self):
+        cache = ImagesIndexCache(2)
+        images = [ImageInfo("1.jpg", False, 1.0)]
+        for key in ("a", "b", "c"):
+            cache.put(key, GalleryIndex(self.tmpdir_path, 0, list(images)))
+
+        self.assertNotIn("a", cache)
+        self.assertIn("b", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.total_images, 2)
+
+    def test_sorted_views_counted(self):
+        cache = ImagesIndexCache(5)
+        images = [ImageInfo("1.jpg", False, 1.0), ImageInfo("2_.jpg", True, 2.0)]
+        for key in ("a", "b"):
+            cache.put(key, GalleryIndex(self.tmpdir_path, 0, list(images)))
+        self.assertEqual(cache.total_images, 4)
+
+        # views are about as large as the images they list
+        index = cache.peek("a")
+        index.sorted_view(SortKey.MOD_TIME, ShowMode.UNMARKED)
+        self.assertEqual(cache.total_images, 5)
+        index.sorted_view(SortKey.MOD_TIME, ShowMode.UNMARKED)
+        self.assertEqual(cache.total_images, 5)
+        # the index used last stays
+        index.sorted_view(SortKey.NAME, ShowMode.ALL)
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertEqual(cache.total_images, 5)
+
+        cache.invalidate("a")
+        self.assertEqual(cache.total_images, 0)
+
+    def test_derived_data_carried_over(self):
+        class Carried(DerivedData):
+            carried_over = True
+            def __len__(self):
+                return 3
+
+        cache = ImagesIndexCache(10)
+        images = [ImageInfo("1.jpg", False, 1.0)]
+        index = GalleryIndex(self.tmpdir_path, 0, list(images))
+        cache.put("a", index)
+        carried = Carried()
+        index.attach("carried", carried)
+        index.attach("dropped", GalleryIndex(self.tmpdir_path, 0, list(images)))
+        self.assertEqual(cache.total_images, 5)
+
+        # kept for the next listing only
+        cache.invalidate("a")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.total_images, 3)
+        rescanned = GalleryIndex(self.tmpdir_path, 1, list(images))
+        cache.put("a", rescanned)
+        self.assertDictEqual(rescanned.derived, {"carried": carried})
+        self.assertEqual(cache.total_images, 4)
+
+        # and evicted with it
+        cache.put("b", GalleryIndex(self.tmpdir_path, 0, [ImageInfo(f"{i}.jpg", False, 1.0) for i in range(8)]))
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.total_images, 8)
+
+
+class GalleryIndexPageTestCase(TestCase):
+
+    def setUp(self) -> None:
+        names = ["img10.jpg", "img2.jpg", "img1_.jpg", "Img3.jpg", "img20.jpg"]
+        self.index = GalleryIndex(Path("/"), 0, [
+            ImageInfo(name, name.endswith("_.jpg"), float(i))
+            for i, name in enumerate(names)
+        ])
+
+    def collect(self, **kwargs) -> list[str]:
+        names: list[str] = []
+        cursor = None
+        while True:
+            page = self.index.page(cursor=cursor, limit=2, **kwargs)
+            names += [i.name for i in page["results"]]
+            cursor = page["next"]
+            if not cursor:
+                return names
+
+    def test_natural_key(self):
+        self.assertLess(natural_key("img2.jpg"), natural_key("img10.jpg"))
+        self.assertLess(natural_key("1.jpg"), natural_key("a.jpg"))
+
+    def test_pages(self):
+        self.assertListEqual(
+            self.collect(show_mode=ShowMode.ALL, sort=SortKey.MOD_TIME),
+            ["img10.jpg", "img2.jpg", "img1_.jpg", "Img3.jpg", "img20.jpg"]
+        )
+        self.assertListEqual(
+            self.collect(show_mode=ShowMode.UNMARKED, sort=SortKey.MOD_TIME, order=SortOrder.DESC),
+            ["img20.jpg", "Img3.jpg", "img2.jpg", "img10.jpg"]
+        )
+        self.assertListEqual(
+            self.collect(show_mode=ShowMode.ALL, sort=SortKey.NAME),
+            ["Img3.jpg", "img10.jpg", "img1_.jpg", "img2.jpg", "img20.jpg"]
+        )
+        self.assertListEqual(
+            self.collect(show_mode=ShowMode.UNMARKED, sort=SortKey.NATURAL, order=SortOrder.DESC),
+            ["img20.jpg", "img10.jpg", "Img3.jpg", "img2.jpg"]
+        )
+
+    def test_sorted_view_reused(self):
+        view = self.index.sorted_view(SortKey.NATURAL, ShowMode.ALL)
+        self.assertIs(self.index.sorted_view(SortKey.NATURAL, ShowMode.ALL), view)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ImagesException):
+            self.index.page(cursor="not a cursor")
+
+
+class RecursiveGalleryTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.tmpdir_path = Path(self.tmpdir.name)
+        for name in ("1.jpg", "a/2_.jpg", "a/b/3.jpg", "a/b/c/4.png", ".trash/5.jpg", "d/.6.jpg"):
+            path = self.tmpdir_path / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        self.outside = TemporaryDirectory()
+        (Path(self.outside.name) / "7.jpg").touch()
+        os.symlink(self.outside.name, self.tmpdir_path / "link")
+        self.settle()
+
+        self.gallery = Gallery.objects.create(title="tree", slug="tree", dir_path=self.tmpdir.name,
+                                              recursive=True)
+        images_index_cache.invalidate("tree")
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+        self.outside.cleanup()
+
+    def settle(self) -> None:
+        # directories modified a minute ago aren't racy
+        mtime_ns = time.time_ns() - 60 * 1_000_000_000
+        for dirpath, _, _ in os.walk(self.tmpdir_path):
+            os.utime(dirpath, ns=(mtime_ns, mtime_ns))
+
+    def names(self, provider:FSImagesProvider) -> set[str]:
+        return {i.name for i in provider.get_images(ShowMode.ALL)}
+
+    def test_get_images(self):
+        provider = FSImagesProvider(self.gallery)
+        expected = {"1.jpg", "a/2_.jpg", "a/b/3.jpg", "a/b/c/4.png"}
+        self.assertSetEqual(self.names(provider), expected)
+        self.assertSetEqual({i.name for i in provider.iter_images(ShowMode.ALL)}, expected)
+        self.assertSetEqual({i.name for i in provider.get_images(ShowMode.MARKED)}, {"a/2_.jpg"})
+
+        # flat galleries don't see subdirectories
+        self.gallery.recursive = False
+        self.assertSetEqual(self.names(FSImagesProvider(self.gallery)), {"1.jpg"})
+
+    def test_tree_rescans_changed_directories(self):
+        tree = ImagesTree(self.tmpdir_path)
+        tree.refresh()
+        self.assertEqual(len(tree.images()), 4)
+
+        with patch.object(services, "scan_directory", wraps=services.scan_directory) as scan:
+            token = tree.refresh()
+            self.assertEqual(tree.refresh(), token)
+            scan.assert_not_called()
+
+            (self.tmpdir_path / "a/b/8.jpg").touch()
+            (self.tmpdir_path / "a/b/e").mkdir()
+            (self.tmpdir_path / "a/b/e/9.jpg").touch()
+            self.assertNotEqual(tree.refresh(), token)
+            self.assertListEqual(sorted(call.args[1] for call in scan.call_args_list), ["a/b", "a/b/e"])
+
+        shutil.rmtree(self.tmpdir_path / "a/b")
+        tree.refresh()
+        self.assertListEqual([i.name for i in tree.images()], ["1.jpg", "a/2_.jpg"])
+
+    def test_check_parent(self):
+        provider = FSImagesProvider(self.gallery)
+        self.assertTrue(provider.check_parent("1.jpg"))
+        self.assertTrue(provider.check_parent("a/b/3.jpg"))
+        for name in ("../1.jpg", "a/../../1.jpg", ".trash/5.jpg", "a//2_.jpg", "/etc/passwd",
+                     "link/7.jpg", "a\\..\\1.jpg"):
+            self.assertFalse(provider.check_parent(name), name)
+
+    def test_mark_and_delete(self):
+        provider = FSImagesProvider(self.gallery)
+        self.names(provider)
+
+        image = provider.mark_image("a/b/3.jpg")
+        self.assertEqual(image.name, "a/b/3_.jpg")
+        self.assertIn("a/b/3_.jpg", self.names(provider))
+
+        provider.delete_image("a/b/3_.jpg")
+        self.assertSetEqual(self.names(provider), {"1.jpg", "a/2_.jpg", "a/b/c/4.png"})
+
+        resp = self.client.get(reverse("images", args=["tree"]) + "?show_mode=all")
+        self.assertIn("/get-image/tree/a/b/c/4.png", {i["url"] for i in resp.json()})
+        self.assertEqual(self.client.get(reverse("get-image", args=["tree", "a/b/c/4.png"])).status_code, 200)
+        self.assertEqual(self.client.get(reverse("get-image", args=["tree", "link/7.jpg"])).status_code, 404)
@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import override_settings
+from rest_framework.test import APITestCase
+
+from .models import Gallery, UserPickerSettings
+from .registry import gallery_registry
+from .services import ShowMode
+from .settings_store import UserSettingsStore
+
+
+class SettingsStoreTestCase(APITestCase):
+
+    def setUp(self) -> None:
+        Gallery.objects.create(title="gallery", slug="gallery", dir_path="/")
+        # loads galleries now so validation below doesn't query them
+        gallery_registry.galleries()
+        cache.clear()
+
+    def save_and_load(self) -> dict:
+        resp = self.client.post("/settings/", {"selected_gallery": "gallery", "show_mode": ShowMode.ALL})
+        self.assertEqual(resp.status_code, 200)
+        return self.client.get("/settings/").json()
+
+    def test_stores(self):
+        for store in ("session", "signed-cookie", "cache", "user"):
+            with self.subTest(store=store), override_settings(IMAGE_PICKER_SETTINGS_STORE=store):
+                self.client.cookies.clear()
+                self.assertEqual(self.client.get("/settings/").json()["selected_gallery"], "")
+                self.assertDictEqual(self.save_and_load(),
+                                     {"selected_gallery": "gallery", "show_mode": ShowMode.ALL})
+
+    def test_no_database_reads(self):
+        for store in ("signed-cookie", "cache"):
+            with self.subTest(store=store), override_settings(IMAGE_PICKER_SETTINGS_STORE=store):
+                self.client.cookies.clear()
+                self.save_and_load()
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get("/settings/").json()["show_mode"], ShowMode.ALL)
+
+    def test_tampered_cookie(self):
+        with override_settings(IMAGE_PICKER_SETTINGS_STORE="signed-cookie"):
+            self.save_and_load()
+            self.client.cookies["picker_settings"] = self.client.cookies["picker_settings"].value[:-2]
+            self.assertEqual(self.client.get("/settings/").json()["selected_gallery"], "")
+
+    @override_settings(IMAGE_PICKER_SETTINGS_STORE="user")
+    def test_user_store(self):
+        user = get_user_model().objects.create_user("picker", password="secret")
+        self.client.force_login(user)
+        self.save_and_load()
+        self.assertEqual(UserPickerSettings.objects.get(user=user).show_mode, ShowMode.ALL)
+
+        request = self.client.get("/settings/").wsgi_request
+        # served from the cache written through on save
+        with self.assertNumQueries(0):
+            self.assertEqual(UserSettingsStore().load(request).selected_gallery, "gallery")
+
+        UserPickerSettings.objects.filter(user=user).delete()
+        UserPickerSettings.objects.create(user=user, selected_gallery="", show_mode=ShowMode.MARKED)
+        self.assertEqual(UserSettingsStore().load(request).show_mode, ShowMode.MARKED)
@@ -0,0 +1,56 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock
+
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from .services import FSImagesProvider
+from .thumbnails import get_thumbnail, get_source_cache_dir, ThumbnailException
+
+
+class ThumbnailsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.gallery_dir = TemporaryDirectory()
+        self.cache_dir = TemporaryDirectory()
+        self.override = override_settings(IMAGE_PICKER_THUMBNAIL_DIR=self.cache_dir.name)
+        self.override.enable()
+
+        self.image = Path(self.gallery_dir.name) / "image.png"
+        Image.new("RGB", (400, 200), "red").save(self.image)
+
+        self.gallery = Mock()
+        self.gallery.dir_path = self.gallery_dir.name
+
+    def tearDown(self) -> None:
+        self.override.disable()
+        self.gallery_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_get_thumbnail(self):
+        with override_settings(IMAGE_PICKER_THUMBNAIL_SIZES={"tiny": 100}):
+            thumb = get_thumbnail(self.image, "tiny")
+            with Image.open(thumb) as im:
+                self.assertEqual(im.size, (100, 50))
+                self.assertEqual(im.format, "WEBP")
+
+            # cached
+            self.assertEqual(get_thumbnail(self.image, "tiny"), thumb)
+
+            with self.assertRaises(ThumbnailException):
+                get_thumbnail(self.image, "huge")
+
+    def test_invalidated_on_mark_and_delete(self):
+        provider = FSImagesProvider(self.gallery)
+        image = provider.get_image_path(self.image.name)
+
+        get_thumbnail(image, "small")
+        self.assertTrue(get_source_cache_dir(image).exists())
+        marked = provider.mark_image(image.name)
+        self.assertFalse(get_source_cache_dir(image).exists())
+
+        marked_path = provider.get_image_path(marked.name)
+        get_thumbnail(marked_path, "small")
+        provider.delete_image(marked.name)
+        self.assertFalse(get_source_cache_dir(marked_path).exists())
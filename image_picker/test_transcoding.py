@@ -0,0 +1,114 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import Mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from .models import Gallery
+from .services import FSImagesProvider
+from .transcoding import (_pending, get_source_cache_dir, negotiate_format, negotiate_image,
+                          parse_accept, variants_cache)
+
+ACCEPT_WEBP = "image/webp,image/*,*/*;q=0.8"
+
+
+class TranscodingTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.gallery_dir = TemporaryDirectory()
+        self.cache_dir = TemporaryDirectory()
+        self.override = override_settings(
+            IMAGE_PICKER_TRANSCODE=True, IMAGE_PICKER_TRANSCODE_DIR=self.cache_dir.name,
+            IMAGE_PICKER_TRANSCODE_MIN_SIZE=0, IMAGE_PICKER_TRANSCODE_FORMATS=["webp"],
+        )
+        self.override.enable()
+
+        self.image = Path(self.gallery_dir.name) / "image.png"
+        # noise doesn't compress so png is big and webp is smaller
+        Image.frombytes("L", (256, 256), os.urandom(256 * 256)).convert("RGB").save(self.image)
+
+        self.gallery = Mock()
+        self.gallery.dir_path = self.gallery_dir.name
+
+    def tearDown(self) -> None:
+        self.override.disable()
+        self.gallery_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def wait_pending(self) -> None:
+        for future in list(_pending.values()):
+            future.result(timeout=30)
+
+    def test_negotiate_format(self):
+        self.assertEqual(parse_accept("image/avif;q=0.9, image/webp, */*;q=x"),
+                         {"image/avif": 0.9, "image/webp": 1.0, "*/*": 0.0})
+        with override_settings(IMAGE_PICKER_TRANSCODE_FORMATS=["avif", "webp"]):
+            self.assertEqual(negotiate_format("image/avif,image/webp").extension, "avif")
+            self.assertEqual(negotiate_format("image/avif;q=0,image/webp").extension, "webp")
+            self.assertIsNone(negotiate_format("image/*,*/*"))
+
+    def test_negotiate_image(self):
+        image = negotiate_image(self.image, ACCEPT_WEBP)
+        self.assertEqual(image.path, self.image)
+        self.assertTrue(image.pending)
+        self.wait_pending()
+
+        image = negotiate_image(self.image, ACCEPT_WEBP)
+        self.assertEqual(image.content_type, "image/webp")
+        self.assertFalse(image.pending)
+        with Image.open(image.path) as im:
+            self.assertEqual(im.format, "WEBP")
+
+        image = negotiate_image(self.image, "image/png")
+        self.assertEqual(image.path, self.image)
+        self.assertTrue(image.varies)
+
+        with override_settings(IMAGE_PICKER_TRANSCODE=False):
+            self.assertFalse(negotiate_image(self.image, ACCEPT_WEBP).varies)
+
+    def test_get_image(self):
+        Gallery.objects.create(title="gallery", slug="gallery", dir_path=self.gallery_dir.name)
+        url = reverse("get-image", args=["gallery", "image.png"])
+
+        resp = self.client.get(url, HTTP_ACCEPT=ACCEPT_WEBP)
+        self.assertEqual(resp["Content-Type"], "image/png")
+        self.assertEqual(resp["Vary"], "Accept")
+        self.assertEqual(resp["Cache-Control"], "private, no-cache")
+        self.wait_pending()
+
+        resp = self.client.get(url, HTTP_ACCEPT=ACCEPT_WEBP, HTTP_IF_NONE_MATCH=resp["ETag"])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp["Content-Type"], "image/webp")
+        self.assertLess(int(resp["Content-Length"]), self.image.stat().st_size)
+
+    def test_evict(self):
+        negotiate_image(self.image, ACCEPT_WEBP)
+        self.wait_pending()
+        variant_dir = get_source_cache_dir(self.image)
+        old = variant_dir.parent / "old" / "1-1-75.webp"
+        old.parent.mkdir()
+        size = next(variant_dir.iterdir()).stat().st_size
+        old.write_bytes(bytes(size))
+        os.utime(old, (0, 0))
+
+        # least recently used goes first
+        self.assertEqual(variants_cache.evict(max_bytes=size * 3 // 2), size)
+        self.assertFalse(old.parent.exists())
+        self.assertTrue(variant_dir.exists())
+
+    def test_moved_on_mark_and_removed_on_delete(self):
+        provider = FSImagesProvider(self.gallery)
+        image = provider.get_image_path(self.image.name)
+        negotiate_image(image, ACCEPT_WEBP)
+        self.wait_pending()
+
+        marked = provider.mark_image(image.name)
+        marked_path = provider.get_image_path(marked.name)
+        self.assertFalse(get_source_cache_dir(image).exists())
+        self.assertEqual(negotiate_image(marked_path, ACCEPT_WEBP).content_type, "image/webp")
+
+        provider.delete_image(marked.name)
+        self.assertFalse(get_source_cache_dir(marked_path).exists())
@@ -0,0 +1,130 @@
+import errno
+import os
+import time
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from .marks import MarkMode, get_mark_store
+from .models import Gallery
+from .services import FSImagesProvider, ShowMode, images_index_cache
+from .trash import TRASH_DIR, Trash
+
+
+@override_settings(IMAGE_PICKER_TRASH=True)
+class TrashTestCase(APITestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.dirpath = Path(self.tmpdir.name)
+        (self.dirpath / "sub").mkdir()
+        for name in ("a.jpg", "b_.jpg", "sub/c.jpg"):
+            (self.dirpath / name).write_bytes(b"x" * 10)
+        self.gallery = Gallery.objects.create(title="gallery", slug="gallery", dir_path=self.tmpdir.name,
+                                              recursive=True)
+        images_index_cache.invalidate("gallery")
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def names(self) -> list[str]:
+        images = FSImagesProvider(self.gallery).get_images(ShowMode.ALL)
+        return sorted(image.name for image in images)
+
+    def test_delete_and_restore(self):
+        provider = FSImagesProvider(self.gallery)
+        provider.delete_image("sub/c.jpg")
+        resp = self.client.post(reverse("delete-image", args=["gallery", "b_.jpg"]))
+        self.assertEqual(resp.status_code, 204)
+        self.assertListEqual(self.names(), ["a.jpg"])
+
+        resp = self.client.get(reverse("gallery-trash", args=["gallery"]))
+        entries = resp.data["results"]
+        self.assertListEqual([entry["name"] for entry in entries], ["sub/c.jpg", "b_.jpg"])
+        self.assertEqual(entries[0]["size"], 10)
+
+        url = reverse("restore-image", args=["gallery"])
+        resp = self.client.post(url, {"id": entries[0]["id"]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["name"], "sub/c.jpg")
+        self.assertListEqual(self.names(), ["a.jpg", "sub/c.jpg"])
+
+        self.assertEqual(self.client.post(url, {"id": entries[0]["id"]}).status_code, 404)
+        self.assertEqual(self.client.post(url, {"id": "1/../a.jpg"}).status_code, 400)
+        (self.dirpath / "b_.jpg").touch()
+        self.assertEqual(self.client.post(url, {"id": entries[1]["id"]}).status_code, 400)
+        # neither the new image nor the entry is lost
+        self.assertEqual((self.dirpath / "b_.jpg").stat().st_size, 0)
+        self.assertEqual(len(FSImagesProvider(self.gallery).get_trash()), 1)
+
+    def test_restore_without_hard_links(self):
+        provider = FSImagesProvider(self.gallery)
+        provider.delete_image("a.jpg")
+        provider.delete_image("b_.jpg")
+        entries = provider.get_trash()
+        url = reverse("restore-image", args=["gallery"])
+
+        with mock.patch("os.link", side_effect=PermissionError(errno.EPERM, "Operation not permitted")):
+            resp = self.client.post(url, {"id": entries[0].id})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual((self.dirpath / "a.jpg").stat().st_size, 10)
+
+            (self.dirpath / "b_.jpg").touch()
+            self.assertEqual(self.client.post(url, {"id": entries[1].id}).status_code, 400)
+            self.assertEqual((self.dirpath / "b_.jpg").stat().st_size, 0)
+            (self.dirpath / "b_.jpg").unlink()
+
+            with mock.patch("os.replace", side_effect=OSError(errno.EIO, "Input/output error")):
+                resp = self.client.post(url, {"id": entries[1].id})
+            self.assertEqual(resp.status_code, 409)
+            self.assertFalse((self.dirpath / "b_.jpg").exists())
+        self.assertListEqual([entry.name for entry in provider.get_trash()], ["b_.jpg"])
+
+    def test_sidecar_mark_restored(self):
+        with TemporaryDirectory() as marks_dir, override_settings(IMAGE_PICKER_MARKS_DIR=marks_dir):
+            self.gallery.mark_mode = MarkMode.SIDECAR
+            self.gallery.save()
+            provider = FSImagesProvider(self.gallery)
+            provider.mark_image("a.jpg")
+            provider.delete_image("a.jpg")
+            provider.delete_image("sub/c.jpg")
+            self.assertFalse(provider.is_marked("a.jpg"))
+            entries = provider.get_trash()
+            self.assertListEqual([(entry.name, entry.marked) for entry in entries],
+                                 [("a.jpg", True), ("sub/c.jpg", False)])
+
+            self.assertTrue(provider.restore_image(entries[0].id).marked)
+            self.assertTrue(provider.is_marked("a.jpg"))
+            self.assertFalse(provider.restore_image(entries[1].id).marked)
+            self.assertListEqual(os.listdir(self.dirpath / TRASH_DIR), [])
+            get_mark_store("gallery").close()
+
+    def test_purge(self):
+        trash = Trash(self.dirpath)
+        for name in ("a.jpg", "b_.jpg", "sub/c.jpg"):
+            trash.move(self.dirpath / name, name)
+        self.assertEqual(len(trash.entries()), 3)
+
+        # nothing is old enough yet
+        self.assertEqual(trash.purge(max_age=60).purged, 0)
+        # the oldest one goes to get under the quota
+        result = trash.purge(max_bytes=25)
+        self.assertEqual((result.purged, result.freed), (1, 10))
+        self.assertListEqual([entry.name for entry in trash.entries()], ["b_.jpg", "sub/c.jpg"])
+
+        result = trash.purge(max_age=60, now=time.time() + 120)
+        self.assertEqual(result.purged, 2)
+        self.assertListEqual(os.listdir(self.dirpath / TRASH_DIR), [])
+
+    def test_purge_command(self):
+        FSImagesProvider(self.gallery).delete_image("a.jpg")
+        out = StringIO()
+        call_command("purge_trash", "--max-age-days", "0", stdout=out)
+        self.assertIn("gallery: 1 purged, 10 bytes freed", out.getvalue())
+        self.assertListEqual(FSImagesProvider(self.gallery).get_trash(), [])
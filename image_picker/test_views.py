@@ -1,3 +1,4 @@
+import json
 from pathlib import Path
 from typing import cast
 import tempfile
@@ -9,6 +10,7 @@ from rest_framework.test import APITestCase
 from rest_framework.response import Response
 
 from  .models import Gallery
+from .serializers import ImageUrls
 
 stat_mock = Mock()
 stat_mock.stat = Mock(return_value={'st_mtime':1000})
@@ -80,6 +82,92 @@ class ImagesTestCase(APITestCase):
             len(list(filter(lambda e: not e['marked'], resp.data))), 0
         )
     
+    def test_images_page(self):
+        url = reverse("images", args=['gallery']) + "?show_mode=all&sort=name&order=desc&limit=4"
+        names = []
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 200)
+            names += [i["name"] for i in resp.data["results"]]
+            self.assertTrue(all("url" in i for i in resp.data["results"]))
+            url = resp.data["next"]
+
+        all_images = self.client.get(reverse("images", args=['gallery']) + "?show_mode=all").data
+        self.assertListEqual(names, sorted((i["name"] for i in all_images), reverse=True))
+
+        # invalid params
+        url = reverse("images", args=['gallery'])
+        resp = self.client.get(url + "?sort=size")
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(url + "?cursor=bad")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_images_columns(self):
+        url = reverse("images", args=['gallery']) + "?show_mode=all"
+        rows = self.client.get(url).data
+        resp = self.client.get(url + "&layout=columns")
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.content)
+
+        self.assertListEqual(data["names"], [i["name"] for i in rows])
+        self.assertListEqual(data["mod_times"], [i["mod_time"] for i in rows])
+        self.assertListEqual(data["marked"], [i["marked"] for i in rows])
+        self.assertTrue(all(data["url_prefix"] + i["name"] == i["url"] for i in rows))
+
+        resp = self.client.get(url + "&layout=columns&limit=3")
+        self.assertEqual(len(resp.data["names"]), 3)
+        self.assertIsNotNone(resp.data["next"])
+
+        resp = self.client.get(url + "&layout=table")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_image_neighbors(self):
+        url = reverse("image-neighbors", args=['gallery', '05.jpg'])
+        resp = self.client.get(url + "?show_mode=all&sort=name&count=2")
+        self.assertEqual(resp.status_code, 200)
+        self.assertListEqual([i["name"] for i in resp.data["next"]], ["06_.jpg", "07.jpg"])
+        self.assertListEqual([i["name"] for i in resp.data["previous"]], ["04_.jpg", "03.jpg"])
+        self.assertEqual(
+            resp["Link"].split(", ")[0],
+            f"<{reverse('get-image', args=['gallery', '06_.jpg'])}>; rel=preload; as=image"
+        )
+        self.assertEqual(len(resp["Link"].split(", ")), 4)
+
+        # current image needn't match show mode
+        resp = self.client.get(reverse("image-neighbors", args=['gallery', '04_.jpg'])
+                               + "?sort=name&order=desc&count=1")
+        self.assertListEqual([i["name"] for i in resp.data["next"]], ["03.jpg"])
+        self.assertListEqual([i["name"] for i in resp.data["previous"]], ["05.jpg"])
+
+        resp = self.client.get(reverse("image-neighbors", args=['gallery', '01.jpg']) + "?count=0")
+        self.assertFalse(resp.has_header("Link"))
+
+        resp = self.client.get(reverse("image-neighbors", args=['gallery', 'missing.jpg']))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_image_urls(self):
+        urls = ImageUrls("get-image", "gallery")
+        for name in ("01.jpg", "a b%#?.jpg", "фото.jpg", "a+b;c=d@e.jpg"):
+            self.assertEqual(urls(name), reverse("get-image", args=["gallery", name]))
+
+    def test_images_stream(self):
+        url = reverse("images", args=['gallery'])
+        expected = {i["name"] for i in self.client.get(url + "?show_mode=all").data}
+
+        for resp in (self.client.get(url + "?show_mode=all&stream=1"),
+                     self.client.get(url + "?show_mode=all", HTTP_ACCEPT="application/x-ndjson")):
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.streaming)
+            self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+            lines = b"".join(resp.streaming_content).splitlines()
+            images = [json.loads(line) for line in lines]
+            self.assertSetEqual({i["name"] for i in images}, expected)
+            self.assertTrue(all(i["url"].endswith(i["name"]) for i in images))
+
+        # not found is still reported before streaming
+        resp = self.client.get(reverse("images", args=['gallery1']) + "?stream=1")
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_image(self):
         # normal path
         url = reverse("get-image", args=["gallery", self.files_list[0]])
@@ -94,6 +182,100 @@ class ImagesTestCase(APITestCase):
 
         self.assertEqual(resp.status_code, 404)
     
+    def test_get_image_conditional(self):
+        image = self.tmp_dir_path / "conditional.jpg"
+        image.write_bytes(b"0123456789")
+        self.addCleanup(image.unlink)
+        url = reverse("get-image", args=["gallery", image.name])
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(b"".join(resp.streaming_content), b"0123456789")
+        self.assertEqual(resp["Accept-Ranges"], "bytes")
+        self.assertIn("Cache-Control", resp)
+        etag, last_modified = resp["ETag"], resp["Last-Modified"]
+        resp.close()
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(resp.status_code, 304)
+
+    def test_get_image_range(self):
+        image = self.tmp_dir_path / "range.jpg"
+        image.write_bytes(b"0123456789")
+        self.addCleanup(image.unlink)
+        url = reverse("get-image", args=["gallery", image.name])
+
+        for header, content, content_range in (("bytes=2-4", b"234", "bytes 2-4/10"),
+                                               ("bytes=7-", b"789", "bytes 7-9/10"),
+                                               ("bytes=-2", b"89", "bytes 8-9/10"),
+                                               ("bytes=8-100", b"89", "bytes 8-9/10")):
+            resp = self.client.get(url, HTTP_RANGE=header)
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(b"".join(resp.streaming_content), content)
+            self.assertEqual(resp["Content-Range"], content_range)
+            self.assertEqual(resp["Content-Length"], str(len(content)))
+
+        resp = self.client.get(url, HTTP_RANGE="bytes=10-")
+        self.assertEqual(resp.status_code, 416)
+        self.assertEqual(resp["Content-Range"], "bytes */10")
+
+        # stale If-Range, multiple ranges and invalid ones fall back to the whole file
+        for extra in ({"HTTP_RANGE": "bytes=0-1", "HTTP_IF_RANGE": '"stale"'},
+                      {"HTTP_RANGE": "bytes=0-1,3-4"}, {"HTTP_RANGE": "bytes=5-2"}):
+            resp = self.client.get(url, **extra)
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+    def test_get_image_delivery_backends(self):
+        image = self.tmp_dir_path / "delivery.jpg"
+        image.write_bytes(b"0123456789")
+        self.addCleanup(image.unlink)
+        url = reverse("get-image", args=["gallery", image.name])
+        image_path = image.resolve()
+
+        with self.settings(IMAGE_PICKER_DELIVERY_BACKEND="sendfile"):
+            resp = self.client.get(url)
+            self.assertEqual(b"".join(resp.streaming_content), b"0123456789")
+            resp = self.client.get(url, HTTP_RANGE="bytes=3-5")
+            self.assertEqual(resp.status_code, 206)
+            self.assertEqual(b"".join(resp.streaming_content), b"345")
+            self.assertEqual(resp["Content-Length"], "3")
+
+        with self.settings(IMAGE_PICKER_DELIVERY_BACKEND="x-sendfile"):
+            resp = self.client.get(url)
+            self.assertEqual(resp["X-Sendfile"], str(image_path))
+            self.assertEqual(resp.content, b"")
+
+        with self.settings(IMAGE_PICKER_DELIVERY_BACKEND="x-accel-redirect",
+                           IMAGE_PICKER_X_ACCEL_LOCATION="/protected/"):
+            resp = self.client.get(url)
+            self.assertEqual(resp["X-Accel-Redirect"], "/protected" + str(image_path))
+            self.assertEqual(resp["Content-Type"], "image/jpeg")
+
+            # conditional requests are still answered by the app
+            resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp["ETag"])
+            self.assertEqual(resp.status_code, 304)
+            self.assertNotIn("X-Accel-Redirect", resp)
+
+        # images outside of gallery are never handed off
+        resp = self.client.get(reverse("get-image", args=["gallery", "sub/" + image.name]))
+        self.assertEqual(resp.status_code, 404)
+
+    def test_get_thumbnail(self):
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                self.settings(IMAGE_PICKER_THUMBNAIL_DIR=cache_dir):
+            # undecodable image falls back to the original
+            url = reverse("get-thumbnail", args=["gallery", "small", self.files_list[0]])
+            resp = self.client.get(url)
+            self.assertRedirects(resp, reverse("get-image", args=["gallery", self.files_list[0]]),
+                                 fetch_redirect_response=False)
+
+            url = reverse("get-thumbnail", args=["gallery", "small", "not_exists.jpg"])
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, 404)
+
     def test_mark_image(self):
 
         # already marked
@@ -172,6 +354,64 @@ class ImagesTestCase(APITestCase):
         # check status
         self.assertEqual(resp.status_code, 404)
 
+    def test_batch_images(self):
+        url = reverse("batch-images", args=["gallery"])
+        for parallel in (False, True):
+            names = [f"batch_{i}{'p' if parallel else ''}.jpg" for i in range(3)]
+            for name in names:
+                (self.tmp_dir_path / name).touch()
+            (self.tmp_dir_path / names[1]).rename(self.tmp_dir_path / names[1].replace(".jpg", "_.jpg"))
+
+            operations = [
+                {"name": names[0], "op": "mark"},
+                {"name": names[1].replace(".jpg", "_.jpg"), "op": "unmark"},
+                {"name": names[2], "op": "delete"},
+                {"name": "batch_not_exists.jpg", "op": "delete"},
+            ]
+            resp = cast(Response, self.client.post(
+                url, {"operations": operations, "parallel": parallel}, format="json"
+            ))
+            self.assertEqual(resp.status_code, 200)
+
+            results = cast(dict, resp.data)["results"]
+            self.assertListEqual([r["status"] for r in results], ["ok", "ok", "ok", "not_found"])
+            self.assertEqual(results[0]["image"]["name"], names[0].replace(".jpg", "_.jpg"))
+            self.assertTrue(results[0]["image"]["url"].endswith(results[0]["image"]["name"]))
+            self.assertEqual(results[1]["image"]["name"], names[1])
+            self.assertIsNone(results[2]["image"])
+            self.assertFalse((self.tmp_dir_path / names[2]).exists())
+
+            for name in (names[0].replace(".jpg", "_.jpg"), names[1]):
+                (self.tmp_dir_path / name).unlink()
+
+        # invalid operation
+        resp = cast(Response, self.client.post(
+            url, {"operations": [{"name": "a.jpg", "op": "rotate"}]}, format="json"
+        ))
+        self.assertEqual(resp.status_code, 400)
+
+    def test_batch_images_parallel_order(self):
+        url = reverse("batch-images", args=["gallery"])
+        names = [f"order_{i}.jpg" for i in range(8)]
+        for name in names:
+            (self.tmp_dir_path / name).touch()
+            for leftover in (name, name.replace(".jpg", "_.jpg")):
+                self.addCleanup((self.tmp_dir_path / leftover).unlink, missing_ok=True)
+        # every image is marked, unmarked and marked again, then deleted under its marked name
+        operations = [{"name": name.replace(".jpg", suffix), "op": op}
+                      for name in names
+                      for suffix, op in ((".jpg", "mark"), ("_.jpg", "unmark"), (".jpg", "mark"),
+                                         ("_.jpg", "delete"))]
+        resp = cast(Response, self.client.post(
+            url, {"operations": operations, "parallel": True}, format="json"
+        ))
+        results = cast(dict, resp.data)["results"]
+        self.assertListEqual([(r["name"], r["status"]) for r in results],
+                             [(o["name"], "ok") for o in operations])
+        for name in names:
+            self.assertFalse((self.tmp_dir_path / name).exists())
+            self.assertFalse((self.tmp_dir_path / name.replace(".jpg", "_.jpg")).exists())
+
     def test_delete_image(self):
         for_delete = self.tmp_dir_path / "for_delete.jpg"
         for_delete.touch()
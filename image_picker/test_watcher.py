@@ -0,0 +1,141 @@
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from . import watcher as watcher_module
+from .models import Gallery, Image
+from .services import FSImagesProvider, ShowMode, images_index_cache
+from .watcher import (Change, GalleriesWatcher, InotifyBackend, PollingBackend, WatchBackend,
+                      WatcherOverflow)
+
+
+class StubBackend(WatchBackend):
+
+    def __init__(self) -> None:
+        self.changes: list[Change]|Exception = []
+
+    def add(self, key, dirpath):
+        pass
+
+    def remove(self, key):
+        pass
+
+    def read(self, timeout):
+        changes, self.changes = self.changes, []
+        if isinstance(changes, Exception):
+            raise changes
+        return changes
+
+
+class WatchBackendsTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.tmpdir_path = Path(self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def check_backend(self, backend:WatchBackend) -> None:
+        (self.tmpdir_path / "old.jpg").touch()
+        backend.add("gallery", self.tmpdir_path)
+
+        (self.tmpdir_path / "new.jpg").touch()
+        (self.tmpdir_path / "old.jpg").unlink()
+        names = {change.name for change in backend.read(1) if change.key == "gallery"}
+        self.assertSetEqual(names, {"new.jpg", "old.jpg"})
+
+        backend.remove("gallery")
+        (self.tmpdir_path / "other.jpg").touch()
+        self.assertListEqual(backend.read(0), [])
+        backend.close()
+
+    def test_polling(self):
+        self.check_backend(PollingBackend(interval=0))
+
+    @skipUnless(sys.platform.startswith("linux"), "inotify is linux only")
+    def test_inotify(self):
+        self.check_backend(InotifyBackend())
+
+
+class GalleriesWatcherTestCase(TestCase):
+
+    def setUp(self) -> None:
+        self.tmpdir = TemporaryDirectory()
+        self.tmpdir_path = Path(self.tmpdir.name)
+        (self.tmpdir_path / "1.jpg").touch()
+        # only this gallery is watched
+        Gallery.objects.all().delete()
+        self.gallery = Gallery.objects.create(title="watched", slug="watched",
+                                              dir_path=self.tmpdir.name)
+        self.backend = StubBackend()
+        self.watcher = GalleriesWatcher(self.backend)
+        self.watcher.refresh_galleries()
+
+    def tearDown(self) -> None:
+        images_index_cache.invalidate("watched")
+        self.tmpdir.cleanup()
+
+    def names(self) -> set[str]:
+        # requests must not scan while gallery is watched
+        with patch.object(FSImagesProvider, "scan_images", side_effect=AssertionError("scanned")):
+            return {i.name for i in FSImagesProvider(self.gallery).get_images(ShowMode.ALL)}
+
+    def test_changes_applied(self):
+        self.assertSetEqual(self.names(), {"1.jpg"})
+
+        (self.tmpdir_path / "1.jpg").rename(self.tmpdir_path / "1_.jpg")
+        (self.tmpdir_path / "2.jpg").touch()
+        self.backend.changes = [Change("watched", "1.jpg"), Change("watched", "1_.jpg"),
+                                Change("watched", "2.jpg"), Change("watched", "notes.txt")]
+        self.watcher.step()
+        self.assertSetEqual(self.names(), {"1_.jpg", "2.jpg"})
+
+    def test_overflow_resync(self):
+        (self.tmpdir_path / "2.jpg").touch()
+        self.backend.changes = WatcherOverflow()
+        with self.assertLogs("image_picker.watcher", "WARNING"):
+            self.watcher.step()
+        self.assertSetEqual(self.names(), {"1.jpg", "2.jpg"})
+
+    def test_not_live_after_stop(self):
+        self.watcher.start()
+        self.watcher.stop()
+        self.assertFalse(self.watcher.healthy)
+        self.assertFalse(images_index_cache.peek("watched").live)
+
+    def test_restarted_after_failure(self):
+        self.backend.changes = RuntimeError("boom")
+        with patch.object(watcher_module, "create_backend", return_value=self.backend), \
+                patch.object(watcher_module, "_watcher", None), patch.object(watcher_module, "_restarts", 0), \
+                patch.object(GalleriesWatcher, "refresh_galleries"):
+            with self.assertLogs("image_picker.watcher", "ERROR"):
+                failed = watcher_module.ensure_watcher_started()
+                failed._thread.join()
+            self.assertTrue(watcher_module.watcher_failed())
+            # not before the backoff delay
+            self.assertIs(watcher_module.ensure_watcher_started(), failed)
+
+            failed.failed_at -= 1
+            with self.assertLogs("image_picker.watcher", "WARNING"):
+                restarted = watcher_module.ensure_watcher_started()
+            self.assertIsNot(restarted, failed)
+            self.assertTrue(restarted.healthy)
+            restarted.stop()
+
+    @override_settings(IMAGE_PICKER_USE_IMAGES_INDEX=True)
+    def test_database_index(self):
+        watcher = GalleriesWatcher(self.backend, keep_memory_index=False)
+        watcher.refresh_galleries()
+        (self.tmpdir_path / "2.jpg").touch()
+        self.backend.changes = [Change("watched", "2.jpg")]
+        watcher.step()
+        self.assertSetEqual(
+            set(Image.objects.filter(gallery=self.gallery).values_list("name", flat=True)),
+            {"1.jpg", "2.jpg"}
+        )
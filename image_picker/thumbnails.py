@@ -0,0 +1,112 @@
+import hashlib
+import os
+import shutil
+import threading
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Protocol, cast
+
+from django.conf import settings
+from django.dispatch import receiver
+
+from .imaging import generate_thumbnail
+from .metrics import timed
+from .services import ImagesException
+from .signals import image_renamed, image_deleted
+from .workers import get_process_pool
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_THUMBNAIL_DIR: str|Path
+    IMAGE_PICKER_THUMBNAIL_SIZES: dict[str, int]
+    IMAGE_PICKER_THUMBNAIL_QUALITY: int
+    IMAGE_PICKER_THUMBNAIL_TIMEOUT: float
+
+
+settings = cast(MySettings, settings)
+
+DEFAULT_THUMBNAIL_SIZES = {"small": 320, "medium": 800, "large": 1600}
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_CONTENT_TYPE = "image/webp"
+
+class ThumbnailException(ImagesException):
+    pass
+
+def get_thumbnail_sizes() -> dict[str, int]:
+    return getattr(settings, "IMAGE_PICKER_THUMBNAIL_SIZES", DEFAULT_THUMBNAIL_SIZES)
+
+def get_cache_dir() -> Path:
+    return Path(settings.IMAGE_PICKER_THUMBNAIL_DIR)
+
+def get_source_cache_dir(source:Path) -> Path:
+    """ All thumbnails of one source file live in a directory keyed by its path """
+    return get_cache_dir() / hashlib.sha1(str(source).encode()).hexdigest()
+
+def get_thumbnail_path(source:Path, st:os.stat_result, size:int) -> Path:
+    return get_source_cache_dir(source) / f"{st.st_mtime_ns}-{st.st_size}-{size}.webp"
+
+_pending: dict[str, Future[str]] = {}
+_pending_lock = threading.Lock()
+
+def _submit(source:Path, target:Path, size:int) -> Future[str]:
+    # concurrent requests for the same thumbnail share one job
+    key = str(target)
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is None:
+            future = get_process_pool().submit(
+                generate_thumbnail, str(source), key, size,
+                getattr(settings, "IMAGE_PICKER_THUMBNAIL_QUALITY", 80), THUMBNAIL_FORMAT
+            )
+            _pending[key] = future
+        else:
+            return future
+    # outside of the lock as the callback runs at once for a finished job
+    future.add_done_callback(lambda _: _discard_pending(key))
+    return future
+
+def _discard_pending(key:str) -> None:
+    with _pending_lock:
+        _pending.pop(key, None)
+
+def remove_stale(target:Path) -> None:
+    """ Removes thumbnails of previous versions of the source """
+    prefix = target.name.split("-", 2)[:2]
+    for file in target.parent.iterdir():
+        if file.name.split("-", 2)[:2] != prefix:
+            file.unlink(missing_ok=True)
+
+def get_thumbnail(source:Path, size_name:str) -> Path:
+    """ Returns cached thumbnail path generating it if needed """
+    sizes = get_thumbnail_sizes()
+    if size_name not in sizes:
+        raise ThumbnailException(f"unknown thumbnail size {size_name}")
+
+    st = source.stat()
+    target = get_thumbnail_path(source, st, sizes[size_name])
+    if target.exists():
+        return target
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with timed("thumbnail"):
+            _submit(source, target, sizes[size_name]).result(
+                timeout=getattr(settings, "IMAGE_PICKER_THUMBNAIL_TIMEOUT", 30)
+            )
+    except Exception as e:
+        raise ThumbnailException(f"can't make thumbnail for {source.name}: {e}") from e
+
+    remove_stale(target)
+    return target
+
+def invalidate_thumbnails(source:Path) -> None:
+    shutil.rmtree(get_source_cache_dir(source), ignore_errors=True)
+
+
+@receiver(image_renamed)
+def on_image_renamed(sender:Any, old_path:Path, **kwargs:Any) -> None:
+    invalidate_thumbnails(old_path)
+
+@receiver(image_deleted)
+def on_image_deleted(sender:Any, path:Path, **kwargs:Any) -> None:
+    invalidate_thumbnails(path)
@@ -0,0 +1,277 @@
+""" Full size images re-encoded to formats the client accepts, kept in a size bounded cache """
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, NamedTuple, Protocol, cast
+
+from django.conf import settings
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .delivery import DeliveryBackend, serve_file
+from .imaging import transcode_image
+from .signals import image_renamed, image_deleted
+from .thumbnails import remove_stale
+from .workers import get_process_pool
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_TRANSCODE: bool
+    IMAGE_PICKER_TRANSCODE_DIR: str|Path
+    IMAGE_PICKER_TRANSCODE_FORMATS: list[str]
+    IMAGE_PICKER_TRANSCODE_QUALITY: int
+    IMAGE_PICKER_TRANSCODE_MIN_SIZE: int
+    IMAGE_PICKER_TRANSCODE_CACHE_MAX_BYTES: int
+
+
+settings = cast(MySettings, settings)
+
+class TranscodeFormat(NamedTuple):
+    pil_format: str
+    content_type: str
+    extension: str
+
+TRANSCODE_FORMATS = {
+    "avif": TranscodeFormat("AVIF", "image/avif", "avif"),
+    "webp": TranscodeFormat("WEBP", "image/webp", "webp"),
+}
+DEFAULT_FORMATS = ["avif", "webp"]
+# gif may be animated and webp is already compact
+SOURCE_EXTENSIONS = frozenset(("jpg", "jpeg", "png"))
+# cache is pruned down to this share of the limit so eviction doesn't run on every add
+LOW_WATERMARK = 0.9
+# last use of variants is tracked by mtime, refreshed at most this often
+TOUCH_INTERVAL = 3600
+
+
+def transcoding_enabled() -> bool:
+    return getattr(settings, "IMAGE_PICKER_TRANSCODE", False)
+
+def get_cache_dir() -> Path:
+    return Path(settings.IMAGE_PICKER_TRANSCODE_DIR)
+
+def get_max_bytes() -> int:
+    return getattr(settings, "IMAGE_PICKER_TRANSCODE_CACHE_MAX_BYTES", 2 * 1024 ** 3)
+
+def get_quality() -> int:
+    return getattr(settings, "IMAGE_PICKER_TRANSCODE_QUALITY", 75)
+
+def get_source_cache_dir(source:Path) -> Path:
+    """ All variants of one source file live in a directory keyed by its path """
+    return get_cache_dir() / hashlib.sha1(str(source).encode()).hexdigest()
+
+def get_variant_path(source:Path, st:os.stat_result, image_format:TranscodeFormat, quality:int) -> Path:
+    # same naming as thumbnails so remove_stale drops variants of previous versions
+    name = f"{st.st_mtime_ns}-{st.st_size}-{quality}.{image_format.extension}"
+    return get_source_cache_dir(source) / name
+
+
+def parse_accept(header:str) -> dict[str, float]:
+    """ Media types of an Accept header with their q values """
+    accepted: dict[str, float] = {}
+    for item in header.split(","):
+        media_type, *params = (part.strip() for part in item.split(";"))
+        if not media_type:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[media_type.lower()] = q
+    return accepted
+
+def negotiate_format(accept:str) -> TranscodeFormat|None:
+    """ First configured format the client accepts explicitly, wildcards don't count """
+    accepted = parse_accept(accept)
+    for name in getattr(settings, "IMAGE_PICKER_TRANSCODE_FORMATS", DEFAULT_FORMATS):
+        image_format = TRANSCODE_FORMATS[name]
+        if accepted.get(image_format.content_type, 0) > 0:
+            return image_format
+    return None
+
+def is_transcodable(source:Path, st:os.stat_result) -> bool:
+    extension = source.suffix[1:].lower()
+    return (extension in SOURCE_EXTENSIONS and
+            st.st_size >= getattr(settings, "IMAGE_PICKER_TRANSCODE_MIN_SIZE", 256 * 1024))
+
+
+class VariantsCache:
+    """ Tracks bytes of encoded variants and evicts least recently used ones over the limit
+
+    The size is an estimate of this process, eviction lists the cache directory
+    and corrects it with what other processes added.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._bytes: int|None = None
+        self._evicting = False
+
+    def added(self, size:int) -> None:
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+                if self._bytes <= get_max_bytes():
+                    return
+            if self._evicting:
+                return
+            self._evicting = True
+        threading.Thread(target=self._evict_in_background, daemon=True,
+                         name="transcode-eviction").start()
+
+    def _evict_in_background(self) -> None:
+        try:
+            self.evict()
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def evict(self, max_bytes:int|None=None) -> int:
+        """ Removes oldest used variants until the cache fits, returns bytes freed """
+        max_bytes = get_max_bytes() if max_bytes is None else max_bytes
+        files: list[tuple[float, int, str]] = []
+        for dirpath, _, filenames in os.walk(get_cache_dir()):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        freed = 0
+        if total > max_bytes:
+            target = max_bytes * LOW_WATERMARK
+            for _, size, path in sorted(files):
+                if total - freed <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                freed += size
+                parent = os.path.dirname(path)
+                if not os.listdir(parent):
+                    shutil.rmtree(parent, ignore_errors=True)
+
+        with self._lock:
+            self._bytes = total - freed
+        return freed
+
+
+variants_cache = VariantsCache()
+
+_pending: dict[str, Future[int]] = {}
+_pending_lock = threading.Lock()
+
+def _submit(source:Path, target:Path, image_format:TranscodeFormat, quality:int) -> Future[int]:
+    # concurrent requests for the same variant share one job
+    key = str(target)
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is not None:
+            return future
+        future = get_process_pool().submit(
+            transcode_image, str(source), key, quality, image_format.pil_format
+        )
+        _pending[key] = future
+    # outside of the lock as the callback runs at once for a finished job
+    future.add_done_callback(lambda done: _on_done(key, done))
+    return future
+
+def _on_done(key:str, future:Future[int]) -> None:
+    target = Path(key)
+    try:
+        if future.exception() is not None:
+            # an empty variant tells the source can't be transcoded until it changes
+            target.touch()
+        else:
+            remove_stale(target)
+            variants_cache.added(future.result())
+    except OSError:
+        pass
+    finally:
+        with _pending_lock:
+            _pending.pop(key, None)
+
+
+class NegotiatedImage(NamedTuple):
+    path: Path
+    content_type: str|None
+    # response depends on Accept header
+    varies: bool
+    # variant is being encoded and the original is served meanwhile
+    pending: bool
+
+
+def negotiate_image(source:Path, accept:str) -> NegotiatedImage:
+    """ Picks a cached variant the client accepts, scheduling encoding of missing ones """
+    original = NegotiatedImage(source, None, False, False)
+    if not transcoding_enabled():
+        return original
+    st = source.stat()
+    if not is_transcodable(source, st):
+        return original
+
+    image_format = negotiate_format(accept)
+    if image_format is None:
+        return original._replace(varies=True)
+
+    target = get_variant_path(source, st, image_format, get_quality())
+    try:
+        variant_st = target.stat()
+    except FileNotFoundError:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        _submit(source, target, image_format, get_quality())
+        return original._replace(varies=True, pending=True)
+
+    if time.time() - variant_st.st_mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(target)
+        except FileNotFoundError:
+            pass
+    # empty variants failed, bigger ones aren't worth it
+    if not 0 < variant_st.st_size < st.st_size:
+        return original._replace(varies=True)
+    return NegotiatedImage(target, image_format.content_type, True, False)
+
+
+def serve_image(request:HttpRequest, source:Path, backend:DeliveryBackend|None=None) -> HttpResponse:
+    """ Serves the image or its variant in a more efficient format accepted by the client """
+    image = negotiate_image(source, request.META.get("HTTP_ACCEPT", ""))
+    response = serve_file(request, image.path, image.content_type, backend)
+    if image.varies:
+        patch_vary_headers(response, ("Accept",))
+    if image.pending:
+        # revalidated next time, when the variant is likely ready
+        response["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def invalidate_variants(source:Path) -> None:
+    shutil.rmtree(get_source_cache_dir(source), ignore_errors=True)
+
+
+@receiver(image_renamed)
+def on_image_renamed(sender:Any, old_path:Path, new_path:Path, **kwargs:Any) -> None:
+    # renaming keeps mtime and size so variants stay valid for the new path
+    old_dir, new_dir = get_source_cache_dir(old_path), get_source_cache_dir(Path(new_path))
+    try:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.replace(old_dir, new_dir)
+    except FileNotFoundError:
+        pass
+
+@receiver(image_deleted)
+def on_image_deleted(sender:Any, path:Path, **kwargs:Any) -> None:
+    invalidate_variants(path)
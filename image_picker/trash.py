@@ -0,0 +1,195 @@
+""" Deleted images kept in a hidden directory of their gallery until purged, see IMAGE_PICKER_TRASH """
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple, Protocol, cast
+
+from django.conf import settings
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_TRASH: bool
+    IMAGE_PICKER_TRASH_MAX_AGE_DAYS: float|None
+    IMAGE_PICKER_TRASH_MAX_BYTES: int|None
+    IMAGE_PICKER_BATCH_WORKERS: int
+
+
+settings = cast(MySettings, settings)
+
+# hidden, so neither scans nor the watcher list it, and on the filesystem of the gallery
+# so moving images into it is a rename
+TRASH_DIR = ".trash"
+# empty file next to a batch directory whose image had a sidecar mark
+MARKED_SUFFIX = ".marked"
+
+def trash_enabled() -> bool:
+    return getattr(settings, "IMAGE_PICKER_TRASH", False)
+
+def get_max_age() -> float|None:
+    """ Seconds trashed images are kept for """
+    days = getattr(settings, "IMAGE_PICKER_TRASH_MAX_AGE_DAYS", 30)
+    return None if days is None else days * 24 * 60 * 60
+
+def get_max_bytes() -> int|None:
+    return getattr(settings, "IMAGE_PICKER_TRASH_MAX_BYTES", None)
+
+
+class TrashException(Exception):
+    pass
+
+
+class TrashEntry(NamedTuple):
+    # <deleted at ns>/<image name>
+    id: str
+    # relative to the gallery as in images api
+    name: str
+    # milliseconds like mod_time
+    deleted_at: float
+    size: int
+    # sidecar mark the image had, suffix marks stay in the name
+    marked: bool = False
+
+
+class PurgeResult(NamedTuple):
+    purged: int
+    freed: int
+    failed: int
+
+
+def _unlink(path:Path) -> int:
+    """ Size of the removed file, -1 if it couldn't be removed """
+    try:
+        size = path.stat().st_size
+        path.unlink()
+        return size
+    except FileNotFoundError:
+        return 0
+    except OSError:
+        return -1
+
+
+class Trash:
+    def __init__(self, dirpath:Path) -> None:
+        self.dirpath = dirpath
+        self.path = dirpath / TRASH_DIR
+
+    def move(self, file:Path, name:str, marked:bool=False) -> Path:
+        """ Moves an image of the gallery into the trash under a directory named by deletion time """
+        batch = str(time.time_ns())
+        target = self.path / batch / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        file.rename(target)
+        if marked:
+            (self.path / (batch + MARKED_SUFFIX)).touch()
+        return target
+
+    def entries(self) -> list[TrashEntry]:
+        """ Trashed images, oldest first """
+        entries: list[TrashEntry] = []
+        try:
+            listing = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return entries
+        marked = {entry.name[:-len(MARKED_SUFFIX)] for entry in listing if entry.name.endswith(MARKED_SUFFIX)}
+        batches = [entry for entry in listing if entry.name.isdigit()]
+        for batch in sorted(batches, key=lambda entry: int(entry.name)):
+            deleted_at = int(batch.name) / 1_000_000
+            for root, _, files in os.walk(batch.path):
+                for filename in files:
+                    path = Path(root, filename)
+                    try:
+                        size = path.stat().st_size
+                    except FileNotFoundError:
+                        continue
+                    name = path.relative_to(batch.path).as_posix()
+                    entries.append(TrashEntry(f"{batch.name}/{name}", name, deleted_at, size,
+                                              batch.name in marked))
+        return entries
+
+    def get_path(self, entry_id:str) -> Path:
+        batch, _, name = entry_id.partition("/")
+        parts = name.split("/")
+        if not batch.isdigit() or any(not part or part[0] == "." or "\\" in part for part in parts):
+            raise TrashException(f"invalid trash entry {entry_id}")
+        return self.path / batch / name
+
+    def restore(self, entry_id:str) -> tuple[str, Path, bool]:
+        """ Moves an entry back to its place in the gallery, returns its name, path and sidecar mark """
+        source = self.get_path(entry_id)
+        if not source.is_file():
+            raise FileNotFoundError(f"trash entry {entry_id} doesn't exist")
+        batch, _, name = entry_id.partition("/")
+        target = self.dirpath / name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # link fails on an existing target, rename would replace an image created meanwhile
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            raise TrashException(f"image {name} already exists")
+        except OSError:
+            # no hard links, e.g. on vfat or some network and FUSE mounts
+            self._replace_new(source, target, name)
+        else:
+            source.unlink()
+        marker = self.path / (batch + MARKED_SUFFIX)
+        marked = marker.exists()
+        self.remove_empty_dirs()
+        return name, target, marked
+
+    @staticmethod
+    def _replace_new(source:Path, target:Path, name:str) -> None:
+        """ Moves source to target only if target doesn't exist yet """
+        # the exclusive create claims the name, the rename then replaces only the placeholder
+        try:
+            os.close(os.open(target, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            raise TrashException(f"image {name} already exists")
+        try:
+            os.replace(source, target)
+        except OSError:
+            target.unlink(missing_ok=True)
+            raise
+
+    def purge(self, max_age:float|None=None, max_bytes:int|None=None,
+              now:float|None=None) -> PurgeResult:
+        """ Removes entries older than max_age seconds, then oldest ones above max_bytes """
+        entries = self.entries()
+        # entries are sorted, so expired ones are a prefix
+        expired = 0
+        if max_age is not None:
+            cutoff = ((time.time() if now is None else now) - max_age) * 1000
+            expired = next((i for i, entry in enumerate(entries) if entry.deleted_at >= cutoff), len(entries))
+        if max_bytes is not None:
+            kept = sum(entry.size for entry in entries[expired:])
+            while expired < len(entries) and kept > max_bytes:
+                kept -= entries[expired].size
+                expired += 1
+        if not expired:
+            return PurgeResult(0, 0, 0)
+
+        paths = [self.get_path(entry.id) for entry in entries[:expired]]
+        workers = getattr(settings, "IMAGE_PICKER_BATCH_WORKERS", 8)
+        # unlinks wait on the disk, not the interpreter
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = list(executor.map(_unlink, paths))
+        self.remove_empty_dirs()
+        failed = sum(1 for size in sizes if size < 0)
+        return PurgeResult(len(sizes) - failed, sum(size for size in sizes if size > 0), failed)
+
+    def remove_empty_dirs(self) -> None:
+        """ Removes emptied batch directories and marks of batches that are gone """
+        # bottom up so emptied parents go too, rmdir leaves directories that aren't empty
+        for root, _, _ in os.walk(self.path, topdown=False):
+            if root != str(self.path):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        try:
+            listing = set(os.listdir(self.path))
+        except FileNotFoundError:
+            return
+        for name in listing:
+            if name.endswith(MARKED_SUFFIX) and name[:-len(MARKED_SUFFIX)] not in listing:
+                (self.path / name).unlink(missing_ok=True)
@@ -2,17 +2,36 @@ from django.urls import path
 #from rest_framework.routers import DefaultRouter
 from .views import (
 	home, get_image, delete_image, GalleryListApiView, settings, images, mark_image,
+	get_thumbnail, batch_images, metrics, image_duplicates, gallery_duplicates, image_neighbors,
+	images_feed, gallery_trash, restore_image,
 )
+from .async_views import images_async, get_image_async, mark_image_async, delete_image_async
 
 urlpatterns = [
 	path('', home),
     path('galleries/', GalleryListApiView.as_view()),
+	path("feed/", images_feed, name="images-feed"),
 	path("galleries/<slug:gallery_slug>/images/", images, name="images"),
+	path("galleries/<slug:gallery_slug>/images/batch", batch_images, name="batch-images"),
+	path("galleries/<slug:gallery_slug>/trash/", gallery_trash, name="gallery-trash"),
+	path("galleries/<slug:gallery_slug>/trash/restore", restore_image, name="restore-image"),
+	path("galleries/<slug:gallery_slug>/duplicates/", gallery_duplicates, name="gallery-duplicates"),
+	path("galleries/<slug:gallery_slug>/images/<path:image_url>/neighbors", image_neighbors, name="image-neighbors"),
+	path("galleries/<slug:gallery_slug>/images/<path:image_url>/duplicates", image_duplicates, name="image-duplicates"),
 	path("galleries/<slug:gallery_slug>/images/<path:image_url>/mark", mark_image, {"mark":True}, name="mark-image"),
     path("galleries/<slug:gallery_slug>/images/<path:image_url>/unmark", mark_image, {"mark":False}, name="unmark-image"),
 	path('get-image/<slug:gallery_slug>/<path:image_url>', get_image, name="get-image"),
+	path('thumbnail/<slug:gallery_slug>/<slug:size>/<path:image_url>', get_thumbnail, name="get-thumbnail"),
 	path('delete-image/<slug:gallery_slug>/<path:image_url>', delete_image, name="delete-image"),
 	path('settings/', settings),
+	path('metrics', metrics, name="metrics"),
+
+	# native async versions for ASGI servers
+	path("async/galleries/<slug:gallery_slug>/images/", images_async, name="images-async"),
+	path("async/galleries/<slug:gallery_slug>/images/<path:image_url>/mark", mark_image_async, {"mark":True}, name="mark-image-async"),
+	path("async/galleries/<slug:gallery_slug>/images/<path:image_url>/unmark", mark_image_async, {"mark":False}, name="unmark-image-async"),
+	path('async/get-image/<slug:gallery_slug>/<path:image_url>', get_image_async, name="get-image-async"),
+	path('async/delete-image/<slug:gallery_slug>/<path:image_url>', delete_image_async, name="delete-image-async"),
 ]
 
 #router = DefaultRouter()
@@ -1,17 +1,36 @@
+from itertools import zip_longest
 from typing import cast
 
-from django.shortcuts import render, get_object_or_404
-from django.http import FileResponse, HttpRequest, HttpResponse, Http404
-from django.urls import reverse
+from django.shortcuts import render, redirect
+from django.http import HttpRequest, HttpResponse, HttpResponseForbidden, Http404, StreamingHttpResponse
 
 from rest_framework import status, generics, viewsets
-from rest_framework.decorators import action, api_view
+from rest_framework.decorators import action, api_view, renderer_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
-from .services import PickerSettings, FSImagesProvider, DEFAULT_SHOW_MODE, ShowModeA
-from .serializers import GallerySerializer, SettingsSerializer
+from .services import (FSImagesProvider, DEFAULT_SHOW_MODE, ShowModeA,
+                       ImagesException)
+from .serializers import (GallerySerializer, SettingsSerializer, ImagesPageQuerySerializer,
+                          BatchSerializer, DuplicatesQuerySerializer, ImagesMetadataQuerySerializer,
+                          NeighborsQuerySerializer, FeedQuerySerializer, TrashRestoreSerializer,
+                          ImagesLayout, ImageUrls, image_data, images_rows, images_columns,
+                          images_metadata_rows, images_metadata_columns)
+from .duplicates import get_hash_index
+from .feed import get_feed_page
+from .metadata import MetadataSortKey, get_metadata_index, prefetch_metadata
+from .renderers import FastJSONRenderer, NDJSONRenderer, OPTIONAL_RENDERER_CLASSES
+from .delivery import serve_file
+from .metrics import metrics_allowed, metrics_enabled, render_metrics, timed
+from .transcoding import serve_image
+from .trash import TrashException
+from .thumbnails import get_thumbnail as make_thumbnail, ThumbnailException, THUMBNAIL_CONTENT_TYPE
 from .models import Gallery
+from .registry import gallery_registry, get_gallery_or_404
+from .settings_store import get_settings_store
 
 # TODO mechanizm for checking ingoing image names /urls
 # TODO images views to viewset
@@ -24,44 +43,160 @@ def home(request:HttpRequest) -> HttpResponse:
         'image_picker/index_vue.html'
     )
 
+PAGE_QUERY_PARAMS = ("cursor", "limit", "sort", "order")
+METADATA_QUERY_PARAMS = ("metadata", "orientation", "min_width", "min_height", "image_format")
+
 @api_view(['GET'])
-def images(request:Request, gallery_slug:str) -> Response:
+@renderer_classes([FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer,
+                   *OPTIONAL_RENDERER_CLASSES])
+def images(request:Request, gallery_slug:str) -> Response|StreamingHttpResponse:
+
+    gallery = get_gallery_or_404(gallery_slug)
+
+    if (request.GET.get("stream") in ("1", "true") or
+            isinstance(request.accepted_renderer, NDJSONRenderer)):
+        return images_stream(request, gallery)
+
+    if (any(param in request.GET for param in METADATA_QUERY_PARAMS) or
+            request.GET.get("sort") in MetadataSortKey.KEYS_LIST):
+        return images_metadata(request, gallery)
+    prefetch_metadata(gallery)
+
+    # listing is paginated only when asked to keep the plain array for old clients
+    if any(param in request.GET for param in PAGE_QUERY_PARAMS):
+        return images_page(request, gallery)
 
-    gallery = get_object_or_404(Gallery, pk=gallery_slug)
     show_mode = request.GET.get("show_mode", DEFAULT_SHOW_MODE)
 
     helper = FSImagesProvider(gallery)
     
     images = helper.get_images(show_mode=cast(ShowModeA, show_mode))
 
-    data = [
-        {**image, 
-         "url": reverse("get-image", kwargs={
-                                        "gallery_slug":gallery_slug,
-                                        "image_url": image["name"]
-                                      })
-        } for image in images
-    ]
-    return Response(data=data)
+    layout = get_layout(request)
+    with timed("serialize"):
+        urls = ImageUrls("get-image", gallery_slug)
+        if layout == ImagesLayout.COLUMNS:
+            return Response(data=images_columns(images, urls))
+        return Response(data=images_rows(images, urls))
+
+
+def get_layout(request:Request) -> str:
+    layout = request.GET.get("layout", ImagesLayout.ROWS)
+    if layout not in ImagesLayout.LAYOUTS_LIST:
+        raise ValidationError({"layout": f"expected one of {ImagesLayout.LAYOUTS_LIST}"})
+    return layout
+
+
+def images_page(request:Request, gallery:Gallery) -> Response:
+    query = ImagesPageQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+
+    helper = FSImagesProvider(gallery)
+    try:
+        page = helper.get_page(**query.validated_data)
+    except ImagesException as e:
+        raise ValidationError({"cursor": str(e)})
+
+    layout = get_layout(request)
+    next_url = None
+    if page["next"]:
+        next_url = replace_query_param(request.build_absolute_uri(), "cursor", page["next"])
+
+    with timed("serialize"):
+        urls = ImageUrls("get-image", gallery.slug)
+        if layout == ImagesLayout.COLUMNS:
+            return Response(data={"next": next_url, **images_columns(page["results"], urls)})
+        return Response(data={"next": next_url, "results": images_rows(page["results"], urls)})
+
+
+def images_metadata(request:Request, gallery:Gallery) -> Response:
+    query = ImagesMetadataQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+    data = query.validated_data
+    filters = query.get_filter()
+
+    with timed("metadata"):
+        index = get_metadata_index(gallery)
+
+    layout = get_layout(request)
+    paginate = any(param in request.GET for param in PAGE_QUERY_PARAMS)
+    next_url = None
+    if paginate:
+        try:
+            page = index.page(data["show_mode"], data["sort"], data["order"], data.get("cursor"),
+                              data["limit"], filters)
+        except ImagesException as e:
+            raise ValidationError({"cursor": str(e)})
+        images = page["results"]
+        if page["next"]:
+            next_url = replace_query_param(request.build_absolute_uri(), "cursor", page["next"])
+    else:
+        images = index.filter(data["show_mode"], filters)
+
+    with timed("serialize"):
+        urls = ImageUrls("get-image", gallery.slug)
+        if layout == ImagesLayout.COLUMNS:
+            columns = images_metadata_columns(images, index.get, urls)
+            return Response(data={"next": next_url, **columns} if paginate else columns)
+        rows = images_metadata_rows(images, index.get, urls)
+        return Response(data={"next": next_url, "results": rows} if paginate else rows)
+
+
+def images_stream(request:Request, gallery:Gallery) -> StreamingHttpResponse:
+    show_mode = request.GET.get("show_mode", DEFAULT_SHOW_MODE)
+
+    helper = FSImagesProvider(gallery)
+    try:
+        images = helper.iter_images(show_mode=cast(ShowModeA, show_mode))
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+
+    urls = ImageUrls("get-image", gallery.slug)
+    data = (image_data(image, urls) for image in images)
+    return StreamingHttpResponse(
+        NDJSONRenderer.render_lines(data),
+        content_type=NDJSONRenderer.media_type
+    )
 	
 
-def get_image(_:HttpRequest, gallery_slug:str, image_url:str) -> FileResponse:
+def get_image(request:HttpRequest, gallery_slug:str, image_url:str) -> HttpResponse:
     
-    gallery = get_object_or_404(Gallery, pk=gallery_slug)
+    gallery = get_gallery_or_404(gallery_slug)
     
+    helper = FSImagesProvider(gallery)
     try:
-        fname = FSImagesProvider(gallery).get_image_path(image_url)
+        helper.check_parent_and_raise(image_url)
+        fname = helper.get_image_path(image_url)
+        return serve_image(request, fname)
     except FileNotFoundError as e:
         raise Http404(e.strerror)
-    return FileResponse(
-        open(fname, 'rb')
-    )
+    except ImagesException as e:
+        raise Http404(str(e))
+
+
+def get_thumbnail(request:HttpRequest, gallery_slug:str, size:str, image_url:str) -> HttpResponse:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    helper = FSImagesProvider(gallery)
+
+    try:
+        helper.check_parent_and_raise(image_url)
+        thumbnail = make_thumbnail(helper.get_image_path(image_url), size)
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+    except ThumbnailException:
+        # the browser can still downscale the original
+        return redirect("get-image", gallery_slug=gallery_slug, image_url=image_url)
+    except ImagesException as e:
+        raise Http404(str(e))
+
+    return serve_file(request, thumbnail, content_type=THUMBNAIL_CONTENT_TYPE)
 
 
 @api_view(['POST'])
 def mark_image(_, gallery_slug:str, image_url:str, mark:bool=True) -> Response:
   
-    gallery = get_object_or_404(Gallery, pk=gallery_slug)
+    gallery = get_gallery_or_404(gallery_slug)
   
     helper = FSImagesProvider(gallery)
     try:
@@ -69,20 +204,13 @@ def mark_image(_, gallery_slug:str, image_url:str, mark:bool=True) -> Response:
     except FileNotFoundError as e:
         raise Http404(e.strerror)
     
-    data = {
-        **image_info,
-        "url": reverse("get-image", kwargs={
-                                        "gallery_slug":gallery_slug,
-                                        "image_url": image_info["name"]
-                                      })
-    }
-    return Response(data=data)
+    return Response(data=image_data(image_info, ImageUrls("get-image", gallery_slug)))
 
   
 @api_view(['POST'])
 def delete_image(_, gallery_slug:str, image_url:str) -> Response:
 
-    gallery = get_object_or_404(Gallery, pk=gallery_slug)
+    gallery = get_gallery_or_404(gallery_slug)
     helper = FSImagesProvider(gallery)
     
     try:
@@ -92,43 +220,193 @@ def delete_image(_, gallery_slug:str, image_url:str) -> Response:
 
     return Response(status=status.HTTP_204_NO_CONTENT)
 
+@api_view(['GET'])
+def gallery_trash(_, gallery_slug:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    entries = FSImagesProvider(gallery).get_trash()
+    return Response(data={"results": [entry._asdict() for entry in entries]})
+
+@api_view(['POST'])
+def restore_image(request:Request, gallery_slug:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    serializer = TrashRestoreSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    helper = FSImagesProvider(gallery)
+    try:
+        image_info = helper.restore_image(serializer.validated_data["id"])
+    except FileNotFoundError as e:
+        raise Http404(str(e))
+    except TrashException as e:
+        raise ValidationError({"id": str(e)})
+    except OSError as e:
+        return Response(data={"detail": e.strerror or str(e)}, status=status.HTTP_409_CONFLICT)
+
+    return Response(data=image_data(image_info, ImageUrls("get-image", gallery_slug)))
+
+@api_view(['POST'])
+def batch_images(request:Request, gallery_slug:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+
+    serializer = BatchSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+
+    helper = FSImagesProvider(gallery)
+    results = helper.apply_batch(**serializer.validated_data)
+
+    urls = ImageUrls("get-image", gallery_slug)
+    data = [
+        {**result, "image": result["image"] and image_data(result["image"], urls)}
+        for result in results
+    ]
+    return Response(data={"results": data})
+
+@api_view(['GET'])
+@renderer_classes([FastJSONRenderer, *api_settings.DEFAULT_RENDERER_CLASSES])
+def images_feed(request:Request) -> Response:
+    """ Images of several galleries merged in one sort order """
+    query = FeedQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+    data = dict(query.validated_data)
+    galleries = data.pop("galleries", None) or gallery_registry.all()
+
+    try:
+        page = get_feed_page(galleries, **data)
+    except ImagesException as e:
+        raise ValidationError({"cursor": str(e)})
+
+    next_url = None
+    if page["next"]:
+        next_url = replace_query_param(request.build_absolute_uri(), "cursor", page["next"])
+
+    with timed("serialize"):
+        urls = {gallery.slug: ImageUrls("get-image", gallery.slug) for gallery in galleries}
+        results = [
+            {"gallery": item.gallery, **image_data(item.image, urls[item.gallery])}
+            for item in page["results"]
+        ]
+    return Response(data={"next": next_url, "results": results, "skipped": page["skipped"]})
+
+
+@api_view(['GET'])
+def image_neighbors(request:Request, gallery_slug:str, image_url:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    query = NeighborsQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+
+    helper = FSImagesProvider(gallery)
+    try:
+        following, preceding = helper.get_neighbors(image_url, **query.validated_data)
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+    except ImagesException as e:
+        raise Http404(str(e))
+
+    urls = ImageUrls("get-image", gallery_slug)
+    response = Response(data={
+        "name": image_url,
+        "next": images_rows(following, urls),
+        "previous": images_rows(preceding, urls),
+    })
+    # the browser warms its cache with the images while the current one is viewed
+    preload = [image for pair in zip_longest(following, preceding) for image in pair if image]
+    if preload:
+        response["Link"] = ", ".join(f"<{urls(image.name)}>; rel=preload; as=image" for image in preload)
+    return response
+
+
+@api_view(['GET'])
+def image_duplicates(request:Request, gallery_slug:str, image_url:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    query = DuplicatesQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+
+    helper = FSImagesProvider(gallery)
+    try:
+        helper.check_parent_and_raise(image_url)
+        helper.get_image_path(image_url)
+    except FileNotFoundError as e:
+        raise Http404(e.strerror)
+    except ImagesException as e:
+        raise Http404(str(e))
+
+    with timed("hashes"):
+        similar = get_hash_index(gallery).similar(image_url, query.validated_data["distance"])
+
+    urls = ImageUrls("get-image", gallery_slug)
+    data = [{"name": name, "distance": distance, "url": urls(name)} for distance, name in similar]
+    return Response(data={"name": image_url, "results": data})
+
+
+@api_view(['GET'])
+def gallery_duplicates(request:Request, gallery_slug:str) -> Response:
+
+    gallery = get_gallery_or_404(gallery_slug)
+    query = DuplicatesQuerySerializer(data=request.GET)
+    query.is_valid(raise_exception=True)
+
+    with timed("hashes"):
+        clusters = get_hash_index(gallery).clusters(query.validated_data["distance"])
+
+    urls = ImageUrls("get-image", gallery_slug)
+    data = [[{"name": name, "url": urls(name)} for name in cluster] for cluster in clusters]
+    return Response(data={"clusters": data})
+
 # TODO Validate gallery and show_mode from session stil exists
 # TODO Move to ApiView or GenericApiView class    
 @api_view(['GET', 'POST'])
 def settings(request: Request) -> Response:
+    store = get_settings_store()
     if request.method == 'GET':
-        picker_settings = PickerSettings.from_session(cast(HttpRequest,request))
+        picker_settings = store.load(cast(HttpRequest,request))
         serializer = SettingsSerializer(instance=picker_settings)
         return Response(serializer.data)
 
     elif request.method == 'POST':
         serializer = SettingsSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save(request=request)
-            return Response(serializer.data)
+            picker_settings = serializer.save()
+            response = Response(serializer.data)
+            store.save(cast(HttpRequest,request), response, picker_settings)
+            return response
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
+def metrics(request:HttpRequest) -> HttpResponse:
+    """ Prometheus scrape endpoint, counters are per process """
+    if not metrics_enabled():
+        raise Http404("metrics are disabled")
+    if not metrics_allowed(request):
+        return HttpResponseForbidden("metrics are restricted")
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 class GalleryListApiView(generics.ListAPIView): # type: ignore
     serializer_class = GallerySerializer
-    queryset = Gallery.objects.all()
+
+    def get_queryset(self) -> list[Gallery]: # type: ignore
+        return gallery_registry.all()
 
 
 class GalleryViewSet(viewsets.ViewSet):
 
     def list(self, request:Request):
-        qs = Gallery.objects.all()
-        s = GallerySerializer(instance=qs, many=True)
+        s = GallerySerializer(instance=gallery_registry.all(), many=True)
         return Response(s.data)
     
     @action(detail=False)
     def images(self, request:Request, gallery_slug:str) -> Response:
-        gallery = get_object_or_404(Gallery, pk=gallery_slug)
+        gallery = get_gallery_or_404(gallery_slug)
         show_mode = request.GET.get("show_mode", DEFAULT_SHOW_MODE)
 	
         helper = FSImagesProvider(gallery)
     
-        data = helper.get_images(show_mode=cast(ShowModeA, show_mode))
+        data = [image.to_dict() for image in helper.get_images(show_mode=cast(ShowModeA, show_mode))]
 	
         return Response(data=data)
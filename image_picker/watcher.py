@@ -0,0 +1,394 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import stat
+import struct
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, NamedTuple, Protocol, cast
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from .indexing import apply_changes, sync_gallery
+from .models import Gallery, Image
+from .services import (FSImagesProvider, GalleryIndex, ImageInfo, ImagesIndexCache, RACY_MTIME_NS,
+                       images_index_cache, iter_image_stats, parse_image_name)
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_WATCHER: bool
+    IMAGE_PICKER_WATCHER_BACKEND: str
+    IMAGE_PICKER_WATCHER_POLL_INTERVAL: float
+
+
+settings = cast(MySettings, settings)
+logger = logging.getLogger(__name__)
+
+
+class Change(NamedTuple):
+    """ Name changed in gallery directory, empty name means the directory itself """
+    key: str
+    name: str
+
+
+class WatcherOverflow(Exception):
+    """ Events were lost, watched galleries must be rescanned """
+
+
+class WatchBackend:
+
+    def add(self, key:str, dirpath:Path) -> None:
+        raise NotImplementedError()
+
+    def remove(self, key:str) -> None:
+        raise NotImplementedError()
+
+    def read(self, timeout:float) -> list[Change]:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_event_struct = struct.Struct("iIII")
+
+class InotifyBackend(WatchBackend):
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    read_size = 64 * 1024
+
+    def __init__(self) -> None:
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._keys: dict[int, str] = {}
+        self._wds: dict[str, int] = {}
+
+    def add(self, key:str, dirpath:Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(dirpath))
+        self._wds[key] = wd
+        self._keys[wd] = key
+
+    def remove(self, key:str) -> None:
+        wd = self._wds.pop(key, None)
+        if wd is not None:
+            self._keys.pop(wd, None)
+            # fails for already removed directories which is fine
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def read(self, timeout:float) -> list[Change]:
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return []
+
+        changes: list[Change] = []
+        while True:
+            try:
+                data = os.read(self._fd, self.read_size)
+            except BlockingIOError:
+                return changes
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _event_struct.unpack_from(data, offset)
+                offset += _event_struct.size
+                name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    raise WatcherOverflow()
+                key = self._keys.get(wd)
+                if key is None:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    changes.append(Change(key, ""))
+                elif not mask & IN_ISDIR:
+                    changes.append(Change(key, name))
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class PollingBackend(WatchBackend):
+    """ Rescans galleries whose directory mtime changed and reports the difference """
+
+    def __init__(self, interval:float=2.0) -> None:
+        self._interval = interval
+        self._dirs: dict[str, tuple[Path, int, dict[str, tuple[int, int]]]] = {}
+
+    @staticmethod
+    def snapshot(dirpath:Path) -> tuple[int, dict[str, tuple[int, int]]]:
+        token = os.stat(dirpath).st_mtime_ns
+        files = {name: (st.st_mtime_ns, st.st_size) for name, _, st in iter_image_stats(dirpath)}
+        return token, files
+
+    def add(self, key:str, dirpath:Path) -> None:
+        self._dirs[key] = (dirpath, *self.snapshot(dirpath))
+
+    def remove(self, key:str) -> None:
+        self._dirs.pop(key, None)
+
+    def poll(self) -> list[Change]:
+        changes: list[Change] = []
+        for key, (dirpath, token, files) in list(self._dirs.items()):
+            try:
+                mtime_ns = os.stat(dirpath).st_mtime_ns
+                if mtime_ns == token and time.time_ns() - token >= RACY_MTIME_NS:
+                    continue
+                new_token, new_files = self.snapshot(dirpath)
+            except FileNotFoundError:
+                changes.append(Change(key, ""))
+                continue
+
+            for name in files.keys() | new_files.keys():
+                if files.get(name) != new_files.get(name):
+                    changes.append(Change(key, name))
+            self._dirs[key] = (dirpath, new_token, new_files)
+        return changes
+
+    def read(self, timeout:float) -> list[Change]:
+        time.sleep(min(timeout, self._interval))
+        return self.poll()
+
+
+class GalleriesWatcher:
+    """ Keeps galleries indexes up to date applying filesystem changes """
+    refresh_interval = 30.0
+
+    def __init__(self, backend:WatchBackend, cache:ImagesIndexCache=images_index_cache,
+                 keep_memory_index:bool=True, timeout:float=1.0) -> None:
+        self._backend = backend
+        self._cache = cache
+        self._keep_memory_index = keep_memory_index
+        self._timeout = timeout
+        self._galleries: dict[str, Gallery] = {}
+        self._last_refresh = 0.0
+        self._running = False
+        self._stop = threading.Event()
+        self._thread: threading.Thread|None = None
+        self.started_at = 0.0
+        # when run failed, None while it didn't
+        self.failed_at: float|None = None
+
+    @property
+    def healthy(self) -> bool:
+        return self._running and (self._thread is None or self._thread.is_alive())
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def refresh_galleries(self) -> None:
+        # only the gallery directory is watched, recursive galleries revalidate by directories
+        galleries = {gallery.slug: gallery for gallery in Gallery.objects.filter(recursive=False)}
+        for key in self._galleries.keys() - galleries.keys():
+            self.unwatch(key)
+        for key, gallery in galleries.items():
+            watched = self._galleries.get(key)
+            if watched and watched.dir_path == gallery.dir_path:
+                continue
+            if watched:
+                self.unwatch(key)
+            self.watch(gallery)
+        self._last_refresh = time.monotonic()
+
+    def watch(self, gallery:Gallery) -> None:
+        provider = FSImagesProvider(gallery)
+        # watch is set before the scan so nothing happening during it is lost
+        try:
+            self._backend.add(gallery.slug, provider.dirpath)
+            self._galleries[gallery.slug] = gallery
+            self.load(gallery)
+        except OSError as e:
+            logger.warning("can't watch gallery %s: %s", gallery.slug, e)
+            self.unwatch(gallery.slug)
+
+    def unwatch(self, key:str) -> None:
+        self._backend.remove(key)
+        self._galleries.pop(key, None)
+        self._cache.invalidate(key)
+
+    def load(self, gallery:Gallery) -> None:
+        provider = FSImagesProvider(gallery)
+        if provider.use_images_index:
+            sync_gallery(gallery)
+        if not self._keep_memory_index:
+            return
+
+        if provider.use_images_index:
+            images = provider.get_indexed_images()
+        else:
+            images = provider.scan_images()
+        self._cache.put(gallery.slug, GalleryIndex(provider.dirpath, None, images, live=True))
+
+    def resync(self) -> None:
+        for gallery in list(self._galleries.values()):
+            self.load(gallery)
+
+    def apply(self, changes:list[Change]) -> None:
+        names_by_key: dict[str, set[str]] = {}
+        for change in changes:
+            names_by_key.setdefault(change.key, set()).add(change.name)
+
+        for key, names in names_by_key.items():
+            gallery = self._galleries.get(key)
+            if gallery is None:
+                continue
+            if "" in names:
+                # gallery directory was removed or moved, next refresh watches it again
+                self.unwatch(key)
+                continue
+            self.apply_gallery_changes(gallery, names)
+
+    def apply_gallery_changes(self, gallery:Gallery, names:set[str]) -> None:
+        provider = FSImagesProvider(gallery)
+        removed: list[str] = []
+        upserts: list[tuple[str, bool, os.stat_result]] = []
+        for name in names:
+            marked = parse_image_name(name)
+            if marked is None:
+                continue
+            try:
+                st = os.stat(provider.dirpath / name)
+            except FileNotFoundError:
+                removed.append(name)
+                continue
+            if stat.S_ISREG(st.st_mode):
+                upserts.append((name, marked, st))
+            else:
+                removed.append(name)
+
+        if not removed and not upserts:
+            return
+
+        if provider.use_images_index:
+            apply_changes(gallery, removed, [
+                Image(gallery=gallery, name=name, marked=marked,
+                      mod_time=st.st_mtime * 1000, size=st.st_size)
+                for name, marked, st in upserts
+            ])
+
+        if self._keep_memory_index:
+            images = [ImageInfo(name, marked, st.st_mtime * 1000) for name, marked, st in upserts]
+            if not self._cache.update_live(gallery.slug, removed, images):
+                # evicted or replaced by a request scan
+                self.load(gallery)
+
+    def step(self) -> None:
+        if time.monotonic() - self._last_refresh > self.refresh_interval:
+            self.refresh_galleries()
+        try:
+            changes = self._backend.read(self._timeout)
+        except WatcherOverflow:
+            logger.warning("galleries watcher events overflow, resyncing")
+            self.resync()
+            return
+        if changes:
+            self.apply(changes)
+
+    def run(self) -> None:
+        self._running = True
+        try:
+            while not self._stop.is_set():
+                self.step()
+                close_old_connections()
+        except Exception:
+            self.failed_at = time.monotonic()
+            logger.exception("galleries watcher failed")
+            raise
+        finally:
+            self._running = False
+            # requests go back to validating indexes themselves
+            self._cache.set_not_live()
+            self._backend.close()
+
+    def start(self) -> None:
+        # healthy from now on, not from when the thread gets to run
+        self._running = True
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self.run, name="galleries-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def create_backend() -> WatchBackend:
+    name = getattr(settings, "IMAGE_PICKER_WATCHER_BACKEND", "auto")
+    if name in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            return InotifyBackend()
+        except (OSError, AttributeError) as e:
+            if name == "inotify":
+                raise
+            logger.warning("inotify is unavailable, polling galleries: %s", e)
+    return PollingBackend(getattr(settings, "IMAGE_PICKER_WATCHER_POLL_INTERVAL", 2.0))
+
+
+# failed watchers are restarted after 1, 2, 4... seconds up to this
+RESTART_BACKOFF_MAX = 300.0
+
+_watcher: GalleriesWatcher|None = None
+_watcher_lock = threading.Lock()
+_restarts = 0
+
+def restart_delay(restarts:int) -> float:
+    return min(RESTART_BACKOFF_MAX, 2.0 ** restarts)
+
+def watcher_failed() -> bool:
+    return _watcher is not None and not _watcher.healthy and not _watcher.stopped
+
+def ensure_watcher_started() -> GalleriesWatcher:
+    global _watcher, _restarts
+    with _watcher_lock:
+        if _watcher is not None and watcher_failed():
+            failed_at = _watcher.failed_at or _watcher.started_at
+            # one that ran for long failed for a new reason, backoff starts over
+            if failed_at - _watcher.started_at >= RESTART_BACKOFF_MAX:
+                _restarts = 0
+            if time.monotonic() - failed_at < restart_delay(_restarts):
+                return _watcher
+            logger.warning("restarting galleries watcher")
+            _restarts += 1
+            _watcher = None
+        if _watcher is None:
+            _watcher = GalleriesWatcher(create_backend())
+            _watcher.start()
+        return _watcher
+
+
+@receiver(request_started)
+def on_request_started(sender:Any, **kwargs:Any) -> None:
+    # started by the first request so management commands don't spawn it
+    if (_watcher is None or watcher_failed()) and getattr(settings, "IMAGE_PICKER_WATCHER", False):
+        ensure_watcher_started()
@@ -0,0 +1,67 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Protocol, cast
+
+from django.conf import settings
+
+
+class MySettings(Protocol):
+    IMAGE_PICKER_PROCESS_POOL_WORKERS: int|None
+    IMAGE_PICKER_WALK_WORKERS: int
+    IMAGE_PICKER_FEED_WORKERS: int
+
+
+settings = cast(MySettings, settings)
+
+_process_pool: ProcessPoolExecutor|None = None
+_process_pool_lock = threading.Lock()
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """ Shared bounded pool for CPU heavy image decoding off the request workers
+
+    Workers are spawned rather than forked from a threaded server process and
+    run functions from image_picker.imaging only.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=getattr(settings, "IMAGE_PICKER_PROCESS_POOL_WORKERS", None),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+_walk_pool: ThreadPoolExecutor|None = None
+_walk_pool_lock = threading.Lock()
+
+def get_walk_pool() -> ThreadPoolExecutor:
+    """ Shared threads listing subdirectories of recursive galleries
+
+    Tasks never wait on each other so the pool can't deadlock when it is full.
+    """
+    global _walk_pool
+    with _walk_pool_lock:
+        if _walk_pool is None:
+            _walk_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "IMAGE_PICKER_WALK_WORKERS", 8),
+                thread_name_prefix="image-picker-walk"
+            )
+        return _walk_pool
+
+_feed_pool: ThreadPoolExecutor|None = None
+_feed_pool_lock = threading.Lock()
+
+def get_feed_pool() -> ThreadPoolExecutor:
+    """ Shared threads loading listings of galleries merged into one feed
+
+    Separate from the walk pool as recursive listings wait on walk tasks.
+    """
+    global _feed_pool
+    with _feed_pool_lock:
+        if _feed_pool is None:
+            _feed_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, "IMAGE_PICKER_FEED_WORKERS", 8),
+                thread_name_prefix="image-picker-feed"
+            )
+        return _feed_pool